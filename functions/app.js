@@ -122,6 +122,16 @@ Model.setStates = (indivDeviceId, statesData) => {
     return admin.database().ref('states/' + indivDeviceId).update(statesData);
 };
 Model.getGroupDevicesByUserId = (userId) => {
+    // user_groups/{userId} lists the groups of the user (maintained by `client.py`),
+    // the groups are scanned when it is missing.
+    return getFromFirestore('user_groups', userId).get().then((indexsnap) => {
+        if(indexsnap.exists) {
+            return Promise.all(Object.keys(indexsnap.data()).map((groupId) => Model.getGroupDevices(groupId)));
+        }
+        return Model.scanGroupDevicesByUserId(userId);
+    });
+};
+Model.scanGroupDevicesByUserId = (userId) => {
     return admin.firestore().collection('groups').select(userId).get().then((querysnap) => {
         const groupDevicePromises = [];
         querysnap.forEach((docsnap) => {
@@ -189,13 +199,20 @@ const sync = (req, res, params={}) => {
         return device_payload;
     };
 
-    Promise.all([
-        Model.getGroupDevicesByUserId(params.uid),
-        Model.getUserDevices(params.uid)
-    ]).then((deviceData) => {
-        valuniq(flatten(deviceData)).forEach((data) => {
-            deviceProps['payload']['devices'].push(payload_data(data.id, data.name, data.data));
+    // user_syncs/{uid} is maintained by `client.py` (build_sync), the devices
+    // are collected from user_devices and group_devices when it is missing.
+    getFromFirestore('user_syncs', params.uid).get().then((docsnap) => {
+        if(docsnap.exists) {
+            return docsnap.data().devices;
+        }
+        return Promise.all([
+            Model.getGroupDevicesByUserId(params.uid),
+            Model.getUserDevices(params.uid)
+        ]).then((deviceData) => {
+            return valuniq(flatten(deviceData)).map((data) => payload_data(data.id, data.name, data.data));
         });
+    }).then((devices) => {
+        deviceProps['payload']['devices'] = devices;
         console.log('sync:', JSON.stringify(deviceProps));
         res.status(200).json(deviceProps);
         return;
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+## Benchmark of client.py sub-commands over synthetic topologies.
+## Each size seeds users, groups, devices, remotes, ircodes, user_devices and
+## group_devices (about <size> documents in total), then runs every scenario
+## and records wall time, RPCs, reads/writes and peak memory as JSON.
+## Runs against the in-memory backend with a simulated round trip by default,
+## or --backend firestore (e.g. with FIRESTORE_EMULATOR_HOST set).
+import os, sys
+import argparse
+import contextlib
+import datetime
+import json
+import random
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import client
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+REMOTE_TYPE = 'broadlink'
+ACTIONS = ('OnOff', 'BrightnessAbsolute', 'SetModes', 'SetToggles', 'ThermostatSetMode')
+## share of the documents per collection, in percent
+SHARES = {
+    'users': 10,
+    'groups': 2,
+    'devices': 10,
+    'remotes': 5,
+    'ircodes': 3,
+    'user_devices': 35,
+    'group_devices': 20,
+}
+## the seeded collections and those the scenarios write to
+COLLECTIONS = tuple(SHARES) + ('user_groups', 'user_syncs', 'ircode_blobs')
+
+class Topology(object):
+    def __init__(self, size, seed=0):
+        rnd = random.Random(seed)
+        count = lambda name: max(1, size * SHARES[name] // 100)
+        self.users = [ 'user{:06d}'.format(i) for i in range(count('users')) ]
+        self.devices = [ 'device{:06d}'.format(i) for i in range(count('devices')) ]
+        self.remotes = [ 'remote{:06d}'.format(i) for i in range(count('remotes')) ]
+        self.ircodes = [ 'ircode{:06d}'.format(i) for i in range(count('ircodes')) ]
+        self.groups = {}
+        for i in range(count('groups')):
+            self.groups['group{:06d}'.format(i)] = rnd.sample(self.users, min(3, len(self.users)))
+        self.user_devices = [ (rnd.choice(self.devices), rnd.choice(self.users), rnd.choice(self.remotes)) for _ in range(count('user_devices')) ]
+        self.group_devices = [ (rnd.choice(self.devices), rnd.choice(sorted(self.groups)), rnd.choice(self.remotes)) for _ in range(count('group_devices')) ]
+    def documents(self, db):
+        for user_id in self.users:
+            yield db.collection('users').document(user_id), { 'id': user_id, 'name': user_id + '@example.jp' }
+        for device_id in self.devices:
+            yield db.collection('devices').document(device_id), {
+                'manufacturer': 'Panasonic', 'model': device_id, 'type': 'action.devices.types.LIGHT',
+                'willReportState': False, 'traits': [ 'action.devices.traits.OnOff', 'action.devices.traits.Brightness', 'action.devices.traits.ColorSpectrum' ],
+                'attributes': { 'colorModel': 'rgb', 'commandOnlyOnOff': False },
+            }
+        for remote_id in self.remotes:
+            yield db.collection('remotes').document(remote_id), { 'mac_addr': '34:EA:34:00:00:00', 'type': REMOTE_TYPE, 'name': remote_id }
+        for ircode_id in self.ircodes:
+            yield db.collection('ircodes').document(ircode_id), {}
+            for action in ACTIONS:
+                yield db.collection('ircodes', ircode_id, REMOTE_TYPE).document(client.DEVICE_COMMANDS_PREFIX + action), { 'on': '2600ac00' * 32, 'off': '2600ad00' * 32 }
+        for group_id, members in self.groups.items():
+            yield db.collection('groups').document(group_id), { user_id: db.collection('users').document(user_id) for user_id in members }
+        for i, (device_id, user_id, remote_id) in enumerate(self.user_devices):
+            yield db.collection('user_devices').document('ud{:07d}'.format(i)), {
+                'deviceId': device_id, 'userId': user_id, 'remoteId': remote_id, 'name': 'user device {}'.format(i),
+                'deviceReference': db.collection('devices').document(device_id),
+                'userReference': db.collection('users').document(user_id),
+                'remoteReference': db.collection('remotes').document(remote_id),
+            }
+        for i, (device_id, group_id, remote_id) in enumerate(self.group_devices):
+            yield db.collection('group_devices').document('gd{:07d}'.format(i)), {
+                'deviceId': device_id, 'groupId': group_id, 'remoteId': remote_id, 'name': 'group device {}'.format(i),
+                'deviceReference': db.collection('devices').document(device_id),
+                'groupReference': db.collection('groups').document(group_id),
+                'remoteReference': db.collection('remotes').document(remote_id),
+            }
+    def seed(self, db):
+        batch = db.batch()
+        count = 0
+        for docref, docdata in self.documents(db):
+            batch.set(docref, docdata)
+            count += 1
+            if len(batch) >= 500:
+                batch.commit()
+                batch = db.batch()
+        if len(batch):
+            batch.commit()
+        return count
+    def clear(self, db):
+        ## the documents of the previous size, with their subcollections
+        batch = db.batch()
+        collection = client.BaseCollection(db)
+        for collectionPath in COLLECTIONS:
+            for docref in db.collection(collectionPath).list_documents():
+                for child in collection._subtree(docref):
+                    batch.delete(child)
+                    if len(batch) >= 500:
+                        batch.commit()
+                        batch = db.batch()
+        if len(batch):
+            batch.commit()
+    def scenarios(self):
+        user_id = self.users[0]
+        group_id = sorted(self.groups)[0]
+        device_id = self.devices[0]
+        remote_id = self.remotes[0]
+        ircode_id = self.ircodes[0]
+        return [
+            ('get_device', []),
+            ('get_device --full', ['--full']),
+            ('get_device_attr', ['--device-id', device_id]),
+            ('get_remote', []),
+            ('get_remote_code', ['--device-id', device_id, '--remote-type', REMOTE_TYPE]),
+            ('get_user', []),
+            ('get_group', []),
+            ('get_group --full', ['--full']),
+            ('get_user_device', []),
+            ('get_user_device --full', ['--full']),
+            ('get_user_device --user-id', ['--user-id', user_id, '--full']),
+            ('get_group_device', []),
+            ('get_group_device --group-id', ['--group-id', group_id, '--full']),
+            ('add_device', ['--manufacturer', 'Panasonic', '--model', 'BENCH', '--type', 'LIGHT', '--traits', 'OnOff']),
+            ('add_device_attr', ['--device-id', device_id, '--attr-name', 'colorModel', '--attr-data', '"hsv"']),
+            ('add_remote', ['--mac-addr', '34:EA:34:00:00:01', '--remote-type', REMOTE_TYPE]),
+            ('add_remote_code', ['--ircode-id', ircode_id, '--remote-type', REMOTE_TYPE, '--action', 'OnOff', '--values', 'on=2600', '--values', 'off=2601']),
+            ('add_user', ['--name', 'bench@example.jp']),
+            ('add_group', sum((['--user-id', u] for u in self.users[:3]), [])),
+            ('add_user_device', ['--device-id', device_id, '--user-id', user_id, '--remote-id', remote_id]),
+            ('add_group_device', ['--device-id', device_id, '--group-id', group_id, '--remote-id', remote_id]),
+            ('del_remote_code', ['--ircode-id', ircode_id, '--remote-type', REMOTE_TYPE, '--action', client.DEVICE_COMMANDS_PREFIX + 'SetModes']),
+            ('del_user_device', ['--user-device-id', 'ud0000000']),
+            ('del_group_device', ['--group-device-id', 'gd0000000']),
+        ]
+
+def run_scenario(db, parser, mode, argv, trace_memory, engine='sync'):
+    profiler = client.Profiler()
+    profiled = client.ProfiledClient(db, profiler)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    status = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            ## measured without the write governor's pacing
+            status = client.run_command(profiled, None, ['--engine', engine, '--write-rate', '0', '--document-write-interval', '0', mode] + argv, parser)
+        except SystemExit as e:
+            status = e.code
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    totals = profiler.summary()['totals']
+    return {
+        'wall_ms': round(elapsed * 1000, 3),
+        'rpcs': totals['rpcs'],
+        'reads': totals['reads'],
+        'writes': totals['writes'],
+        'deletes': totals['deletes'],
+        'peak_kib': None if peak is None else round(peak / 1024, 1),
+        'status': status,
+    }
+
+def compare(previous, current):
+    for size, scenarios in current['results'].items():
+        before = previous.get('results', {}).get(size, {})
+        for name, result in scenarios.items():
+            if name not in before:
+                continue
+            old = before[name]
+            ratio = result['wall_ms'] / old['wall_ms'] if old['wall_ms'] else float('inf')
+            sys.stderr.write("{:>7} {:<30} {:>10.1f}ms -> {:>10.1f}ms  x{:<6.2f} rpcs {:>6} -> {:<6}\n".format(
+                size, name, old['wall_ms'], result['wall_ms'], ratio, old['rpcs'], result['rpcs']))
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    p.add_argument('--scenario', action='append', help='run only these scenarios (repeatable)')
+    p.add_argument('--backend', type=str, default='memory', choices=('memory', 'firestore'))
+    p.add_argument('--rtt', type=float, default=1.0, help='simulated round trip per RPC in ms (memory backend)')
+    p.add_argument('--engine', type=str, default='sync', choices=('sync', 'async'))
+    p.add_argument('--no-memory', action='store_true', help='do not trace peak memory (tracing slows Python down)')
+    p.add_argument('--output', type=str)
+    p.add_argument('--compare', type=str, help='previous result file to compare with')
+    args = p.parse_args()
+
+    parser = client.build_parser()
+    report = {
+        'meta': {
+            'backend': args.backend,
+            'rtt_ms': args.rtt if args.backend == 'memory' else None,
+            'engine': args.engine,
+            'python': sys.version.split()[0],
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'trace_memory': not args.no_memory,
+        },
+        'results': {},
+    }
+    ## one backend (and firebase app) for every size
+    client.set_backend(client.MemoryBackend() if args.backend == 'memory' else client.FirestoreBackend())
+    db = client.get_client()
+    topology = None
+    for size in args.sizes:
+        if args.backend == 'memory':
+            db._store.latency = 0
+        if topology is not None:
+            topology.clear(db)
+        topology = Topology(size)
+        count = topology.seed(db)
+        if args.backend == 'memory':
+            db._store.latency = args.rtt / 1000
+        ## pay one-time imports (query filters) before the first measurement
+        client.BaseCollection(db)._where(db.collection('users'), 'id', '==', None)
+        results = report['results'][str(size)] = {}
+        for name, argv in topology.scenarios():
+            if args.scenario and name not in args.scenario:
+                continue
+            mode = name.split()[0]
+            results[name] = run_scenario(db, parser, mode, argv, not args.no_memory, args.engine)
+            r = results[name]
+            sys.stderr.write("{:>7} {:<30} {:>10.1f}ms {:>6} rpcs {:>7} reads {:>5} writes {:>10} KiB\n".format(
+                count, name, r['wall_ms'], r['rpcs'], r['reads'], r['writes'], r['peak_kib'] if r['peak_kib'] is not None else '-'))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, 'r') as fd:
+            compare(json.load(fd), report)
+
+if __name__ == '__main__':
+    main()
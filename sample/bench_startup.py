@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+## Cold-start latency of client.py per sub-command.
+## Every run is a fresh interpreter executing `client.py <mode> -h`, which
+## parses arguments only and must not import firebase_admin/grpc.
+import os, sys
+import argparse
+import json
+import subprocess
+import time
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py')
+
+PROBE = '''
+import sys, runpy
+sys.argv = [{client!r}] + {argv!r}
+try:
+    runpy.run_path({client!r}, run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write('\\nHEAVY_MODULES=' + ','.join(m for m in ('firebase_admin', 'grpc', 'google.cloud.firestore') if m in sys.modules) + '\\n')
+'''
+
+def measure(argv, repeat):
+    timings = []
+    heavy = set()
+    for _ in range(repeat):
+        code = PROBE.format(client=CLIENT, argv=argv)
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        timings.append((time.perf_counter() - start) * 1000)
+        for line in proc.stderr.splitlines():
+            if line.startswith('HEAVY_MODULES='):
+                heavy.update(m for m in line[len('HEAVY_MODULES='):].split(',') if m)
+    timings.sort()
+    return {
+        'argv': argv,
+        'runs': repeat,
+        'min_ms': round(timings[0], 2),
+        'median_ms': round(timings[len(timings) // 2], 2),
+        'max_ms': round(timings[-1], 2),
+        'heavy_modules': sorted(heavy),
+    }
+
+def interpreter(repeat):
+    ## startup of a bare interpreter, the floor for every measurement
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'])
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(min(timings), 2)
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--mode', action='append')
+    p.add_argument('--output', type=str)
+    args = p.parse_args()
+
+    sys.path.insert(0, os.path.dirname(CLIENT))
+    import client
+    modes = args.mode or list(client.mode_class.keys())
+    results = {
+        'python': sys.version.split()[0],
+        'interpreter_ms': interpreter(args.repeat),
+        'help': measure(['-h'], args.repeat),
+        'modes': {},
+    }
+    for mode in modes:
+        results['modes'][mode] = measure([mode, '-h'], args.repeat)
+        r = results['modes'][mode]
+        sys.stderr.write("{:<20} median {:>8.1f}ms  min {:>8.1f}ms  {}\n".format(mode, r['median_ms'], r['min_ms'], ','.join(r['heavy_modules']) or '-'))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output + "\n")
+    else:
+        print(output)
+    if any(r['heavy_modules'] for r in results['modes'].values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
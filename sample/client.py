@@ -1,49 +1,109 @@
 #!/usr/bin/env python3
 import os, sys, types
 import argparse
-import firebase_admin
-from firebase_admin import credentials,firestore
+import contextlib
+import copy
+import datetime
+import csv
+import hashlib
+import io
+import itertools
+import shlex
+import socketserver
+import time
 import pprint
-import json, urllib.request
+import re
+import json, urllib.parse
+import concurrent.futures
+import queue
+import random
+import threading
+import zlib
 
 ## List Device Traits, see https://developers.google.com/actions/smarthome/traits/
 DEVICE_TRAITS_PREFIX = 'action.devices.traits.'
 DEVICE_COMMANDS_PREFIX = 'action.devices.commands.'
+## valid thermostatMode values of TemperatureSetting
+THERMOSTAT_MODES = [ 'off', 'heat', 'cool', 'on', 'heatcool', 'auto', 'fan-only', 'purifier', 'eco', 'dry' ]
+
+## 'attributes' and 'states' are the schemas of sample/schema.py
 DEVICE_TRAITS = {
     'Brightness': {
         'description': '''Absolute brightness setting is in a normalized range from 0 to 100 (individual lights may not support every point in the range based on their LED configuration).''',
         'language': [ 'en', 'de', 'fr', 'ja', 'it' ],
         'commands': [
             'BrightnessAbsolute'
-        ]
+        ],
+        'attributes': {
+            'commandOnlyBrightness': { 'type': 'boolean' },
+        },
+        'states': {
+            'brightness': { 'type': 'integer', 'minimum': 0, 'maximum': 100 },
+        }
     },
     'CameraStream': {
         'description': '''This trait belongs to devices which have the capability to stream video feeds to third party screens, Chromecast-connected screens or an Android phone. By and large, these are currently security cameras or baby cameras. But this would also apply to more complex devices which have a camera on them (for example, video-conferencing robotics/devices or a vacuum robot with a camera on it).''',
         'language': [ 'en', 'de', 'fr', 'ja' ],
         'commands': [
             'GetCameraStream'
-        ]
+        ],
+        'attributes': {
+            'cameraStreamSupportedProtocols': { 'type': 'array', 'items': { 'enum': [ 'hls', 'dash', 'smooth_stream', 'progressive_mp4' ] } },
+            'cameraStreamNeedAuthToken': { 'type': 'boolean' },
+            'cameraStreamNeedDrmEncryption': { 'type': 'boolean' },
+        },
+        'states': {
+            ## command params, stored as the states by index.js and executor.py
+            'StreamToChromecast': { 'type': 'boolean' },
+            'SupportedStreamProtocols': { 'type': 'array', 'items': { 'type': 'string' } },
+        }
     },
     'ColorSpectrum': {
         'description': '''This applies to "full" color bulbs that take RGB color ranges. Lights may have any combination of ColorSpectrum and ColorTemperature; accent lights and LED strips may just have Spectrum, whereas some reading bulbs just have Temperature. Basic bulbs, or dumb lights on smart plugs, have neither.''',
         'language': [ 'en', 'de', 'fr', 'ja', 'it' ],
         'commands': [
             'ColorAbsolute'
-        ]
+        ],
+        'attributes': {
+            'colorModel': { 'enum': [ 'rgb', 'hsv' ] },
+            'commandOnlyColorSetting': { 'type': 'boolean' },
+        },
+        'states': {
+            'color': { 'type': 'object', 'properties': {
+                'name': { 'type': 'string' },
+                'spectrumRgb': { 'type': 'integer', 'minimum': 0, 'maximum': 0xFFFFFF },
+                'spectrumRGB': { 'type': 'integer', 'minimum': 0, 'maximum': 0xFFFFFF },
+            } },
+        }
     },
     'ColorTemperature': {
         'description': '''This applies to "warmth" bulbs that take a color point in Kelvin. This is generally a separate modality from ColorSpectrum, and there may be white points available via Temperature that cannot be reached by Spectrum. Based on available traits, Google may pick the appropriate mode to use based on request and light type (for example, Make the living room lights white might send Temperature commands to some bulbs and Spectrum commands to LED strips).''',
         'language': [ 'en', 'de', 'fr', 'ja', 'it' ],
         'commands': [
             'ColorAbsolute'
-        ]
+        ],
+        'attributes': {
+            'temperatureMinK': { 'type': 'integer', 'minimum': 0 },
+            'temperatureMaxK': { 'type': 'integer', 'minimum': 0 },
+        },
+        'states': {
+            'color': { 'type': 'object', 'properties': {
+                'name': { 'type': 'string' },
+                'temperature': { 'type': 'integer', 'minimum': 0 },
+                'temperatureK': { 'type': 'integer', 'minimum': 0 },
+            } },
+        }
     },
     'Dock': {
         'description': '''This trait is designed for self-mobile devices that can be commanded to return for charging.''',
         'language': [ 'en', 'de', 'fr', 'ja' ],
         'commands': [
             'Dock'
-        ]
+        ],
+        'attributes': {},
+        'states': {
+            'isDocked': { 'type': 'boolean' },
+        }
     },
     'FanSpeed': {
         'description': '''This trait belongs to devices that support setting the speed of a fan (that is, blowing air from the device at various levels, which may be part of an air conditioning or heating unit, or in a car), with settings such as low, medium, and high.''',
@@ -51,40 +111,110 @@ DEVICE_TRAITS = {
         'commands': [
             'SetFanSpeed',
             'Reverse'
-        ]
+        ],
+        'attributes': {
+            'availableFanSpeeds': { 'type': 'object', 'required': [ 'speeds' ], 'properties': {
+                'speeds': { 'type': 'array', 'items': { 'type': 'object', 'required': [ 'speed_name', 'speed_values' ], 'properties': {
+                    'speed_name': { 'type': 'string' },
+                    'speed_values': { 'type': 'array', 'items': { 'type': 'object', 'properties': {
+                        'speed_synonym': { 'type': 'array', 'items': { 'type': 'string' } },
+                        'lang': { 'type': 'string' },
+                    } } },
+                } } },
+                'ordered': { 'type': 'boolean' },
+            } },
+            'reversible': { 'type': 'boolean' },
+        },
+        'states': {
+            'currentFanSpeedSetting': { 'type': 'string' },
+            ## command params, stored as the states by index.js and executor.py
+            'fanSpeed': { 'type': 'string' },
+        }
     },
     'Locator': {
         'description': '''This trait is used for devices that can be "found". This includes phones, robots (including vacuums and mowers), drones, and tag-specific products that attach to other devices.''',
         'language': [ 'en', 'de', 'fr', 'ja' ],
         'commands': [
             'Locate'
-        ]
+        ],
+        'attributes': {},
+        'states': {
+            ## command params, stored as the states by index.js and executor.py
+            'silent': { 'type': 'boolean' },
+            'lang': { 'type': 'string' },
+        }
     },
     'Modes': {
         'description': '''This trait belongs to any devices with an arbitrary number of "n-way" modes in which the modes and settings for each mode are arbitrary and unique to each device or device type. Each mode has multiple possible settings, but only one can be selected at a time; a dryer cannot be in "delicate," "normal," and "heavy duty" mode simultaneously. A setting that simply can be turned on or off belongs in the Toggles trait.''',
         'language': [ 'en', 'de', 'fr', 'ja' ],
         'commands': [
             'SetModes'
-        ]
+        ],
+        'attributes': {
+            'availableModes': { 'type': 'array', 'items': { 'type': 'object', 'required': [ 'name', 'settings' ], 'properties': {
+                'name': { 'type': 'string' },
+                'name_values': { 'type': 'array', 'items': { 'type': 'object', 'properties': {
+                    'name_synonym': { 'type': 'array', 'items': { 'type': 'string' } },
+                    'lang': { 'type': 'string' },
+                } } },
+                'settings': { 'type': 'array', 'items': { 'type': 'object', 'required': [ 'setting_name' ], 'properties': {
+                    'setting_name': { 'type': 'string' },
+                    'setting_values': { 'type': 'array', 'items': { 'type': 'object', 'properties': {
+                        'setting_synonym': { 'type': 'array', 'items': { 'type': 'string' } },
+                        'lang': { 'type': 'string' },
+                    } } },
+                } } },
+                'ordered': { 'type': 'boolean' },
+            } } },
+        },
+        'states': {
+            'currentModeSettings': { 'type': 'object' },
+            ## command params, stored as the states by index.js and executor.py
+            'updateModeSettings': { 'type': 'object' },
+        }
     },
     'OnOff': {
         'description': '''The basic on and off functionality for any device that has binary on and off, including plugs and switches as well as many future devices.''',
         'language': [ 'en', 'de', 'fr', 'ja', 'it' ],
         'commands': [
             'OnOff'
-        ]
+        ],
+        'attributes': {
+            'commandOnlyOnOff': { 'type': 'boolean' },
+            'queryOnlyOnOff': { 'type': 'boolean' },
+        },
+        'states': {
+            'on': { 'type': 'boolean' },
+        }
     },
     'RunCycle': {
         'description': '''This trait represents any device that has an ongoing duration for its operation which can be queried. This includes, but is not limited to, devices that operate cyclically, such as washing machines, dryers, and dishwashers.''',
         'language': [ 'en', 'de', 'fr', 'ja' ],
-        'commands': []
+        'commands': [],
+        'attributes': {},
+        'states': {
+            'currentRunCycle': { 'type': 'array', 'items': { 'type': 'object', 'properties': {
+                'currentCycle': { 'type': 'string' },
+                'nextCycle': { 'type': 'string' },
+                'lang': { 'type': 'string' },
+            } } },
+            'currentTotalRemainingTime': { 'type': 'integer', 'minimum': 0 },
+            'currentCycleRemainingTime': { 'type': 'integer', 'minimum': 0 },
+        }
     },
     'Scene': {
         'description': '''In the case of scenes, the type maps 1': {1 to the trait, as scenes don't combine with other traits to form composite devices.''',
         'language': [ 'en', 'de', 'fr', 'ja' ],
         'commands': [
             'ActivateScene'
-        ]
+        ],
+        'attributes': {
+            'sceneReversible': { 'type': 'boolean' },
+        },
+        'states': {
+            ## command params, stored as the states by index.js and executor.py
+            'deactivate': { 'type': 'boolean' },
+        }
     },
     'StartStop': {
         'description': '''Starting and stopping a device serves a similar function to turning it on and off. Devices that inherit this trait function differently when turned on and when started. Unlike devices that simply have an on and off state, some devices that can start and stop are also able to pause while performing operation.''',
@@ -92,14 +222,40 @@ DEVICE_TRAITS = {
         'commands': [
             'StartStop',
             'PauseUnpause'
-        ]
+        ],
+        'attributes': {
+            'pausable': { 'type': 'boolean' },
+        },
+        'states': {
+            'isRunning': { 'type': 'boolean' },
+            'isPaused': { 'type': 'boolean' },
+            ## command params, stored as the states by index.js and executor.py
+            'start': { 'type': 'boolean' },
+            'pause': { 'type': 'boolean' },
+        }
     },
     'TemperatureControl': {
         'description': '''Trait for devices (other than thermostats) that support controlling temperature, either within or around the device. This includes devices such as ovens and refrigerators.''',
         'language': [ 'en', 'de', 'fr', 'ja' ],
         'commands': [
             'SetTemperature'
-        ]
+        ],
+        'attributes': {
+            'temperatureRange': { 'type': 'object', 'required': [ 'minThresholdCelsius', 'maxThresholdCelsius' ], 'properties': {
+                'minThresholdCelsius': { 'type': 'number' },
+                'maxThresholdCelsius': { 'type': 'number' },
+            } },
+            'temperatureStepCelsius': { 'type': 'number', 'minimum': 0 },
+            'temperatureUnitForUX': { 'enum': [ 'C', 'F' ] },
+            'commandOnlyTemperatureControl': { 'type': 'boolean' },
+            'queryOnlyTemperatureControl': { 'type': 'boolean' },
+        },
+        'states': {
+            'temperatureSetpointCelsius': { 'type': 'number' },
+            'temperatureAmbientCelsius': { 'type': 'number' },
+            ## command params, stored as the states by index.js and executor.py
+            'temperature': { 'type': 'number' },
+        }
     },
     'TemperatureSetting': {
         'description': '''This trait covers handling both temperature point and modes.''',
@@ -108,17 +264,53 @@ DEVICE_TRAITS = {
             'ThermostatTemperatureSetpoint',
             'ThermostatTemperatureSetRange',
             'ThermostatSetMode'
-        ]
+        ],
+        'attributes': {
+            ## a comma separated string in the first versions of the trait
+            'availableThermostatModes': { 'anyOf': [
+                { 'type': 'string' },
+                { 'type': 'array', 'items': { 'enum': THERMOSTAT_MODES } },
+            ] },
+            'thermostatTemperatureUnit': { 'enum': [ 'C', 'F' ] },
+            'bufferRangeCelsius': { 'type': 'number', 'minimum': 0 },
+            'commandOnlyTemperatureSetting': { 'type': 'boolean' },
+            'queryOnlyTemperatureSetting': { 'type': 'boolean' },
+        },
+        'states': {
+            'thermostatMode': { 'enum': THERMOSTAT_MODES },
+            'thermostatTemperatureSetpoint': { 'type': 'number' },
+            'thermostatTemperatureAmbient': { 'type': 'number' },
+            'thermostatTemperatureSetpointHigh': { 'type': 'number' },
+            'thermostatTemperatureSetpointLow': { 'type': 'number' },
+            'thermostatHumidityAmbient': { 'type': 'number', 'minimum': 0, 'maximum': 100 },
+        }
     },
     'Toggles': {
         'description': '''This trait belongs to any devices with settings that can only exist in one of two states. These settings can represent a physical button with an on/off or active/inactive state, a checkbox in HTML, or any other sort of specifically enabled/disabled element.''',
         'language': [ 'en', 'de', 'fr', 'ja' ],
         'commands': [
             'SetToggles'
-        ]
+        ],
+        'attributes': {
+            'availableToggles': { 'type': 'array', 'items': { 'type': 'object', 'required': [ 'name' ], 'properties': {
+                'name': { 'type': 'string' },
+                'name_values': { 'type': 'array', 'items': { 'type': 'object', 'properties': {
+                    'name_synonym': { 'type': 'array', 'items': { 'type': 'string' } },
+                    'lang': { 'type': 'string' },
+                } } },
+            } } },
+            'commandOnlyToggles': { 'type': 'boolean' },
+        },
+        'states': {
+            'currentToggleSettings': { 'type': 'object' },
+            ## command params, stored as the states by index.js and executor.py
+            'updateToggleSettings': { 'type': 'object' },
+        }
     },
 }
 
+DEVICE_COMMANDS = sorted(set(x for v in DEVICE_TRAITS.values() for x in v['commands']))
+
 # List Device Types, see https://developers.google.com/actions/smarthome/guides/
 DEVICE_TYPES_PREFIX = 'action.devices.types.'
 DEVICE_TYPES = {
@@ -175,30 +367,1026 @@ DEVICE_TYPES = {
     }
 }
 
+class RequestSyncDispatcher(object):
+    ## sends requestSync over pooled keep-alive connections, duplicate
+    ## agent_user_id within the debounce window are sent only once
+    endpoint = '/v1/devices:requestSync'
+    operation = 'requestSync'
+    def __init__(self, baseUrl, apikey, maxWorkers=4, debounce=0.5, timeout=10):
+        url = urllib.parse.urlsplit(baseUrl)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/') + self.endpoint + '?key=' + urllib.parse.quote(apikey or '')
+        self.debounce = debounce
+        self.timeout = timeout
+        self.connections = queue.LifoQueue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+        self.futures = []
+        self.requested = 0
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self.profiler = None
+    def _new_connection(self):
+        import http.client
+        connectionClass = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return connectionClass(self.netloc, timeout=self.timeout)
+    def _connection(self):
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+    def _payload(self, agent_user_id):
+        ## called by flush() with the lock held
+        return { 'agent_user_id' : agent_user_id }
+    def _send(self, agent_user_id, payload):
+        import http.client
+        headers = { 'Content-Type': 'application/json' }
+        data = json.dumps(payload).encode()
+        conn = self._connection()
+        start = time.perf_counter()
+        try:
+            try:
+                conn.request('POST', self.path, body=data, headers=headers)
+                res = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                ## the server closed the idle keep-alive connection, retry once
+                conn.close()
+                conn = self._new_connection()
+                conn.request('POST', self.path, body=data, headers=headers)
+                res = conn.getresponse()
+            res.read()
+        except:
+            (t, e) = sys.exc_info()[:2]
+            conn.close()
+            if self.profiler:
+                self.profiler.record('http.' + self.operation, time.perf_counter() - start, rpcs=0, http=1)
+            with self.lock:
+                self.sent += 1
+                self.failed += 1
+            sys.stderr.write("{} {} failed: {}\n".format(self.operation, agent_user_id, e))
+            return None
+        if self.profiler:
+            self.profiler.record('http.' + self.operation, time.perf_counter() - start, rpcs=0, http=1)
+        self.connections.put(conn)
+        with self.lock:
+            self.sent += 1
+            if res.status >= 300:
+                self.failed += 1
+        if res.status >= 300:
+            sys.stderr.write("{} {} failed: {} {}\n".format(self.operation, agent_user_id, res.status, res.reason))
+        return res.status, res.reason
+    def submit(self, agent_user_id):
+        with self.lock:
+            self.requested += 1
+            if agent_user_id in self.pending:
+                self.merged += 1
+                return
+            self.pending.append(agent_user_id)
+            if self.timer is None:
+                self.timer = threading.Timer(self.debounce, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+    def flush(self):
+        with self.lock:
+            agent_user_ids, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            for agent_user_id in agent_user_ids:
+                self.futures.append(self.executor.submit(self._send, agent_user_id, self._payload(agent_user_id)))
+    def close(self):
+        self.flush()
+        with self.lock:
+            futures, self.futures = self.futures, []
+        concurrent.futures.wait(futures)
+        self.executor.shutdown()
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
+        if self.requested:
+            sys.stderr.write("{}: {} requested, {} sent, {} merged, {} failed\n".format(self.operation, self.requested, self.sent, self.merged, self.failed))
+
+class ReportStatePublisher(RequestSyncDispatcher):
+    ## state updates are merged per agentUserId within the debounce window
+    ## and sent as one multi-device reportStateAndNotification call
+    endpoint = '/v1/devices:reportStateAndNotification'
+    operation = 'reportState'
+    def __init__(self, baseUrl, apikey, maxWorkers=4, debounce=0.5, timeout=10):
+        RequestSyncDispatcher.__init__(self, baseUrl, apikey, maxWorkers, debounce, timeout)
+        ## agent_user_id -> {device_id: state}
+        self.states = {}
+    def report(self, agent_user_id, device_id, state):
+        with self.lock:
+            self._merge(self.states.setdefault(agent_user_id, {}).setdefault(device_id, {}), state)
+        self.submit(agent_user_id)
+    def _merge(self, target, state):
+        ## nested changes of the same object within the window are kept together
+        for k, v in state.items():
+            if isinstance(v, dict) and isinstance(target.get(k), dict):
+                self._merge(target[k], v)
+            else:
+                target[k] = v
+    def _payload(self, agent_user_id):
+        return {
+            'requestId': '{}-{}'.format(agent_user_id, time.time_ns()),
+            'agentUserId': agent_user_id,
+            'payload': { 'devices': { 'states': self.states.pop(agent_user_id, {}) } },
+        }
+
+class AsyncEngine(object):
+    ## reads on the backend's async Firestore client in a background event
+    ## loop, independent lookups are in flight together under a semaphore
+    def __init__(self, backend, concurrency=16, chunkSize=100):
+        self.backend = backend
+        self.concurrency = concurrency
+        self.chunkSize = chunkSize
+        self.profiler = None
+        self.loop = None
+        self.thread = None
+        self._client = None
+        self._semaphore = None
+    def _start(self):
+        import asyncio
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+        return self.loop
+    def _async_client(self):
+        ## created inside the loop, the grpc channel is bound to it
+        import asyncio
+        if self._client is None:
+            self._client = self.backend.async_client()
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._client
+    async def _get_chunk(self, paths):
+        client = self._async_client()
+        references = [ client.document(path) for path in paths ]
+        async with self._semaphore:
+            start = time.perf_counter()
+            snapshots = [ docsnap async for docsnap in client.get_all(references) ]
+            if self.profiler:
+                self.profiler.record('async.get_all', time.perf_counter() - start, reads=len(paths))
+        return snapshots
+    async def _get_all(self, paths):
+        import asyncio
+        chunks = await asyncio.gather(*[ self._get_chunk(paths[i:i + self.chunkSize]) for i in range(0, len(paths), self.chunkSize) ])
+        return [ docsnap for chunk in chunks for docsnap in chunk ]
+    def submit(self, coroutine):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(coroutine, self._start())
+    def submit_get_all(self, references):
+        ## concurrent.futures.Future of the snapshots, in no particular order
+        return self.submit(self._get_all([ reference.path for reference in references ]))
+    def get_all(self, references):
+        return self.submit_get_all(references).result()
+    def close(self):
+        if self.loop is None:
+            return
+        if self._client is not None:
+            self.loop.call_soon_threadsafe(self._client.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        self._client = None
+
+class DocumentCache(object):
+    ## persistent LRU cache of documents in a SQLite file. Entries are
+    ## trusted for `ttl` seconds after they were read, or as long as an
+    ## on_snapshot listener of their collection runs (shell)
+    cachedCollections = ('devices', 'remotes', 'users', 'groups', 'user_devices', 'group_devices', 'ircode_blobs')
+    def __init__(self, filename, maxSize=10000, ttl=300):
+        self.filename = filename
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.entries = None
+        self.removed = set()
+        self.listened = set()
+        self.watches = []
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.reported = (0, 0)
+    def _load(self):
+        import sqlite3
+        import collections
+        self.entries = collections.OrderedDict()
+        if not os.path.exists(self.filename):
+            return
+        db = sqlite3.connect(self.filename)
+        try:
+            for path, data, update_time, cached_at in db.execute('SELECT path, data, update_time, cached_at FROM documents ORDER BY last_used'):
+                self.entries[path] = (data, update_time, cached_at)
+        finally:
+            db.close()
+        while len(self.entries) > self.maxSize:
+            evicted, _ = self.entries.popitem(last=False)
+            self.removed.add(evicted)
+            self.evicted += 1
+    def _entries(self):
+        if self.entries is None:
+            self._load()
+        return self.entries
+    def cacheable(self, path):
+        return path.rsplit('/', 1)[0] in self.cachedCollections
+    def lookup(self, reference, document):
+        ## snapshot of the cached document, None when it has to be read,
+        ## document: path -> DocumentReference for the cached references
+        import snapshot
+        path = reference.path
+        if not self.cacheable(path):
+            return None
+        with self.lock:
+            entry = self._entries().get(path)
+            fresh = entry is not None and (path.rsplit('/', 1)[0] in self.listened or time.time() - entry[2] < self.ttl)
+            if not fresh:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+        return snapshot.DocumentSnapshot(reference, snapshot.decode(json.loads(entry[0]), document), entry[1])
+    def store(self, docsnap, is_reference):
+        import snapshot
+        path = docsnap.reference.path
+        if not self.cacheable(path):
+            return
+        if not docsnap.exists:
+            self.invalidate(path)
+            return
+        data = json.dumps(snapshot.encode(docsnap.to_dict(), is_reference), ensure_ascii=False, separators=(',', ':'))
+        update_time = docsnap.update_time.isoformat() if getattr(docsnap, 'update_time', None) else None
+        with self.lock:
+            entries = self._entries()
+            entries[path] = (data, update_time, time.time())
+            entries.move_to_end(path)
+            self.removed.discard(path)
+            while len(entries) > self.maxSize:
+                evicted, _ = entries.popitem(last=False)
+                self.removed.add(evicted)
+                self.evicted += 1
+    def invalidate(self, path):
+        with self.lock:
+            if self._entries().pop(path, None) is not None:
+                self.removed.add(path)
+    def listen(self, client, is_reference):
+        ## keep the cached documents current while the process runs, only
+        ## documents already in the cache are updated
+        def on_snapshot(docsnaps, changes, read_time):
+            for change in changes:
+                path = change.document.reference.path
+                ## called on the listener's thread, while commands use the cache
+                with self.lock:
+                    if change.type.name == 'REMOVED':
+                        self.invalidate(path)
+                    elif path in self._entries():
+                        self.store(change.document, is_reference)
+        for collection in self.cachedCollections:
+            self.watches.append(client.collection(collection).on_snapshot(on_snapshot))
+            self.listened.add(collection)
+    def counters(self):
+        ## hits and misses since the previous call
+        with self.lock:
+            hits, misses = self.hits - self.reported[0], self.misses - self.reported[1]
+            self.reported = (self.hits, self.misses)
+        return hits, misses
+    def close(self):
+        import sqlite3
+        for watch in self.watches:
+            watch.unsubscribe()
+        self.watches = []
+        self.listened = set()
+        if self.entries is None:
+            return
+        db = sqlite3.connect(self.filename)
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY, data TEXT NOT NULL, update_time TEXT, cached_at REAL, last_used INTEGER)')
+            with self.lock:
+                db.executemany('DELETE FROM documents WHERE path = ?', [ (path,) for path in self.removed ])
+                db.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)',
+                    [ (path, data, update_time, cached_at, i) for i, (path, (data, update_time, cached_at)) in enumerate(self.entries.items()) ])
+                self.removed = set()
+            db.commit()
+        finally:
+            db.close()
+        if self.hits or self.misses:
+            sys.stderr.write("cache: {} hits, {} misses, {} evicted, {} entries\n".format(self.hits, self.misses, self.evicted, len(self.entries)))
+
+class Profiler(object):
+    ## Firestore prices in USD per 100,000 operations, adjust for the project location
+    readPrice = 0.06
+    writePrice = 0.18
+    deletePrice = 0.02
+    histogramBuckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+    counterNames = ('calls', 'rpcs', 'reads', 'writes', 'deletes', 'http')
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+    def record(self, operation, elapsed, reads=0, writes=0, deletes=0, rpcs=1, http=0):
+        with self.lock:
+            op = self.operations.setdefault(operation, dict({ k: 0 for k in self.counterNames }, latencies=[]))
+            op['calls'] += 1
+            op['rpcs'] += rpcs
+            op['reads'] += reads
+            op['writes'] += writes
+            op['deletes'] += deletes
+            op['http'] += http
+            op['latencies'].append(elapsed * 1000)
+    def histogram(self, latencies):
+        histogram = {}
+        for latency in latencies:
+            bucket = next((b for b in self.histogramBuckets if latency <= b), None)
+            key = '<={}'.format(bucket) if bucket else '>{}'.format(self.histogramBuckets[-1])
+            histogram[key] = histogram.get(key, 0) + 1
+        return histogram
+    def summary(self):
+        operations = {}
+        totals = { k: 0 for k in self.counterNames }
+        with self.lock:
+            for name, op in sorted(self.operations.items()):
+                latencies = sorted(op['latencies'])
+                operations[name] = { k: op[k] for k in self.counterNames }
+                operations[name]['latency_ms'] = {
+                    'total': round(sum(latencies), 3),
+                    'p50': round(latencies[len(latencies) // 2], 3),
+                    'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                    'max': round(latencies[-1], 3),
+                }
+                operations[name]['histogram_ms'] = self.histogram(latencies)
+                for k in self.counterNames:
+                    totals[k] += op[k]
+        cost = (totals['reads'] * self.readPrice + totals['writes'] * self.writePrice + totals['deletes'] * self.deletePrice) / 100000
+        return { 'operations': operations, 'totals': totals, 'estimated_cost_usd': round(cost, 8) }
+    def report(self, output_format='text', stream=None):
+        stream = stream or sys.stderr
+        summary = self.summary()
+        if output_format == 'json':
+            stream.write(json.dumps(summary, indent=2, sort_keys=True) + "\n")
+            return
+        stream.write("{:<24} {:>6} {:>6} {:>7} {:>7} {:>7} {:>5} {:>9} {:>9} {:>9}\n".format(
+            'operation', 'calls', 'rpcs', 'reads', 'writes', 'deletes', 'http', 'p50(ms)', 'p95(ms)', 'max(ms)'))
+        for name, op in summary['operations'].items():
+            stream.write("{:<24} {calls:>6} {rpcs:>6} {reads:>7} {writes:>7} {deletes:>7} {http:>5} {p50:>9.1f} {p95:>9.1f} {max:>9.1f}\n".format(
+                name, **{ k: op[k] for k in self.counterNames }, **op['latency_ms']))
+            stream.write("{:<24} {}\n".format('', '  '.join('{}:{}'.format(k, v) for k, v in op['histogram_ms'].items())))
+        totals = summary['totals']
+        stream.write("{:<24} {calls:>6} {rpcs:>6} {reads:>7} {writes:>7} {deletes:>7} {http:>5}\n".format('total', **totals))
+        stream.write("estimated cost: ${:.6f}\n".format(summary['estimated_cost_usd']))
+        single_gets = summary['operations'].get('document.get', {}).get('calls', 0)
+        if single_gets > 10:
+            stream.write("note: {} single document gets, check for N+1 reads\n".format(single_gets))
+
+def _unwrap(value):
+    if isinstance(value, (_Profiled, _Governed)):
+        return _unwrap(value._wrapped)
+    if isinstance(value, dict):
+        return { k: _unwrap(v) for k, v in value.items() }
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(v) for v in value)
+    return value
+
+class _Profiled(object):
+    ## forwards everything to the wrapped Firestore object, counting RPCs
+    def __init__(self, wrapped, profiler):
+        self._wrapped_object = wrapped
+        self._profiler = profiler
+    @property
+    def _wrapped(self):
+        return self._wrapped_object
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+    def _call(self, operation, method, *args, counts=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*_unwrap(args), **_unwrap(kwargs))
+        finally:
+            self._profiler.record(operation, time.perf_counter() - start, **(counts or {}))
+    def _iterate(self, operation, iterable):
+        start = time.perf_counter()
+        count = 0
+        try:
+            for item in iterable:
+                count += 1
+                yield item
+        finally:
+            ## an empty query is still billed one read
+            self._profiler.record(operation, time.perf_counter() - start, reads=max(1, count))
+
+class ProfiledQuery(_Profiled):
+    def _query(self, method, *args, **kwargs):
+        return ProfiledQuery(method(*_unwrap(args), **_unwrap(kwargs)), self._profiler)
+    def where(self, *args, **kwargs):
+        return self._query(self._wrapped.where, *args, **kwargs)
+    def select(self, *args, **kwargs):
+        return self._query(self._wrapped.select, *args, **kwargs)
+    def order_by(self, *args, **kwargs):
+        return self._query(self._wrapped.order_by, *args, **kwargs)
+    def limit(self, *args, **kwargs):
+        return self._query(self._wrapped.limit, *args, **kwargs)
+    def start_at(self, *args, **kwargs):
+        return self._query(self._wrapped.start_at, *args, **kwargs)
+    def start_after(self, *args, **kwargs):
+        return self._query(self._wrapped.start_after, *args, **kwargs)
+    def end_at(self, *args, **kwargs):
+        return self._query(self._wrapped.end_at, *args, **kwargs)
+    def end_before(self, *args, **kwargs):
+        return self._query(self._wrapped.end_before, *args, **kwargs)
+    def document(self, *args, **kwargs):
+        return ProfiledDocument(self._wrapped.document(*args, **kwargs), self._profiler)
+    def add(self, *args, **kwargs):
+        update_time, docref = self._call('collection.add', self._wrapped.add, *args, counts={ 'writes': 1 }, **kwargs)
+        return update_time, ProfiledDocument(docref, self._profiler)
+    def stream(self, *args, **kwargs):
+        return self._iterate('query.stream', self._wrapped.stream(*args, **kwargs))
+    def get(self, *args, **kwargs):
+        return list(self._iterate('query.get', self._wrapped.stream(*args, **kwargs)))
+
+class ProfiledDocument(_Profiled):
+    def collection(self, *args, **kwargs):
+        return ProfiledQuery(self._wrapped.collection(*args, **kwargs), self._profiler)
+    def get(self, *args, **kwargs):
+        return self._call('document.get', self._wrapped.get, *args, counts={ 'reads': 1 }, **kwargs)
+    def create(self, *args, **kwargs):
+        return self._call('document.create', self._wrapped.create, *args, counts={ 'writes': 1 }, **kwargs)
+    def set(self, *args, **kwargs):
+        return self._call('document.set', self._wrapped.set, *args, counts={ 'writes': 1 }, **kwargs)
+    def update(self, *args, **kwargs):
+        return self._call('document.update', self._wrapped.update, *args, counts={ 'writes': 1 }, **kwargs)
+    def delete(self, *args, **kwargs):
+        return self._call('document.delete', self._wrapped.delete, *args, counts={ 'deletes': 1 }, **kwargs)
+
+class ProfiledWriteBatch(_Profiled):
+    operation = 'batch.commit'
+    def __init__(self, wrapped, profiler):
+        _Profiled.__init__(self, wrapped, profiler)
+        self._writes = 0
+        self._deletes = 0
+    def __len__(self):
+        return len(self._wrapped)
+    def create(self, reference, *args, **kwargs):
+        self._writes += 1
+        return self._wrapped.create(_unwrap(reference), *_unwrap(args), **_unwrap(kwargs))
+    def set(self, reference, *args, **kwargs):
+        self._writes += 1
+        return self._wrapped.set(_unwrap(reference), *_unwrap(args), **_unwrap(kwargs))
+    def update(self, reference, *args, **kwargs):
+        self._writes += 1
+        return self._wrapped.update(_unwrap(reference), *_unwrap(args), **_unwrap(kwargs))
+    def delete(self, reference, *args, **kwargs):
+        self._deletes += 1
+        return self._wrapped.delete(_unwrap(reference), *args, **kwargs)
+    def _flush(self, method, rpcs):
+        writes, deletes = self._writes, self._deletes
+        self._writes = self._deletes = 0
+        return self._call(self.operation, method, counts={ 'writes': writes, 'deletes': deletes, 'rpcs': rpcs })
+    def commit(self, *args, **kwargs):
+        return self._flush(self._wrapped.commit, 1)
+
+class ProfiledBulkWriter(ProfiledWriteBatch):
+    operation = 'bulk_writer.flush'
+    ## the BulkWriter sends batches of up to 20 writes
+    bulkBatchSize = 20
+    def _rpcs(self):
+        return -(-(self._writes + self._deletes) // self.bulkBatchSize)
+    def flush(self):
+        return self._flush(self._wrapped.flush, self._rpcs())
+    def close(self):
+        return self._flush(self._wrapped.close, self._rpcs())
+
+class ProfiledClient(_Profiled):
+    ## the client is created on first use, like BaseCollection.client
+    @property
+    def _wrapped(self):
+        if self._wrapped_object is None:
+            self._wrapped_object = get_client()
+        return self._wrapped_object
+    def collection(self, *args, **kwargs):
+        return ProfiledQuery(self._wrapped.collection(*args, **kwargs), self._profiler)
+    def document(self, *args, **kwargs):
+        return ProfiledDocument(self._wrapped.document(*args, **kwargs), self._profiler)
+    def get_all(self, references, *args, **kwargs):
+        references = _unwrap(list(references))
+        start = time.perf_counter()
+        try:
+            return list(self._wrapped.get_all(references, *args, **kwargs))
+        finally:
+            self._profiler.record('client.get_all', time.perf_counter() - start, reads=len(references))
+    def batch(self):
+        return ProfiledWriteBatch(self._wrapped.batch(), self._profiler)
+    def bulk_writer(self, *args, **kwargs):
+        return ProfiledBulkWriter(self._wrapped.bulk_writer(*args, **kwargs), self._profiler)
+
+class WriteGovernor(object):
+    ## shared by every write of a run (see GovernedClient): a token bucket
+    ## that starts at initialRate writes per second and grows by half every
+    ## rampUpInterval (the 500/50/5 rule), at most one commit per
+    ## documentInterval to the same document, and exponential backoff on
+    ## RESOURCE_EXHAUSTED / ABORTED, halving the rate on RESOURCE_EXHAUSTED
+    initialRate = 500
+    rampUpFactor = 1.5
+    rampUpInterval = 300
+    minRate = 1
+    documentInterval = 1.0
+    maxRetries = 8
+    backoffBase = 0.5
+    backoffMax = 30.0
+    ## older document times are dropped when there are more than this
+    documentTimesSize = 10000
+    throttleErrors = ('ResourceExhausted', 'TooManyRequests')
+    retryableErrors = throttleErrors + ('Aborted',)
+    def __init__(self, rate=None, maxRate=None, documentInterval=None):
+        ## rate 0 disables the token bucket, documentInterval 0 the per document limit
+        self.rate = float(self.initialRate if rate is None else rate)
+        self.maxRate = maxRate
+        if documentInterval is not None:
+            self.documentInterval = documentInterval
+        self.lock = threading.Lock()
+        self.tokens = self.rate
+        self.updated = None
+        self.rampStart = None
+        self.documentTimes = {}
+        self.writes = 0
+        self.commits = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.waited = 0.0
+        self._deleteField = None
+    def delete_field(self):
+        if self._deleteField is None:
+            self._deleteField = get_backend().delete_field()
+        return self._deleteField
+    def _refill(self, now):
+        if self.updated is None:
+            self.updated = self.rampStart = now
+        while now - self.rampStart >= self.rampUpInterval:
+            self.rampStart += self.rampUpInterval
+            self.rate *= self.rampUpFactor
+            if self.maxRate:
+                self.rate = min(self.rate, self.maxRate)
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    def acquire(self, count, paths=()):
+        ## reserves count writes, sleeps until the bucket and the documents allow them
+        now = time.monotonic()
+        wait = 0.0
+        with self.lock:
+            if self.rate:
+                self._refill(now)
+                self.tokens -= count
+                if self.tokens < 0:
+                    wait = -self.tokens / self.rate
+            if self.documentInterval:
+                if len(self.documentTimes) > self.documentTimesSize:
+                    self.documentTimes = { p: t for p, t in self.documentTimes.items() if t > now - self.documentInterval }
+                for path in paths:
+                    wait = max(wait, self.documentTimes.get(path, float('-inf')) + self.documentInterval - now)
+                for path in paths:
+                    self.documentTimes[path] = now + wait
+            self.writes += count
+            self.commits += 1
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+    def backoff(self, error, attempt, paths=()):
+        delay = min(self.backoffMax, self.backoffBase * 2 ** attempt) * random.uniform(0.5, 1.0)
+        with self.lock:
+            self.retries += 1
+            self.waited += delay
+            if self.rate and type(error).__name__ in self.throttleErrors:
+                self.rate = max(self.minRate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+                self.rampStart = time.monotonic()
+            ## the retry waits out the documents' interval again
+            for path in paths:
+                self.documentTimes.pop(path, None)
+        sys.stderr.write("write failed ({}), retry in {:.1f}s\n".format(type(error).__name__, delay))
+        time.sleep(delay)
+    def run(self, method, count=1, paths=()):
+        ## method() sends one commit of count writes to paths
+        attempt = 0
+        while True:
+            self.acquire(count, paths)
+            try:
+                return method()
+            except Exception as e:
+                if type(e).__name__ not in self.retryableErrors or attempt >= self.maxRetries:
+                    raise
+                self.backoff(e, attempt, paths)
+                attempt += 1
+    def close(self):
+        if self.retries or self.coalesced or self.waited >= 1:
+            sys.stderr.write("writes: {} in {} commits, {} coalesced, {} retries, waited {:.1f}s, {:.0f} writes/s\n".format(
+                self.writes, self.commits, self.coalesced, self.retries, self.waited, self.rate))
+
+def _merge_fields(docdata, fields, delete, full):
+    ## docdata after set(fields, merge=True), full when docdata is the whole document
+    merged = dict(docdata)
+    for k, v in fields.items():
+        if v is delete and full:
+            merged.pop(k, None)
+        elif isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = _merge_fields(merged[k], v, delete, full)
+        elif isinstance(v, dict) and merged.get(k) is delete:
+            ## the map is deleted first, one merge would keep its other fields
+            raise ValueError(k)
+        else:
+            merged[k] = v
+    return merged
+
+def _update_fields(docdata, field_updates, delete):
+    ## docdata after update(field_updates)
+    docdata = dict(docdata)
+    for field_path, value in field_updates.items():
+        keys = field_path.split('.')
+        target = docdata
+        for key in keys[:-1]:
+            child = target.get(key)
+            if value is delete and not isinstance(child, dict):
+                target = None
+                break
+            target[key] = dict(child) if isinstance(child, dict) else {}
+            target = target[key]
+        if target is None:
+            continue
+        if value is delete:
+            target.pop(keys[-1], None)
+        else:
+            target[keys[-1]] = value
+    return docdata
+
+def _coalesce(previous, current, delete):
+    ## one (op, data, merge) with the effect of previous then current in the
+    ## same commit, None when they have to stay two writes
+    prevOp, prevData, prevMerge = previous
+    op, data, merge = current
+    ## create and update fail on (non-)existence, keep their errors
+    if 'create' in (prevOp, op) or (prevOp == 'update' and op != 'update'):
+        return None
+    if op == 'delete' or (op == 'set' and not merge):
+        return current
+    try:
+        if prevOp == 'delete':
+            return ('set', _merge_fields({}, data, delete, True), False) if op == 'set' else None
+        if op == 'set':
+            return (prevOp, _merge_fields(prevData, data, delete, not prevMerge), prevMerge)
+        if prevOp == 'update':
+            keys = set(prevData) | set(data)
+            if any(a != b and b.startswith(a + '.') for a in keys for b in keys):
+                return None
+            return ('update', dict(prevData, **data), False)
+        if not prevMerge:
+            return ('set', _update_fields(prevData, data, delete), False)
+    except ValueError:
+        pass
+    return None
+
+class _Governed(object):
+    ## forwards everything to the wrapped Firestore object, writes wait for the governor
+    def __init__(self, wrapped, governor):
+        self._wrapped_object = wrapped
+        self._governor = governor
+    @property
+    def _wrapped(self):
+        return self._wrapped_object
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+    def _write(self, method, *args, **kwargs):
+        return self._governor.run(lambda: method(*_unwrap(args), **_unwrap(kwargs)), 1, [ self._wrapped.path ])
+
+class GovernedCollection(_Governed):
+    ## queries only read, they are made on the wrapped collection
+    def _query(self, method, *args, **kwargs):
+        return method(*_unwrap(args), **_unwrap(kwargs))
+    def where(self, *args, **kwargs):
+        return self._query(self._wrapped.where, *args, **kwargs)
+    def select(self, *args, **kwargs):
+        return self._query(self._wrapped.select, *args, **kwargs)
+    def order_by(self, *args, **kwargs):
+        return self._query(self._wrapped.order_by, *args, **kwargs)
+    def limit(self, *args, **kwargs):
+        return self._query(self._wrapped.limit, *args, **kwargs)
+    def start_at(self, *args, **kwargs):
+        return self._query(self._wrapped.start_at, *args, **kwargs)
+    def start_after(self, *args, **kwargs):
+        return self._query(self._wrapped.start_after, *args, **kwargs)
+    def end_at(self, *args, **kwargs):
+        return self._query(self._wrapped.end_at, *args, **kwargs)
+    def end_before(self, *args, **kwargs):
+        return self._query(self._wrapped.end_before, *args, **kwargs)
+    def document(self, *args, **kwargs):
+        return GovernedDocument(self._wrapped.document(*args, **kwargs), self._governor)
+    def add(self, *args, **kwargs):
+        ## the id is made by the client, there is no document to wait for
+        update_time, docref = self._governor.run(lambda: self._wrapped.add(*_unwrap(args), **_unwrap(kwargs)))
+        return update_time, GovernedDocument(docref, self._governor)
+
+class GovernedDocument(_Governed):
+    def collection(self, *args, **kwargs):
+        return GovernedCollection(self._wrapped.collection(*args, **kwargs), self._governor)
+    def create(self, *args, **kwargs):
+        return self._write(self._wrapped.create, *args, **kwargs)
+    def set(self, *args, **kwargs):
+        return self._write(self._wrapped.set, *args, **kwargs)
+    def update(self, *args, **kwargs):
+        return self._write(self._wrapped.update, *args, **kwargs)
+    def delete(self, *args, **kwargs):
+        return self._write(self._wrapped.delete, *args, **kwargs)
+
+class GovernedWriteBatch(object):
+    ## keeps the writes, coalesced per document, and replays them into a
+    ## new batch of the client on every attempt of the commit
+    def __init__(self, client, governor):
+        self._client = client
+        self._governor = governor
+        self._writes = []
+        self._positions = {}
+    def __len__(self):
+        return len(self._writes)
+    def _add(self, reference, op, data=None, merge=False):
+        reference = _unwrap(reference)
+        write = (op, _unwrap(data), merge)
+        position = self._positions.get(reference.path)
+        if position is not None:
+            coalesced = _coalesce(self._writes[position][1:], write, self._governor.delete_field())
+            if coalesced is not None:
+                self._writes[position] = (reference,) + coalesced
+                with self._governor.lock:
+                    self._governor.coalesced += 1
+                return
+        self._positions[reference.path] = len(self._writes)
+        self._writes.append((reference,) + write)
+    def create(self, reference, document_data):
+        self._add(reference, 'create', document_data)
+    def set(self, reference, document_data, merge=False):
+        self._add(reference, 'set', document_data, merge)
+    def update(self, reference, field_updates):
+        self._add(reference, 'update', field_updates)
+    def delete(self, reference):
+        self._add(reference, 'delete')
+    def _take(self):
+        writes, self._writes, self._positions = self._writes, [], {}
+        return writes
+    def _replay(self, writer, writes):
+        for reference, op, data, merge in writes:
+            if op == 'delete':
+                writer.delete(reference)
+            elif op == 'set':
+                writer.set(reference, data, merge=merge)
+            else:
+                getattr(writer, op)(reference, data)
+    def commit(self):
+        writes = self._take()
+        def commit():
+            batch = self._client.batch()
+            self._replay(batch, writes)
+            return batch.commit()
+        return self._governor.run(commit, len(writes), [ reference.path for reference, _, _, _ in writes ])
+
+class GovernedBulkWriter(GovernedWriteBatch):
+    ## the BulkWriter retries failed writes by itself, the governor paces
+    ## the batches of up to 20 writes handed to it
+    bulkBatchSize = 20
+    def __init__(self, writer, governor):
+        GovernedWriteBatch.__init__(self, None, governor)
+        self._writer = writer
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+    def _release(self):
+        writes = self._take()
+        for i in range(0, len(writes), self.bulkBatchSize):
+            chunk = writes[i:i + self.bulkBatchSize]
+            self._governor.acquire(len(chunk), [ reference.path for reference, _, _, _ in chunk ])
+            self._replay(self._writer, chunk)
+    def flush(self):
+        self._release()
+        return self._writer.flush()
+    def close(self):
+        self._release()
+        return self._writer.close()
+
+class GovernedClient(_Governed):
+    ## the client is created on first use, like BaseCollection.client
+    @property
+    def _wrapped(self):
+        if self._wrapped_object is None:
+            self._wrapped_object = get_client()
+        return self._wrapped_object
+    def collection(self, *args, **kwargs):
+        return GovernedCollection(self._wrapped.collection(*args, **kwargs), self._governor)
+    def document(self, *args, **kwargs):
+        return GovernedDocument(self._wrapped.document(*args, **kwargs), self._governor)
+    def batch(self):
+        return GovernedWriteBatch(self._wrapped, self._governor)
+    def bulk_writer(self, *args, **kwargs):
+        return GovernedBulkWriter(self._wrapped.bulk_writer(*args, **kwargs), self._governor)
+
 class BaseCollection(object):
     baseUrl = 'https://homegraph.googleapis.com'
     collectionRootPath = None
-    def __init__(self, client, apikey=None):
-        self.client = client
+    resolvePageSize = 300
+    getAllChunkSize = 100
+    cascadeFlushSize = 500
+    ## users per buildSync() batch (one write per user)
+    syncBatchSize = 500
+    ## (collection, field) of documents linking to this collection, removed by --cascade
+    dependentFields = ()
+    outputFormat = 'text'
+    formatArguments = (
+        ('--format',        { 'type': str,    'required': False, 'default': 'text', 'choices': ('text', 'jsonl') }),
+    )
+    snapshotArguments = (
+        ('--snapshot',      { 'type': str,    'required': False }),
+    )
+    listArguments = (
+        ('--limit',         { 'type': int,    'required': False }),
+        ('--page-size',     { 'type': int,    'required': False }),
+        ('--start-after',   { 'type': str,    'required': False }),
+    ) + formatArguments + snapshotArguments
+    cascadeArguments = (
+        ('--cascade',       { 'type': bool,   'required': False }),
+        ('--dry-run',       { 'type': bool,   'required': False }),
+    )
+    def __init__(self, client=None, apikey=None, dispatcher=None, engine=None, cache=None):
+        self._client = client
         self.apikey = apikey
+        self.dispatcher = dispatcher
+        self.engine = engine
+        self.cache = cache
+        self.pendingSync = set()
+        self._referenceTypes = None
+    @property
+    def client(self):
+        ## connect on first use, so help and argument errors stay offline
+        if self._client is None:
+            self._client = get_client()
+        return self._client
+    def _is_reference(self, value):
+        while isinstance(value, (_Profiled, _Governed)):
+            value = value._wrapped
+        return isinstance(value, self._referenceTypes or get_reference_types())
+    def _open_snapshot(self, filename):
+        ## read from a local export instead of Firestore
+        import snapshot
+        self._client = snapshot.Client(filename)
+        self._referenceTypes = (snapshot.DocumentReference,)
+        self.engine = None
+        self.cache = None
     def _get_colref(self, collectionPath=None):
         if collectionPath is None:
             collectionPath = self.collectionRootPath
         return self.client.collection(collectionPath)
-    def _get_doc(self, documentSnap):
+    def _references(self, documentSnaps):
+        ## every DocumentReference in the snapshots, each path once
+        references = {}
+        for documentSnap in documentSnaps:
+            for v in (documentSnap.to_dict() or {}).values():
+                if self._is_reference(v):
+                    references.setdefault(v.path, v)
+        return list(references.values())
+    def _get_all(self, references, fromCache=True):
+        ## with the async engine the chunks are fetched concurrently,
+        ## with the cache only the documents not cached are read
+        ## (fromCache=False reads them all and refreshes the cache)
+        references = list(references)
+        cached = []
+        if self.cache is not None and fromCache:
+            uncached = []
+            for reference in references:
+                docsnap = self.cache.lookup(reference, self.client.document)
+                if docsnap is None:
+                    uncached.append(reference)
+                else:
+                    cached.append(docsnap)
+            references = uncached
+        if self.engine is not None:
+            docsnaps = self.engine.get_all(references)
+        else:
+            docsnaps = []
+            for i in range(0, len(references), self.getAllChunkSize):
+                docsnaps.extend(self.client.get_all(references[i:i + self.getAllChunkSize]))
+        if self.cache is not None:
+            for docsnap in docsnaps:
+                self.cache.store(docsnap, self._is_reference)
+        return cached + docsnaps
+    def _invalidate(self, paths):
+        if self.cache is None:
+            return
+        for path in paths:
+            self.cache.invalidate(path)
+    def _resolve_references(self, documentSnaps):
+        return { docsnap.reference.path: docsnap.to_dict() for docsnap in self._get_all(self._references(documentSnaps)) }
+    def _get_doc(self, documentSnap, resolved=None, resolve=True):
         id_dict = { 'id': documentSnap.id }
         data_dict = documentSnap.to_dict()
         merged_dict = { **id_dict, **data_dict }
-        yield { k: v.get().to_dict() if isinstance(v, firestore.DocumentReference) else v for k, v in merged_dict.items() }
-    def _get(self, dockey=None):
-        collectionref = self._get_colref()
+        if not resolve:
+            yield merged_dict
+            return
+        if resolved is None:
+            resolved = self._resolve_references([documentSnap])
+        yield { k: resolved.get(v.path) if self._is_reference(v) else v for k, v in merged_dict.items() }
+    def _where(self, query, field_path, op_string, value):
+        ## a FieldFilter is not unwrapped by the profiled/governed queries
+        value = _unwrap(value)
+        try:
+            from google.cloud.firestore_v1.base_query import FieldFilter
+        except ImportError:
+            return query.where(field_path, op_string, value)
+        return query.where(filter=FieldFilter(field_path, op_string, value))
+    def _list_options(self, args):
+        self.outputFormat = args.format
+        if getattr(args, 'snapshot', None):
+            self._open_snapshot(args.snapshot)
+        return {
+            'limit': getattr(args, 'limit', None),
+            'pageSize': getattr(args, 'page_size', None),
+            'startAfter': getattr(args, 'start_after', None),
+        }
+    def _stream(self, query, limit=None, pageSize=None, startAfter=None):
+        ## read page by page ordered by document id, resuming after the last snapshot
+        pageSize = pageSize or self.resolvePageSize
+        query = query.order_by('__name__')
+        cursor = { '__name__': startAfter } if startAfter else None
+        while limit is None or limit > 0:
+            size = pageSize if limit is None else min(pageSize, limit)
+            page = query if cursor is None else query.start_after(cursor)
+            count = 0
+            for docsnap in page.limit(size).stream():
+                count += 1
+                cursor = docsnap
+                yield docsnap
+            if count < size:
+                return
+            if limit is not None:
+                limit -= count
+    def _json_default(self, value):
+        if hasattr(value, 'path'):
+            return value.path
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        if isinstance(value, bytes):
+            return value.hex()
+        if hasattr(value, 'latitude'):
+            return { 'latitude': value.latitude, 'longitude': value.longitude }
+        return str(value)
+    def _print_jsonl(self, record_id, record):
+        sys.stdout.write(json.dumps({ 'id': record_id, **record }, ensure_ascii=False, default=self._json_default) + "\n")
+        sys.stdout.flush()
+    def _get(self, dockey=None, filters=None, limit=None, pageSize=None, startAfter=None, fields=None, resolve=True):
+        ## fields: fetch only these fields (select projection)
+        ## resolve: replace DocumentReference fields with the referenced data
+        filters = { k: v for k, v in (filters or {}).items() if v is not None }
         docsnaps = []
         if dockey:
-            docsnaps = [ self._get_colref().document(dockey).get() ]
+            docref = self._get_colref().document(dockey)
+            if self.cache is not None and self.cache.cacheable(docref.path):
+                docsnap = self._get_all([docref])[0]
+            else:
+                ## the filtered fields are read too, the projection drops them after the check
+                docsnap = docref.get(field_paths=None if fields is None else list(fields) + [ k for k in filters if k not in fields ])
+            docdata = docsnap.to_dict() or {}
+            if all(docdata.get(k) == v for k, v in filters.items()):
+                if fields is not None and docsnap.exists:
+                    import snapshot
+                    docsnap = snapshot.DocumentSnapshot(docsnap.reference, snapshot._project(docdata, fields))
+                docsnaps = [ docsnap ]
         else:
-            docsnaps = self._get_colref().get()
-        for docsnap in docsnaps:
-            yield self._get_doc(docsnap)
+            query = self._get_colref()
+            for field_path, value in filters.items():
+                query = self._where(query, field_path, '==', value)
+            if fields is not None:
+                query = query.select(fields)
+            docsnaps = self._stream(query, limit, pageSize, startAfter)
+        docsnaps = iter(docsnaps)
+        if resolve and self.engine is not None:
+            yield from self._get_pipelined(docsnaps, pageSize or self.resolvePageSize)
+            return
+        while True:
+            page = list(itertools.islice(docsnaps, pageSize or self.resolvePageSize))
+            if not page:
+                break
+            resolved = self._resolve_references(page) if resolve else {}
+            for docsnap in page:
+                yield self._get_doc(docsnap, resolved, resolve)
+    def _get_pipelined(self, docsnaps, pageSize):
+        ## the references of a page are resolved on the async engine while
+        ## the next page is read, one round trip per page instead of two
+        pending = None
+        while True:
+            page = list(itertools.islice(docsnaps, pageSize))
+            future = self.engine.submit_get_all(self._references(page)) if page else None
+            if pending is not None:
+                previous, previousFuture = pending
+                resolved = { docsnap.reference.path: docsnap.to_dict() for docsnap in previousFuture.result() }
+                for docsnap in previous:
+                    yield self._get_doc(docsnap, resolved)
+            if not page:
+                break
+            pending = (page, future)
     def _add(self, docdata={}):
         try:
             update_time, docref = self._get_colref().add(docdata)
@@ -211,11 +1399,21 @@ class BaseCollection(object):
             sys.stderr.write(str(e) + "\n")
             sys.exit(1)
         return docref
-    def _del(self, dockey):
+    def _del(self, dockey, dependents=()):
+        ## dependents: references deleted in the same batch as the document
         try:
             docref = self._get_colref().document(dockey)
-            if(docref.get().exists):
-                times = docref.delete()
+            docsnap = docref.get()
+            if(docsnap.exists):
+                if dependents:
+                    batch = self.client.batch()
+                    batch.delete(docref)
+                    for reference in dependents:
+                        batch.delete(reference)
+                    times = batch.commit()
+                else:
+                    times = docref.delete()
+                self._invalidate([docref.path] + [ reference.path for reference in dependents ])
                 if times:
                     sys.stdout.write("{} was deleted\n".format(self.collectionRootPath + '/' + dockey))
             else:
@@ -224,76 +1422,376 @@ class BaseCollection(object):
             (t, e) = sys.exc_info()[:2]
             sys.stderr.write(str(e) + "\n")
             sys.exit(1)
-        return docref
+        return docsnap
+    def _missing_references(self, values, created=()):
+        ## check every DocumentReference among values with one get_all,
+        ## created: paths written by the same command, not checked
+        references = {}
+        for v in values:
+            if self._is_reference(v) and v.path not in created:
+                references.setdefault(v.path, v)
+        ## existence is never taken from the cache, a deleted document may still be cached
+        docsnaps = { docsnap.reference.path: docsnap for docsnap in self._get_all(references.values(), fromCache=False) }
+        missing = sorted(path for path, docsnap in docsnaps.items() if not docsnap.exists)
+        return missing, docsnaps
+    def _reference_error(self, path):
+        collection_path, document_id = path.rsplit('/', 1)
+        return "{} cannot referenced, check {}".format(document_id, collection_path.capitalize())
+    def checkReferences(self, values):
+        ## fails before anything is written if a referenced document is missing
+        missing, docsnaps = self._missing_references(values)
+        if missing:
+            for path in missing:
+                sys.stderr.write(self._reference_error(path) + "\n")
+            sys.exit(1)
+        return docsnaps
     def getDeviceReference(self, device_id, checkExists=False):
         deviceReference = self._get_colref(Device.collectionRootPath).document(device_id)
-        if checkExists == True and deviceReference is None:
-            sys.stderr.write("{} cannot referenced, check Devices\n".format(device_id))
-            sys.exit(1)
+        if checkExists == True:
+            self.checkReferences([deviceReference])
         return deviceReference
     def getGroupReference(self, group_id, checkExists=False):
         groupReference = self._get_colref(Group.collectionRootPath).document(group_id)
-        if checkExists == True and groupReference is None:
-            sys.stderr.write("{} cannot referenced, check Groups\n".format(group_id))
-            sys.exit(1)
+        if checkExists == True:
+            self.checkReferences([groupReference])
         return groupReference
     def getRemoteReference(self, remote_id, checkExists=False):
         remoteReference = self._get_colref(Remote.collectionRootPath).document(remote_id)
-        if checkExists == True and remoteReference is None:
-            sys.stderr.write("{} cannot referenced, check Remotes\n".format(remote_id))
-            sys.exit(1)
+        if checkExists == True:
+            self.checkReferences([remoteReference])
         return remoteReference
     def getUserReference(self, user_id, checkExists=False):
         userReference = self._get_colref(User.collectionRootPath).document(user_id)
-        if checkExists == True and userReference is None:
-            sys.stderr.write("{} cannot referenced, check Groups\n".format(userId))
-            sys.exit(1)
+        if checkExists == True:
+            self.checkReferences([userReference])
         return userReference
     def getIrcodeReference(self, ircode_id, checkExists=False):
         ircodeReference = self._get_colref(Ircode.collectionRootPath).document(ircode_id)
-        if checkExists == True and ircodeReference is None:
-            sys.stderr.write("{} cannot referenced, check Ircodes\n".format(ircode_id))
-            sys.exit(1)
+        if checkExists == True:
+            self.checkReferences([ircodeReference])
         return ircodeReference
+    def _subtree(self, docref):
+        ## the document and every document of its subcollections, deepest first
+        for colref in docref.collections():
+            for child in colref.list_documents():
+                yield from self._subtree(child)
+        yield docref
+    def _cascade_updates(self, dockey):
+        ## (docref, field updates) applied to documents that keep existing
+        return []
+    def _cascade(self, dockeys, dry_run=False):
+        ## delete the documents, their subcollections and every document
+        ## linking to them (dependentFields), found with where queries
+        deletes = {}
+        updates = []
+        roots = []
+        sync_users = set()
+        sync_groups = set()
+        found = {}
+        for dockey in dockeys:
+            docref = self._get_colref().document(dockey)
+            roots.append(docref)
+            dependents = [ child for child in self._subtree(docref) if child.path != docref.path ]
+            for collectionPath, field in self.dependentFields:
+                query = self._where(self._get_colref(collectionPath), field, '==', dockey)
+                for docsnap in query.select(['userId', 'groupId']).stream():
+                    dependents.append(docsnap.reference)
+                    docdata = docsnap.to_dict() or {}
+                    if 'userId' in docdata:
+                        sync_users.add(docdata['userId'])
+                    if 'groupId' in docdata:
+                        sync_groups.add(docdata['groupId'])
+            dependents.append(docref)
+            for dependent in dependents:
+                deletes.setdefault(dependent.path, dependent)
+            cascade_updates = self._cascade_updates(dockey)
+            updates.extend(cascade_updates)
+            found[docref.path] = len(dependents) - 1 + len(cascade_updates)
+        ## a missing document is an error only when nothing refers to it
+        missing, docsnaps = self._missing_references(roots)
+        for path in missing:
+            if not found[path]:
+                sys.stderr.write("{} delete failed\n".format(path))
+                sys.exit(1)
+        ## user_groups index entries of the deleted groups and users
+        index_writes = []
+        if self.collectionRootPath == Group.collectionRootPath:
+            sync_groups.update(dockeys)
+            for docref in roots:
+                if docref.path not in missing:
+                    index_writes += self._user_groups_writes(docref.id, removed=(docsnaps[docref.path].to_dict() or {}).keys())
+        if self.collectionRootPath == User.collectionRootPath:
+            for docref in roots:
+                if docref.path not in missing:
+                    dependent = self._get_colref(UserGroup.collectionRootPath).document(docref.id)
+                    deletes.setdefault(dependent.path, dependent)
+        ## members are read before the groups may be deleted
+        for members in self.getGroupMembers(sync_groups).values():
+            sync_users.update(members)
+        if self.collectionRootPath == User.collectionRootPath:
+            sync_users.difference_update(dockeys)
+            ## the SYNC documents of the deleted users are removed by commitSync()
+            deleted_users = [ dockey for dockey in dockeys if self._get_colref().document(dockey).path not in missing ]
+        else:
+            deleted_users = []
+        if dry_run:
+            for docref, field_updates in updates + index_writes:
+                sys.stdout.write("{} would be updated ({})\n".format(docref.path, ', '.join(sorted(field_updates))))
+            for path in deletes:
+                sys.stdout.write("{} would be deleted\n".format(path))
+            sys.stdout.write("{} documents would be deleted, {} updated, requestSync for {} users\n".format(len(deletes), len(updates) + len(index_writes), len(sync_users)))
+            return
+        writer = self.client.bulk_writer()
+        total = len(deletes) + len(updates) + len(index_writes)
+        done = 0
+        for docref, field_updates in updates:
+            writer.update(docref, field_updates)
+            done += 1
+        for docref, docdata in index_writes:
+            writer.set(docref, docdata, merge=True)
+            done += 1
+        for docref in deletes.values():
+            writer.delete(docref)
+            done += 1
+            if done % self.cascadeFlushSize == 0:
+                writer.flush()
+                sys.stderr.write("{}/{} written\n".format(done, total))
+        writer.close()
+        self._invalidate(list(deletes) + [ docref.path for docref, field_updates in updates ])
+        for docref in roots:
+            if docref.path not in missing:
+                sys.stdout.write("{} was deleted\n".format(docref.path))
+        sys.stdout.write("{} documents deleted, {} updated\n".format(len(deletes), len(updates) + len(index_writes)))
+        for user_id in sorted(sync_users) + deleted_users:
+            self.requestSync(user_id)
+    def getGroupMembers(self, group_ids):
+        group_ids = sorted(set(group_ids))
+        members = {}
+        references = [ self.getGroupReference(group_id) for group_id in group_ids ]
+        for docsnap in self._get_all(references):
+            members[docsnap.id] = list((docsnap.to_dict() or {}).keys())
+        return members
+    def _code_blob(self, code):
+        ## ircode_blobs/{sha256 of the code}, the code zlib-compressed
+        raw = bytes.fromhex(code)
+        docref = self._get_colref(IrcodeBlob.collectionRootPath).document(hashlib.sha256(raw).hexdigest())
+        return docref, { 'data': zlib.compress(raw, 9), 'encoding': 'zlib', 'size': len(raw) }
+    def compactCodes(self, values):
+        ## replace the hex codes by references to ircode_blobs, returns the
+        ## values and the blob documents {path: (docref, docdata)}
+        compact = {}
+        blobs = {}
+        for k, v in values.items():
+            if isinstance(v, str) and ImportRemoteCode.hexCodePattern.match(v) and len(v) % 2 == 0:
+                docref, docdata = self._code_blob(v)
+                blobs[docref.path] = (docref, docdata)
+                compact[k] = docref
+            else:
+                compact[k] = v
+        return compact, blobs
+    def _new_blobs(self, blobs):
+        ## the blobs not stored yet, blobs are never rewritten
+        existing = set(docsnap.reference.path for docsnap in self._get_all([ docref for docref, docdata in blobs.values() ]) if docsnap.exists)
+        return [ (docref, docdata) for path, (docref, docdata) in sorted(blobs.items()) if path not in existing ]
+    def expandCodes(self, docdatas):
+        ## the values with references to ircode_blobs replaced by hex codes,
+        ## every blob read with one get_all
+        references = {}
+        for docdata in docdatas:
+            for v in docdata.values():
+                if self._is_reference(v):
+                    references.setdefault(v.path, v)
+        codes = {}
+        for docsnap in self._get_all(references.values()):
+            if docsnap.exists:
+                blob = docsnap.to_dict()
+                codes[docsnap.reference.path] = zlib.decompress(blob['data']).hex() if blob.get('encoding') == 'zlib' else bytes(blob['data']).hex()
+        return [ { k: codes.get(v.path) if self._is_reference(v) else v for k, v in docdata.items() } for docdata in docdatas ]
+    def _document_size(self, path, docdata):
+        ## storage size of a document, see
+        ## https://firebase.google.com/docs/firestore/storage-size
+        def value_size(v):
+            if isinstance(v, str):
+                return len(v.encode('utf-8')) + 1
+            if isinstance(v, (bytes, bytearray)):
+                return len(v)
+            if isinstance(v, dict):
+                return sum(len(k.encode('utf-8')) + 1 + value_size(x) for k, x in v.items())
+            if isinstance(v, (list, tuple)):
+                return sum(value_size(x) for x in v)
+            if self._is_reference(v):
+                return self._document_name_size(v.path)
+            return 8
+        return self._document_name_size(path) + value_size(docdata) + 32
+    def _document_name_size(self, path):
+        return sum(len(segment.encode('utf-8')) + 1 for segment in path.split('/')) + 16
+    def getDeviceUsers(self, device_ids):
+        ## users seeing the devices through user_devices or group_devices
+        user_ids = set()
+        group_ids = set()
+        for device_id in device_ids:
+            query = self._where(self._get_colref(UserDevice.collectionRootPath), 'deviceId', '==', device_id)
+            user_ids.update(docsnap.get('userId') for docsnap in query.select(['userId']).stream())
+            query = self._where(self._get_colref(GroupDevice.collectionRootPath), 'deviceId', '==', device_id)
+            group_ids.update(docsnap.get('groupId') for docsnap in query.select(['groupId']).stream())
+        for members in self.getGroupMembers(group_ids).values():
+            user_ids.update(members)
+        return user_ids
+    def syncDevice(self, row_id, nickname, devdata):
+        ## same as payload_data() of the SYNC intent in functions/app.js
+        name = devdata.get('name')
+        if not name:
+            if devdata.get('manufacturer') and devdata.get('model'):
+                name = devdata['manufacturer'] + ' ' + devdata['model']
+            else:
+                name = devdata.get('id')
+        payload = {
+            'id': row_id,
+            'type': devdata.get('type'),
+            'name': { 'defaultNames': [ name ], 'name': name, 'nicknames': [ nickname ] },
+            'deviceInfo': {},
+            'traits': devdata.get('traits') or [],
+            'willReportState': devdata.get('willReportState'),
+        }
+        if devdata.get('manufacturer'):
+            payload['deviceInfo']['manufacturer'] = devdata['manufacturer']
+        if devdata.get('model'):
+            payload['deviceInfo']['model'] = devdata['model']
+        if devdata.get('attributes'):
+            payload['attributes'] = devdata['attributes']
+        return payload
+    def buildSync(self, user_ids):
+        ## rewrite user_syncs/{user_id} with the devices of the SYNC response,
+        ## the document of a deleted user is removed. returns the existing users
+        user_ids = sorted(set(user_ids))
+        userReferences = [ self.getUserReference(user_id) for user_id in user_ids ]
+        missing, docsnaps = self._missing_references(userReferences)
+        rows = {}
+        group_rows = {}
+        user_groups = self.getUserGroups([ user_id for user_id, userReference in zip(user_ids, userReferences) if userReference.path not in missing ])
+        for user_id in user_groups:
+            query = self._where(self._get_colref(UserDevice.collectionRootPath), 'userId', '==', user_id)
+            rows[user_id] = [ docsnap for docsnap in query.select(['deviceId', 'name']).stream() ]
+        for group_id in sorted(set(g for groups in user_groups.values() for g in groups)):
+            query = self._where(self._get_colref(GroupDevice.collectionRootPath), 'groupId', '==', group_id)
+            group_rows[group_id] = [ docsnap for docsnap in query.select(['deviceId', 'name']).stream() ]
+        device_ids = set(docsnap.get('deviceId') for docsnaps in itertools.chain(rows.values(), group_rows.values()) for docsnap in docsnaps)
+        devices = { docsnap.id: docsnap.to_dict() for docsnap in self._get_all([ self.getDeviceReference(device_id) for device_id in sorted(device_ids) ]) if docsnap.exists }
+        now = datetime.datetime.now(datetime.timezone.utc)
+        batch = self.client.batch()
+        for user_id, userReference in zip(user_ids, userReferences):
+            docref = self._get_colref(UserSync.collectionRootPath).document(user_id)
+            if userReference.path in missing:
+                batch.delete(docref)
+            else:
+                ## group devices first, a row id seen twice keeps its first place (valuniq of app.js)
+                payload = {}
+                for docsnap in itertools.chain(*[ group_rows[g] for g in user_groups[user_id] ], rows[user_id]):
+                    docdata = docsnap.to_dict()
+                    if docdata.get('deviceId') in devices:
+                        payload[docsnap.id] = self.syncDevice(docsnap.id, docdata.get('name'), devices[docdata['deviceId']])
+                batch.set(docref, { 'devices': list(payload.values()), 'updatedAt': now })
+            if len(batch) >= self.syncBatchSize:
+                batch.commit()
+                batch = self.client.batch()
+        if len(batch):
+            batch.commit()
+        return [ user_id for user_id, userReference in zip(user_ids, userReferences) if userReference.path not in missing ]
+    def getUserGroups(self, user_ids):
+        ## ids of the groups having each user as a member, read from the
+        ## user_groups index with one get_all. the groups are queried for a
+        ## user having no index document yet (see build_user_groups)
+        user_ids = sorted(set(user_ids))
+        groups = {}
+        references = [ self._get_colref(UserGroup.collectionRootPath).document(user_id) for user_id in user_ids ]
+        for docsnap in self._get_all(references):
+            if docsnap.exists:
+                groups[docsnap.id] = sorted((docsnap.to_dict() or {}).keys())
+        for user_id in user_ids:
+            if user_id not in groups:
+                groups[user_id] = self._scan_user_groups(user_id)
+        return groups
+    def _scan_user_groups(self, user_id):
+        query = self._where(self._get_colref(Group.collectionRootPath), user_id, '==', self.getUserReference(user_id))
+        return [ docsnap.id for docsnap in query.select([]).stream() ]
+    def _user_groups_writes(self, group_id, added=(), removed=()):
+        ## (docref, data) written with set(merge=True) to keep user_groups/{user_id}
+        ## in step with the members of groups/{group_id}
+        colref = self._get_colref(UserGroup.collectionRootPath)
+        groupReference = self.getGroupReference(group_id)
+        writes = [ (colref.document(user_id), { group_id: groupReference }) for user_id in added ]
+        writes += [ (colref.document(user_id), { group_id: get_backend().delete_field() }) for user_id in removed ]
+        return writes
+    def _write_user_groups(self, writes):
+        batch = self.client.batch()
+        for docref, docdata in writes:
+            batch.set(docref, docdata, merge=True)
+            if len(batch) >= self.syncBatchSize:
+                batch.commit()
+                batch = self.client.batch()
+        if len(batch):
+            batch.commit()
     def requestSync(self, agent_user_id):
-        if not self.apikey:
+        ## sent by commitSync() after the command, with the SYNC document
+        self.pendingSync.add(agent_user_id)
+    def commitSync(self):
+        user_ids, self.pendingSync = self.pendingSync, set()
+        if not user_ids:
             return
-        url = self.baseUrl + '/v1/devices:requestSync?key=' + self.apiKey
-        headers = { 'Content-Type': 'application/json' }
-        data = json.dumps({ 'agent_user_id' : agent_user_id }).encode()
-        req = urllib.request.Request(url, data=data, method='POST', headers=headers)
-        with urllib.request.urlopen(req) as res:
-            return res.status, res.reason
+        user_ids = self.buildSync(user_ids)
+        if not self.apikey or self.dispatcher is None:
+            return
+        for user_id in user_ids:
+            self.dispatcher.submit(user_id)
 class Device(BaseCollection):
     collectionRootPath = 'devices'
+    dependentFields = (('user_devices', 'deviceId'), ('group_devices', 'deviceId'))
 class Remote(BaseCollection):
     collectionRootPath = 'remotes'
+    dependentFields = (('user_devices', 'remoteId'), ('group_devices', 'remoteId'))
 class User(BaseCollection):
     collectionRootPath = 'users'
+    dependentFields = (('user_devices', 'userId'),)
+    def _cascade_updates(self, user_id):
+        ## the user is removed from the groups, the groups are kept
+        query = self._where(self._get_colref(Group.collectionRootPath), user_id, '==', self.getUserReference(user_id))
+        return [ (docsnap.reference, { user_id: get_backend().delete_field() }) for docsnap in query.stream() ]
 class Group(BaseCollection):
     collectionRootPath = 'groups'
+    dependentFields = (('group_devices', 'groupId'),)
 class UserDevice(BaseCollection):
     collectionRootPath = 'user_devices'
 class GroupDevice(BaseCollection):
     collectionRootPath = 'group_devices'
 class Ircode(BaseCollection):
     collectionRootPath = 'ircodes'
+class IrcodeBlob(BaseCollection):
+    ## learned codes shared by the ircodes, content-addressed (see compactCodes())
+    collectionRootPath = 'ircode_blobs'
+class UserGroup(BaseCollection):
+    ## inverted index of groups: user_groups/{user_id} = { group_id: groupReference }
+    collectionRootPath = 'user_groups'
+class UserSync(BaseCollection):
+    ## devices of the SYNC response per agentUserId, see buildSync()
+    collectionRootPath = 'user_syncs'
 
 class GetDevice(Device):
+    summaryFields = ('manufacturer', 'model', 'name')
     arguments = (
         ('--device-id',     { 'type': str,    'required': False}),
         ('--full',          { 'type': bool,   'required': False}),
-    )
+    ) + BaseCollection.listArguments
     def run(self, args=object):
         device_id = args.device_id
         show_full = args.full
-        device_info = {}
-        for device in self._get(device_id):
-            device_basic_info = None
+        summary = {} if show_full else { 'fields': self.summaryFields, 'resolve': False }
+        for device in self._get(device_id, **summary, **self._list_options(args)):
             for dev in device:
                 device_id = dev['id']
                 del dev['id']
-                if show_full:
+                if self.outputFormat == 'jsonl':
+                    self._print_jsonl(device_id, dev)
+                elif show_full:
                     pprint.pprint({device_id: dev})
                 else:
                     device_name = dev['manufacturer'] + ' ' + dev['model']
@@ -311,13 +1809,14 @@ class AddDevice(Device):
         ('--report-state',  { 'type': bool,   'required': False }),
         ('--name',          { 'type': str,    'required': False }),
     )
-    def run(self, args=object):
-        device_manufacturer = args.manufacturer
-        device_model = args.model
-        device_traits = [ DEVICE_TRAITS_PREFIX + t for t in args.traits ]
-        device_type = DEVICE_TYPES_PREFIX + args.type
-        device_report_state = args.report_state
-        device_name = args.name
+    def docdata(self, device_manufacturer, device_model, device_traits, device_type, device_report_state=False, device_name=None):
+        for t in device_traits:
+            if t not in DEVICE_TRAITS:
+                raise ValueError('{} is not a device trait'.format(t))
+        if device_type not in DEVICE_TYPES:
+            raise ValueError('{} is not a device type'.format(device_type))
+        device_traits = [ DEVICE_TRAITS_PREFIX + t for t in device_traits ]
+        device_type = DEVICE_TYPES_PREFIX + device_type
         docdata = {
             'manufacturer': device_manufacturer,
             'model': device_model,
@@ -327,16 +1826,26 @@ class AddDevice(Device):
         }
         if device_name:
             docdata['name'] = device_name
+        return docdata
+    def run(self, args=object):
+        docdata = self.docdata(args.manufacturer, args.model, args.traits, args.type, args.report_state, args.name)
         self._add(docdata)
         return
 
 class DelDevice(Device):
     arguments = (
-        ('--device-id',     { 'type': str,    'required': True }),
-    )
+        ('--device-id',     { 'type': list,   'required': True }),
+    ) + BaseCollection.cascadeArguments
     def run(self, args=object):
-        device_id = args.device_id
-        self._del(device_id)
+        device_ids = args.device_id
+        if args.cascade or args.dry_run:
+            self._cascade(device_ids, args.dry_run)
+            return
+        user_ids = self.getDeviceUsers(device_ids)
+        for device_id in device_ids:
+            self._del(device_id)
+        for user_id in sorted(user_ids):
+            self.requestSync(user_id)
         return
 
 class GetDeviceAttribute(Device):
@@ -344,11 +1853,12 @@ class GetDeviceAttribute(Device):
         ('--device-id',     { 'type': str,    'required': True }),
         ('--attr-name',     { 'type': str,    'required': False }),
         ('--full',          { 'type': bool,   'required': False }),
-    )
+    ) + BaseCollection.formatArguments + BaseCollection.snapshotArguments
     def run(self, args=object):
         device_id = args.device_id
         attr_name = args.attr_name
         show_full = args.full
+        self._list_options(args)
         for device in self._get(device_id):
             for dev in device:
                 if 'attributes' not in dev:
@@ -357,7 +1867,10 @@ class GetDeviceAttribute(Device):
                     show_attrs = { attr_name: dev['attributes'][attr_name] }
                 else:
                     show_attrs = dev['attributes']
-                pprint.pprint(show_attrs)
+                if self.outputFormat == 'jsonl':
+                    self._print_jsonl(dev['id'], { 'attributes': show_attrs })
+                else:
+                    pprint.pprint(show_attrs)
 
 class AddDeviceAttribute(Device):
     arguments = (
@@ -370,7 +1883,44 @@ class AddDeviceAttribute(Device):
         attr_name = args.attr_name
         attr_data = args.attr_data
         attr_data = json.loads(attr_data)
-        update_time = self.getDeviceReference(device_id).update({ 'attributes.' + attr_name: attr_data})
+        deviceReference = self.getDeviceReference(device_id)
+        ## a nested field (name.field) is checked within its top-level attribute
+        name, *fields = attr_name.split('.')
+        registry = get_schema_registry()
+        ## a top-level value is checked against every trait before any RPC,
+        ## then against the traits of the device
+        errors = [] if fields else registry.attributes()({ attr_name: attr_data })
+        if not errors:
+            ## existence is never taken from the cache
+            docsnap = self._get_all([deviceReference], fromCache=False)[0]
+            if not docsnap.exists:
+                errors = [ self._reference_error(deviceReference.path) ]
+            else:
+                docdata = docsnap.to_dict()
+                value = attr_data
+                if fields:
+                    ## the attribute as the update leaves it
+                    value = copy.deepcopy((docdata.get('attributes') or {}).get(name))
+                    if not isinstance(value, dict):
+                        value = {}
+                    target = value
+                    for field in fields[:-1]:
+                        if not isinstance(target.get(field), dict):
+                            target[field] = {}
+                        target = target[field]
+                    target[fields[-1]] = attr_data
+                try:
+                    errors = registry.attributes(docdata.get('traits') or [])({ name: value })
+                except ValueError as e:
+                    errors = [ '{}: {}'.format(deviceReference.path, e) ]
+        if errors:
+            for error in errors:
+                sys.stderr.write(error + "\n")
+            sys.exit(1)
+        update_time = deviceReference.update({ 'attributes.' + attr_name: attr_data})
+        self._invalidate([deviceReference.path])
+        for user_id in sorted(self.getDeviceUsers([device_id])):
+            self.requestSync(user_id)
         return
 
 class DelDeviceAttribute(Device):
@@ -380,18 +1930,22 @@ class DelDeviceAttribute(Device):
     )
 
 class GetRemote(Remote):
+    summaryFields = ('mac_addr', 'type', 'name')
     arguments = (
         ('--remote-id',     { 'type': str,    'required': False }),
         ('--full',          { 'type': bool,   'required': False }),
-    )
+    ) + BaseCollection.listArguments
     def run(self, args=object):
         remote_id = args.remote_id
         show_full = args.full
-        for remote in self._get(remote_id):
+        summary = {} if show_full else { 'fields': self.summaryFields, 'resolve': False }
+        for remote in self._get(remote_id, **summary, **self._list_options(args)):
             for r in remote:
                 remote_id = r['id']
                 del r['id']
-                if show_full:
+                if self.outputFormat == 'jsonl':
+                    self._print_jsonl(remote_id, r)
+                elif show_full:
                     pprint.pprint({remote_id: r})
                 else:
                     remote_name = r['mac_addr']
@@ -407,84 +1961,204 @@ class AddRemote(Remote):
         ('--remote-type',   { 'type': str,    'required': True }),
         ('--name',          { 'type': str,    'required': False }),
     )
-    def run(self, args=object):
-        remote_macaddr = args.mac_addr
-        remote_type = args.remote_type
-        remote_name = args.name
+    def docdata(self, remote_macaddr, remote_type, remote_name=None):
         docdata = {
             'mac_addr': remote_macaddr,
             'type': remote_type
         }
         if remote_name:
             docdata['name'] = remote_name
+        return docdata
+    def run(self, args=object):
+        docdata = self.docdata(args.mac_addr, args.remote_type, args.name)
         self._add(docdata)
         return
 
 class DelRemote(Remote):
     arguments = (
-        ('--remote-id',     { 'type': str,    'required': True }),
-    )
+        ('--remote-id',     { 'type': list,   'required': True }),
+    ) + BaseCollection.cascadeArguments
     def run(self, args=object):
-        remote_id = args.remote_id
-        self._del(remote_id)
+        remote_ids = args.remote_id
+        if args.cascade or args.dry_run:
+            self._cascade(remote_ids, args.dry_run)
+            return
+        for remote_id in remote_ids:
+            self._del(remote_id)
         return
 
 class GetRemoteCode(Device):
     arguments = (
         ('--device-id',     { 'type': str,    'required': True }),
         ('--remote-type',   { 'type': str,    'required': True }),
-    )
+    ) + BaseCollection.listArguments
     def run(self, args=object):
         device_id = args.device_id
         remote_type = args.remote_type
         remote_collection = '/'.join((self.collectionRootPath, device_id, remote_type))
-        for docsnap in self._get_colref(remote_collection).get():
+        options = self._list_options(args)
+        for docsnap in self._stream(self._get_colref(remote_collection), **options):
             action = docsnap.id
-            for remote in self._get_doc(documentSnap=docsnap):
-                del remote['id']
-                pprint.pprint({action: remote})
+            for remote in self.expandCodes([docsnap.to_dict()]):
+                if self.outputFormat == 'jsonl':
+                    self._print_jsonl(action, remote)
+                else:
+                    pprint.pprint({action: remote})
         return
 
 class AddRemoteCode(Ircode):
     arguments = (
         ('--ircode-id',     { 'type': str,    'required': False }),
         ('--remote-type',   { 'type': str,    'required': True }),
-        ('--action',        { 'type': str,    'required': True,	'choices': sorted(set(x for v in DEVICE_TRAITS.values() for x in v['commands'])) }),
+        ('--action',        { 'type': str,    'required': True,	'choices': DEVICE_COMMANDS }),
         ('--values',        { 'type': list,   'required': True }),
+        ('--compact',       { 'type': bool,   'required': False }),
     )
+    def parse_values(self, remotecode_values):
+        values = {}
+        for v in remotecode_values:
+            if '=' not in v:
+                raise ValueError('{} value separated with "=" was required'.format(v))
+            kv,vv = v.split('=', 1)
+            if not kv or not vv:
+                raise ValueError('{} value with key and value was required'.format(v))
+            values[kv] = vv
+        return values
     def run(self, args):
         ircode_id = args.ircode_id
         remote_type = args.remote_type
         remotecode_action = DEVICE_COMMANDS_PREFIX + args.action
         remotecode_values = args.values
         try:
-            if  not ircode_id or not self.getIrcodeReference(ircode_id,False):
+            values = self.parse_values(remotecode_values)
+            blobs = {}
+            if args.compact:
+                values, blobs = self.compactCodes(values)
+            if ircode_id:
+                ## the ircode and the blobs are read with one get_all
+                ircodeReference = self.getIrcodeReference(ircode_id)
+                missing, docsnaps = self._missing_references([ ircodeReference ] + [ blobref for blobref, blobdata in blobs.values() ])
+                if ircodeReference.path in missing:
+                    raise ValueError(self._reference_error(ircodeReference.path))
+                newBlobs = [ (blobref, blobdata) for path, (blobref, blobdata) in sorted(blobs.items()) if path in missing ]
+            else:
                 ircode_id = self._add({}).id
-            colref = self.getIrcodeReference(ircode_id, True).collection(remote_type)
-            docref = colref.document(remotecode_action)
-            for v in remotecode_values:
-                if '=' not in v:
-                    raise ValueError('{} value separated with "=" was required'.format(v))
-                kv,vv = v.split('=')
-                if kv is None or vv is None:
-                    raise ValueError('{} value with key and value was required'.format(v))
-                try:
-                    docref.get()
-                    update_time = docref.update({kv: vv})
-                except:
-                    update_time = colref.add({kv: vv}, remotecode_action)
-                if update_time:
-                    cpath = [self.collectionRootPath, ircode_id, remote_type, remotecode_action, remotecode_values]
-                    cpath = [ str(i) for i in cpath ]
-                    sys.stdout.write("{} was added\n".format('/'.join(cpath)))
-                else:
-                    raise ValueError('data add failed')
+                newBlobs = self._new_blobs(blobs) if blobs else []
+            docref = self.getIrcodeReference(ircode_id).collection(remote_type).document(remotecode_action)
+            if args.compact:
+                ## new blobs and the action in one batch
+                batch = self.client.batch()
+                for blobref, blobdata in newBlobs:
+                    batch.set(blobref, blobdata)
+                batch.set(docref, values, merge=True)
+                update_time = batch.commit()
+            else:
+                ## all keys of the action in one write, existing keys are kept
+                update_time = docref.set(values, merge=True)
+            if not update_time:
+                raise ValueError('data add failed')
+            for kv in values:
+                cpath = [self.collectionRootPath, ircode_id, remote_type, remotecode_action, kv]
+                sys.stdout.write("{} was added\n".format('/'.join(cpath)))
         except:
             (t, e) = sys.exc_info()[:2]
             sys.stderr.write(str(e) + "\n")
             sys.exit(1)
         return
 
+class ImportRemoteCode(Ircode):
+    arguments = (
+        ('--from',          { 'type': str,    'required': True, 'dest': 'source' }),
+        ('--ircode-id',     { 'type': str,    'required': False }),
+        ('--compact',       { 'type': bool,   'required': False }),
+    )
+    maxBatchSize = 500
+    learnedCodePattern = re.compile(r'learned hex code: ([0-9a-fA-F]+)')
+    hexCodePattern = re.compile(r'^[0-9a-fA-F]+$')
+    def action_name(self, action):
+        if action.startswith(DEVICE_COMMANDS_PREFIX):
+            action = action[len(DEVICE_COMMANDS_PREFIX):]
+        if action not in DEVICE_COMMANDS:
+            raise ValueError('{} is not a device command'.format(action))
+        return DEVICE_COMMANDS_PREFIX + action
+    def read_code(self, path):
+        with open(path, 'r') as fd:
+            content = fd.read()
+        ## output of sample/learncode.js or a bare hex string
+        learned = self.learnedCodePattern.findall(content)
+        code = learned[-1] if learned else content.strip()
+        if not self.hexCodePattern.match(code):
+            raise ValueError('{} has no learned code'.format(path))
+        return code.lower()
+    def read_directory(self, source):
+        ## <source>/<remote_type>/<action>/<key>[.ext]
+        codes = {}
+        for remote_type in sorted(os.listdir(source)):
+            remote_dir = os.path.join(source, remote_type)
+            if not os.path.isdir(remote_dir):
+                continue
+            for action in sorted(os.listdir(remote_dir)):
+                action_dir = os.path.join(remote_dir, action)
+                if not os.path.isdir(action_dir):
+                    continue
+                for keyfile in sorted(os.listdir(action_dir)):
+                    key = os.path.splitext(keyfile)[0]
+                    codes.setdefault(remote_type, {}).setdefault(action, {})[key] = self.read_code(os.path.join(action_dir, keyfile))
+        return codes
+    def run(self, args=object):
+        source = args.source
+        ircode_id = args.ircode_id
+        try:
+            ## {ircode_id: {remote_type: {action: {key: code}}}}, or without
+            ## the ircode_id level when --ircode-id is given
+            added = None
+            if os.path.isdir(source):
+                codes = self.read_directory(source)
+                if not ircode_id:
+                    ## a new ircode only once every file is read
+                    ircode_id = added = self._get_colref().document().id
+                ircodes = { ircode_id: codes }
+            else:
+                with open(source, 'r') as fd:
+                    ircodes = json.load(fd)
+                if ircode_id:
+                    ircodes = { ircode_id: ircodes }
+            actions = []
+            for iid, remote_types in ircodes.items():
+                for remote_type, remote_actions in remote_types.items():
+                    for action, values in remote_actions.items():
+                        docref = self.getIrcodeReference(iid).collection(remote_type).document(self.action_name(action))
+                        actions.append((docref, { str(k): v for k, v in values.items() }))
+            ## the ircode documents are written with their actions, so that
+            ## add_remote_code --ircode-id finds them
+            parents = [ (self.getIrcodeReference(iid), {}) for iid in ircodes ]
+            writes = parents + actions
+            if args.compact:
+                ## blobs are written before the actions refering them
+                blobs = {}
+                for i, (docref, values) in enumerate(actions):
+                    values, action_blobs = self.compactCodes(values)
+                    actions[i] = (docref, values)
+                    blobs.update(action_blobs)
+                writes = self._new_blobs(blobs) + parents + actions
+            commits = 0
+            for i in range(0, len(writes), self.maxBatchSize):
+                batch = self.client.batch()
+                for docref, values in writes[i:i + self.maxBatchSize]:
+                    batch.set(docref, values, merge=True)
+                batch.commit()
+                commits += 1
+        except:
+            (t, e) = sys.exc_info()[:2]
+            sys.stderr.write(str(e) + "\n")
+            sys.exit(1)
+        if added:
+            sys.stdout.write("{} was added\n".format(self.collectionRootPath + '/' + added))
+        for docref, values in actions:
+            sys.stdout.write("{} was added ({} codes)\n".format(docref.path, len(values)))
+        sys.stdout.write("{} codes for {} actions in {} commits\n".format(sum(len(v) for _, v in actions), len(actions), commits))
+        return
+
 class DelRemoteCode(Ircode):
     arguments = (
         ('--ircode-id',     { 'type': str,    'required': True }),
@@ -496,7 +2170,7 @@ class DelRemoteCode(Ircode):
         remote_type = args.remote_type
         remotecode_action = args.action
         try:
-            colref = self.getIrcodeReference(ircode_id, True).collection(remote_type)
+            colref = self.getIrcodeReference(ircode_id).collection(remote_type)
             docref = colref.document(remotecode_action)
             if(not docref.get().exists):
                 return
@@ -513,19 +2187,117 @@ class DelRemoteCode(Ircode):
             sys.exit(1)
         return
 
+class DelIrcode(Ircode):
+    arguments = (
+        ('--ircode-id',     { 'type': list,   'required': True }),
+    ) + BaseCollection.cascadeArguments
+    def run(self, args=object):
+        ircode_ids = args.ircode_id
+        if args.cascade or args.dry_run:
+            self._cascade(ircode_ids, args.dry_run)
+            return
+        for ircode_id in ircode_ids:
+            self._del(ircode_id)
+        return
+
+class MigrateRemoteCode(Ircode):
+    arguments = (
+        ('--ircode-id',     { 'type': list,   'required': False }),
+        ('--expand',        { 'type': bool,   'required': False }),
+        ('--dry-run',       { 'type': bool,   'required': False }),
+    )
+    def actions(self, ircode_ids):
+        ## every action document of the ircodes
+        for ircode_id in ircode_ids:
+            for colref in self.getIrcodeReference(ircode_id).collections():
+                for docsnap in colref.stream():
+                    yield docsnap
+    def sizes(self, docsnaps, docdatas, expanded):
+        ## (bytes stored by the actions and their blobs, bytes read per command,
+        ## the same once the executor has cached the blobs)
+        blobs = {}
+        stored = 0
+        read = 0
+        cached = 0
+        codes = 0
+        for docsnap, docdata, codedata in zip(docsnaps, docdatas, expanded):
+            size = self._document_size(docsnap.reference.path, docdata)
+            stored += size
+            for k, v in docdata.items():
+                codes += 1
+                read += size
+                cached += size
+                if self._is_reference(v):
+                    blobref, blobdata = self._code_blob(codedata[k])
+                    blobs[v.path] = self._document_size(v.path, blobdata)
+                    read += blobs[v.path]
+        return stored + sum(blobs.values()), read / codes if codes else 0, cached / codes if codes else 0
+    def run(self, args=object):
+        ircode_ids = args.ircode_id or [ docref.id for docref in self._get_colref().list_documents() ]
+        docsnaps = list(self.actions(ircode_ids))
+        current = [ docsnap.to_dict() or {} for docsnap in docsnaps ]
+        expanded = self.expandCodes(current)
+        ## an action referencing a missing blob is left as it is
+        missing = []
+        for docsnap, docdata, codedata in zip(docsnaps, current, expanded):
+            for k, v in docdata.items():
+                if self._is_reference(v) and codedata[k] is None:
+                    missing.append(docsnap)
+                    sys.stderr.write("{}.{}: {} does not exist\n".format(docsnap.reference.path, k, v.path))
+        if missing:
+            rows = [ row for row in zip(docsnaps, current, expanded) if row[0] not in missing ]
+            docsnaps, current, expanded = [ [ row[i] for row in rows ] for i in range(3) ]
+        blobs = {}
+        if args.expand:
+            target = expanded
+        else:
+            target = []
+            for docdata in expanded:
+                values, action_blobs = self.compactCodes(docdata)
+                target.append(values)
+                blobs.update(action_blobs)
+        before = self.sizes(docsnaps, current, expanded)
+        after = self.sizes(docsnaps, target, expanded)
+        distinct = set(v for docdata in expanded for v in docdata.values())
+        sys.stdout.write("{} actions, {} codes, {} distinct\n".format(len(docsnaps), sum(len(docdata) for docdata in expanded), len(distinct)))
+        sys.stdout.write("stored: {} bytes -> {} bytes\n".format(before[0], after[0]))
+        sys.stdout.write("read per command: {:.0f} bytes -> {:.0f} bytes ({:.0f} bytes with cached blobs)\n".format(before[1], after[1], after[2]))
+        writes = self._new_blobs(blobs) if blobs else []
+        writes += [ (docsnap.reference, docdata) for docsnap, docdata, old in zip(docsnaps, target, current) if docdata != old ]
+        if args.dry_run:
+            sys.stdout.write("{} documents would be written\n".format(len(writes)))
+        else:
+            batch = self.client.batch()
+            for docref, docdata in writes:
+                batch.set(docref, docdata)
+                if len(batch) >= ImportRemoteCode.maxBatchSize:
+                    batch.commit()
+                    batch = self.client.batch()
+            if len(batch):
+                batch.commit()
+            sys.stdout.write("{} documents written\n".format(len(writes)))
+        if missing:
+            sys.stderr.write("{} actions skipped, their code blob is missing\n".format(len(missing)))
+            sys.exit(1)
+        return
+
 class GetUser(User):
+    summaryFields = ('name',)
     arguments = (
         ('--user-id',       { 'type': str,    'required': False }),
         ('--full',          { 'type': bool,   'required': False }),
-    )
+    ) + BaseCollection.listArguments
     def run(self, args=object):
         user_id = args.user_id
         show_full = args.full
-        for user in self._get(user_id):
+        summary = {} if show_full else { 'fields': self.summaryFields, 'resolve': False }
+        for user in self._get(user_id, **summary, **self._list_options(args)):
             for u in user:
                 user_id = u['id']
                 del u['id']
-                if show_full:
+                if self.outputFormat == 'jsonl':
+                    self._print_jsonl(user_id, u)
+                elif show_full:
                     pprint.pprint({user_id: u})
                 else:
                     user_name = u['name']
@@ -537,16 +2309,20 @@ class AddUser(User):
     arguments = (
         ('--name',          { 'type': str,    'required': False }),
     )
-    def run(self, args=object):
-        user_name = args.name
+    def docdata(self, user_name=None):
         docdata = {}
         if user_name:
             docdata['name'] = user_name
+        return docdata
+    def run(self, args=object):
+        docdata = self.docdata(args.name)
         docref = self._add(docdata)
         try:
             update_time = docref.update({ 'id': docref.id })
             if update_time is None:
                 raise ValueError('id update failed')
+            ## an empty index document, the user has no groups yet
+            self._get_colref(UserGroup.collectionRootPath).document(docref.id).set({}, merge=True)
         except:
             (t, e) = sys.exc_info()[:2]
             sys.stderr.write(str(e) + "\n")
@@ -555,26 +2331,36 @@ class AddUser(User):
 
 class DelUser(User):
     arguments = (
-        ('--user-id',       { 'type': str,    'required': True }),
-    )
+        ('--user-id',       { 'type': list,   'required': True }),
+    ) + BaseCollection.cascadeArguments
     def run(self, args=object):
-        user_id = args.user_id
-        self._del(user_id)
+        user_ids = args.user_id
+        if args.cascade or args.dry_run:
+            self._cascade(user_ids, args.dry_run)
+            return
+        for user_id in user_ids:
+            ## the user_groups index of the user goes with it
+            self._del(user_id, [ self._get_colref(UserGroup.collectionRootPath).document(user_id) ])
+            self.requestSync(user_id)
         return
 
 class GetGroup(Group):
     arguments = (
         ('--group-id',      { 'type': str,    'required': False }),
         ('--full',          { 'type': bool,   'required': False }),
-    )
+    ) + BaseCollection.listArguments
     def run(self, args=object):
         group_id = args.group_id
         show_full = args.full
-        for group in self._get(group_id):
+        ## members are the field names, the referenced users are not needed
+        summary = {} if show_full else { 'resolve': False }
+        for group in self._get(group_id, **summary, **self._list_options(args)):
             for g in group:
                 group_id = g['id']
                 del g['id']
-                if show_full:
+                if self.outputFormat == 'jsonl':
+                    self._print_jsonl(group_id, g)
+                elif show_full:
                     pprint.pprint({group_id: g})
                 else:
                     print(group_id)
@@ -586,44 +2372,61 @@ class AddGroup(Group):
     arguments = (
         ('--user-id',       { 'type': list,    'required': True }),
     )
-    def run(self, args=object):
-        user_ids = args.user_id
+    def docdata(self, user_ids):
         docdata = {}
         if user_ids:
             for user_id in user_ids:
-                userref = self.getUserReference(user_id)
-                if userref is None:
-                    continue
-                docdata[user_id] = userref
-        self._add(docdata)
+                docdata[user_id] = self.getUserReference(user_id)
+        return docdata
+    def run(self, args=object):
+        docdata = self.docdata(args.user_id)
+        self.checkReferences(docdata.values())
+        docref = self._add(docdata)
+        self._write_user_groups(self._user_groups_writes(docref.id, added=docdata.keys()))
         return
 
 class DelGroup(Group):
     arguments = (
-        ('--group-id',      { 'type': str,    'required': True }),
-    )
+        ('--group-id',      { 'type': list,   'required': True }),
+    ) + BaseCollection.cascadeArguments
     def run(self, args=object):
-        group_id = args.group_id
-        self._del(group_id)
+        group_ids = args.group_id
+        if args.cascade or args.dry_run:
+            self._cascade(group_ids, args.dry_run)
+            return
+        for group_id in group_ids:
+            docsnap = self._del(group_id)
+            members = (docsnap.to_dict() or {}).keys()
+            self._write_user_groups(self._user_groups_writes(group_id, removed=members))
+            for user_id in members:
+                self.requestSync(user_id)
         return
 
 class GetUserDevice(UserDevice):
+    summaryFields = ('deviceId', 'remoteId', 'name')
     arguments = (
         ('--user-device-id',    { 'type': str,      'required': False }),
         ('--user-id',           { 'type': str,      'required': False }),
+        ('--device-id',         { 'type': str,      'required': False }),
+        ('--remote-id',         { 'type': str,      'required': False }),
         ('--full',              { 'type': bool,     'required': False }),
-    )
+    ) + BaseCollection.listArguments
     def run(self, args=object):
         user_device_id = args.user_device_id
-        user_id = args.user_id
         show_full = args.full
-        for udevice in self._get(user_device_id):
+        filters = {
+            'userId': args.user_id,
+            'deviceId': args.device_id,
+            'remoteId': args.remote_id,
+        }
+        summary = {} if show_full else { 'fields': self.summaryFields, 'resolve': False }
+        for udevice in self._get(user_device_id, filters, **summary, **self._list_options(args)):
             for ud in udevice:
                 user_device_id = ud['id']
                 del ud['id']
-                if user_id and user_id not in ud:
-                    continue
-                if show_full:
+                if self.outputFormat == 'jsonl':
+                    self._print_jsonl(user_device_id, ud)
+                elif show_full:
                     print({user_device_id: ud})
                 else:
                     device_id = ud['deviceId']
@@ -640,14 +2443,10 @@ class AddUserDevice(UserDevice):
         ('--remote-id',     { 'type': str,    'required': True }),
         ('--name',          { 'type': str,    'required': False }),
     )
-    def run(self, args=object):
-        device_id = args.device_id
-        user_id = args.user_id
-        remote_id = args.remote_id
-        user_device_name = args.name
-        deviceReference = self.getDeviceReference(device_id, True)
-        userReference  = self.getUserReference(user_id, True)
-        remoteReference = self.getRemoteReference(remote_id, True)
+    def docdata(self, device_id, user_id, remote_id, user_device_name=None):
+        deviceReference = self.getDeviceReference(device_id)
+        userReference  = self.getUserReference(user_id)
+        remoteReference = self.getRemoteReference(remote_id)
         docdata = {
             'deviceId': device_id,
             'userId' : user_id,
@@ -658,6 +2457,11 @@ class AddUserDevice(UserDevice):
         }
         if user_device_name:
             docdata['name'] = user_device_name
+        return docdata
+    def run(self, args=object):
+        user_id = args.user_id
+        docdata = self.docdata(args.device_id, user_id, args.remote_id, args.name)
+        self.checkReferences(docdata.values())
         self._add(docdata)
         self.requestSync(user_id)
         return
@@ -668,26 +2472,35 @@ class DelUserDevice(UserDevice):
     )
     def run(self, args=object):
         user_device_id = args.user_device_id
-        self._del(user_device_id)
+        docsnap = self._del(user_device_id)
+        self.requestSync(docsnap.get('userId'))
         return
 
 class GetGroupDevice(GroupDevice):
+    summaryFields = ('deviceId', 'remoteId', 'name')
     arguments = (
         ('--group-device-id',   { 'type': str,      'required': False }),
         ('--group-id',          { 'type': str,      'required': False }),
+        ('--device-id',         { 'type': str,      'required': False }),
+        ('--remote-id',         { 'type': str,      'required': False }),
         ('--full',              { 'type': bool,     'required': False }),
-    )
+    ) + BaseCollection.listArguments
     def run(self, args=object):
         group_device_id = args.group_device_id
-        group_id = args.group_id
         show_full = args.full
-        for gdevice in self._get(group_device_id):
+        filters = {
+            'groupId': args.group_id,
+            'deviceId': args.device_id,
+            'remoteId': args.remote_id,
+        }
+        summary = {} if show_full else { 'fields': self.summaryFields, 'resolve': False }
+        for gdevice in self._get(group_device_id, filters, **summary, **self._list_options(args)):
             for gd in gdevice:
                 group_device_id = gd['id']
                 del gd['id']
-                if group_id and group_id not in gd:
-                    continue
-                if show_full:
+                if self.outputFormat == 'jsonl':
+                    self._print_jsonl(group_device_id, gd)
+                elif show_full:
                     print({group_device_id: gd})
                 else:
                     device_id = gd['deviceId']
@@ -704,13 +2517,10 @@ class AddGroupDevice(GroupDevice):
         ('--remote-id',     { 'type': str,    'required': True }),
         ('--name',          { 'type': str,    'required': False }),
     )
-    def run(self, args=object):
-        device_id = args.device_id
-        group_id  = args.group_id
-        remote_id = args.remote_id
-        device_reference = self.getDeviceReference(device_id, True)
-        group_reference  = self.getGroupReference(group_id, True)
-        remote_reference = self.getRemoteReference(remote_id, True)
+    def docdata(self, device_id, group_id, remote_id, group_device_name=None):
+        device_reference = self.getDeviceReference(device_id)
+        group_reference  = self.getGroupReference(group_id)
+        remote_reference = self.getRemoteReference(remote_id)
         docdata = {
             'deviceId': device_id,
             'groupId' : group_id,
@@ -719,12 +2529,16 @@ class AddGroupDevice(GroupDevice):
             'groupReference' : group_reference,
             'remoteReference': remote_reference,
         }
-        group_device_name = args.name
         if group_device_name:
             docdata['name'] = group_device_name
+        return docdata
+    def run(self, args=object):
+        docdata = self.docdata(args.device_id, args.group_id, args.remote_id, args.name)
+        ## the group snapshot read by the check also gives the members
+        docsnaps = self.checkReferences(docdata.values())
+        members = list((docsnaps[docdata['groupReference'].path].to_dict() or {}).keys())
         self._add(docdata)
-        for grp_docsnap in group_reference.get():
-            user_id = grp_docsnap.id
+        for user_id in members:
             self.requestSync(user_id)
         return
 
@@ -734,68 +2548,872 @@ class DelGroupDevice(GroupDevice):
     )
     def run(self, args=object):
         group_device_id = args.group_device_id
-        self._del(group_device_id)
+        docsnap = self._del(group_device_id)
+        for members in self.getGroupMembers([docsnap.get('groupId')]).values():
+            for user_id in members:
+                self.requestSync(user_id)
         return
 
-def get_client(serviceAccountKeyFile=None):
-    default_serviceAccountKeyFile = os.path.join(os.getcwd(), 'serviceAccountKey.json')
-    if(serviceAccountKeyFile is None):
-        serviceAccountKeyFile = default_serviceAccountKeyFile
-    cred = credentials.Certificate(serviceAccountKeyFile)
-    cert_cred = cred.get_credential()
-    app = firebase_admin.initialize_app(cred)
-    return firestore.client(app)
+class BuildSync(UserSync):
+    arguments = (
+        ('--user-id',       { 'type': list,   'required': False }),
+    )
+    def run(self, args=object):
+        ## every user and every SYNC document left by a deleted user
+        user_ids = args.user_id
+        if not user_ids:
+            user_ids = sorted(set(docref.id for docref in self._get_colref(User.collectionRootPath).list_documents())
+                | set(docref.id for docref in self._get_colref().list_documents()))
+        start = time.perf_counter()
+        built = 0
+        for i in range(0, len(user_ids), self.syncBatchSize):
+            built += len(self.buildSync(user_ids[i:i + self.syncBatchSize]))
+            if len(user_ids) > self.syncBatchSize:
+                sys.stderr.write("{}/{} users\n".format(min(i + self.syncBatchSize, len(user_ids)), len(user_ids)))
+        sys.stdout.write("{} SYNC documents built, {} removed in {:.2f}s\n".format(built, len(user_ids) - built, time.perf_counter() - start))
+        return
 
-def get_apikey(apiKeyFile=None):
-    default_apiKeyFile = os.path.join(os.getcwd(), 'apikey.txt')
-    if(apiKeyFile is None):
-        apiKeyFile = default_apiKeyFile
-    apikey = None
-    apikey_length = 12
-    try:
-        with open(apiKeyFile, 'r') as fd:
-            apikey = fd.read(apikey_length)
-        return apikey
-    except:
-        (t, e) = sys.exc_info()[:2]
-        return None
+class GetUserGroups(UserGroup):
+    arguments = (
+        ('--user-id',       { 'type': str,    'required': True }),
+    ) + BaseCollection.formatArguments + BaseCollection.snapshotArguments
+    def run(self, args=object):
+        user_id = args.user_id
+        self._list_options(args)
+        group_ids = self.getUserGroups([user_id])[user_id]
+        if self.outputFormat == 'jsonl':
+            self._print_jsonl(user_id, { 'groups': group_ids })
+        else:
+            for group_id in group_ids:
+                print(group_id)
+        return
 
-if __name__ == '__main__':
-    mode_class = {
-        'get_device': GetDevice,
-        'get_device_attr': GetDeviceAttribute,
-        'get_remote': GetRemote,
-        'get_remote_code': GetRemoteCode,
-        'get_user': GetUser,
-        'get_group': GetGroup,
-        'get_user_device': GetUserDevice,
-        'get_group_device': GetGroupDevice,
-        'add_device': AddDevice,
-        'add_device_attr': AddDeviceAttribute,
-        'add_remote': AddRemote,
-        'add_remote_code': AddRemoteCode,
-        'add_user': AddUser,
-        'add_group': AddGroup,
-        'add_user_device': AddUserDevice,
-        'add_group_device': AddGroupDevice,
-        'del_device': DelDevice,
-        'del_device_attr': DelDeviceAttribute,
-        'del_remote': DelRemote,
-        'del_remote_code': DelRemoteCode,
-        'del_user': DelUser,
-        'del_group': DelGroup,
-        'del_user_device': DelUserDevice,
-        'del_group_device': DelGroupDevice,
+class BuildUserGroups(UserGroup):
+    arguments = (
+        ('--verify',        { 'type': bool,   'required': False }),
+    )
+    def run(self, args=object):
+        ## the index expected from every group, one document per user
+        expected = { docref.id: {} for docref in self._get_colref(User.collectionRootPath).list_documents() }
+        for docsnap in self._get_colref(Group.collectionRootPath).stream():
+            for user_id, userReference in (docsnap.to_dict() or {}).items():
+                expected.setdefault(user_id, {})[docsnap.id] = self.getGroupReference(docsnap.id)
+        actual = { docsnap.id: set((docsnap.to_dict() or {}).keys()) for docsnap in self._get_colref().stream() }
+        writes = []
+        removes = []
+        for user_id in sorted(set(expected) | set(actual)):
+            path = self.collectionRootPath + '/' + user_id
+            if user_id not in expected:
+                sys.stdout.write("{} has no user\n".format(path))
+                removes.append(user_id)
+            elif user_id not in actual:
+                sys.stdout.write("{} is missing\n".format(path))
+                writes.append(user_id)
+            elif set(expected[user_id]) != actual[user_id]:
+                sys.stdout.write("{} differs: missing {}, stale {}\n".format(path,
+                    sorted(set(expected[user_id]) - actual[user_id]), sorted(actual[user_id] - set(expected[user_id]))))
+                writes.append(user_id)
+        if args.verify:
+            sys.stdout.write("{} users checked, {} inconsistent\n".format(len(expected), len(writes) + len(removes)))
+            if writes or removes:
+                sys.exit(1)
+            return
+        batch = self.client.batch()
+        for user_id in writes + removes:
+            if user_id in expected:
+                batch.set(self._get_colref().document(user_id), expected[user_id])
+            else:
+                batch.delete(self._get_colref().document(user_id))
+            if len(batch) >= self.syncBatchSize:
+                batch.commit()
+                batch = self.client.batch()
+        if len(batch):
+            batch.commit()
+        self._invalidate([ self.collectionRootPath + '/' + user_id for user_id in writes + removes ])
+        sys.stdout.write("{} user_groups documents written, {} removed\n".format(len(writes), len(removes)))
+        return
+
+class Import(BaseCollection):
+    arguments = (
+        ('--file',          { 'type': str,    'required': True }),
+        ('--format',        { 'type': str,    'required': False, 'choices': ('jsonl', 'csv') }),
+        ('--batch-size',    { 'type': int,    'required': False, 'default': 500 }),
+        ('--bulk-writer',   { 'type': bool,   'required': False }),
+    )
+    ## kind: (command class, keys refering another record)
+    importKinds = {
+        'device':       (AddDevice, ()),
+        'remote':       (AddRemote, ()),
+        'user':         (AddUser, ()),
+        'group':        (AddGroup, ('user_id',)),
+        'user_device':  (AddUserDevice, ('device_id', 'user_id', 'remote_id')),
+        'group_device': (AddGroupDevice, ('device_id', 'group_id', 'remote_id')),
+    }
+    requiredKeys = {
+        'device':       ('manufacturer', 'model', 'traits', 'type'),
+        'remote':       ('mac_addr',),
+        'user':         (),
+        'group':        ('user_id',),
+        'user_device':  ('device_id', 'user_id', 'remote_id'),
+        'group_device': ('device_id', 'group_id', 'remote_id'),
+    }
+    listKeys = {
+        'device':       ('traits',),
+        'group':        ('user_id',),
     }
+    maxBatchSize = 500
+    def read_records(self, fd, file_format):
+        if file_format == 'csv':
+            for record in csv.DictReader(fd):
+                record = { k: v for k, v in record.items() if k and v not in (None, '') }
+                for k in self.listKeys.get(record.get('kind'), ()):
+                    if k in record:
+                        record[k] = [ v.strip() for v in record[k].split(';') if v.strip() ]
+                if 'report_state' in record:
+                    record['report_state'] = record['report_state'].lower() in ('1', 'true', 'yes')
+                yield record
+        else:
+            for line in fd:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                yield json.loads(line)
+    def check(self, record):
+        ## errors of the record found without any RPC
+        kind = record.get('kind')
+        if kind not in self.importKinds:
+            return [ '{} is not a known kind'.format(kind) ]
+        errors = [ '{} record without {}'.format(kind, k) for k in self.requiredKeys[kind] if k not in record ]
+        if kind == 'device' and not errors:
+            errors = get_schema_registry().device(record)
+        return errors
+    def check_records(self, records):
+        ## (lineno, record) of the valid records, the errors are written to stderr
+        self.checked = self.invalid = 0
+        for lineno, record in records:
+            self.checked += 1
+            errors = self.check(record)
+            if errors:
+                self.invalid += 1
+                for error in errors:
+                    sys.stderr.write("record {}: {}\n".format(lineno, error))
+            else:
+                yield lineno, record
+    def resolve(self, value):
+        if isinstance(value, list):
+            return [ self.resolve(v) for v in value ]
+        return self.labels.get(value, value)
+    def build(self, record):
+        kind = record.get('kind')
+        if kind not in self.importKinds:
+            raise ValueError('{} is not a known kind'.format(kind))
+        command_class, link_keys = self.importKinds[kind]
+        command = command_class(self.client, self.apikey, self.dispatcher, self.engine, self.cache)
+        record = dict(record)
+        for k in link_keys:
+            if k in record:
+                record[k] = self.resolve(record[k])
+        if kind == 'device':
+            docdata = command.docdata(record['manufacturer'], record['model'], record['traits'], record['type'], record.get('report_state', False), record.get('name'))
+        elif kind == 'remote':
+            docdata = command.docdata(record['mac_addr'], record.get('remote_type', record.get('type')), record.get('name'))
+        elif kind == 'user':
+            docdata = command.docdata(record.get('name'))
+        elif kind == 'group':
+            docdata = command.docdata(record['user_id'])
+        elif kind == 'user_device':
+            docdata = command.docdata(record['device_id'], record['user_id'], record['remote_id'], record.get('name'))
+        else:
+            docdata = command.docdata(record['device_id'], record['group_id'], record['remote_id'], record.get('name'))
+        docref = command._get_colref().document()
+        if kind == 'user':
+            docdata['id'] = docref.id
+        if 'ref' in record:
+            self.labels[record['ref']] = docref.id
+        return kind, docref, docdata
+    def commit(self, writer):
+        if self.bulk_writer:
+            writer.flush()
+            return writer
+        if len(writer):
+            writer.commit()
+            self.commits += 1
+        return self.client.batch()
+    def run(self, args=object):
+        file_format = args.format
+        if file_format is None:
+            file_format = 'csv' if args.file.lower().endswith('.csv') else 'jsonl'
+        batch_size = min(args.batch_size, self.maxBatchSize)
+        self.bulk_writer = args.bulk_writer
+        self.labels = {}
+        self.commits = 0
+        counts = {}
+        group_members = {}
+        sync_users = set()
+        sync_groups = set()
+        start = time.perf_counter()
+        records = []
+        lineno = 0
+        try:
+            with open(args.file, 'r', newline='') as fd:
+                for lineno, record in self.check_records(enumerate(self.read_records(fd, file_format), 1)):
+                    records.append(self.build(record))
+        except:
+            (t, e) = sys.exc_info()[:2]
+            sys.stderr.write("record {}: {}\n".format(lineno, e))
+            sys.exit(1)
+        if self.invalid:
+            sys.exit(1)
+        ## every link to a document outside the file is checked in one
+        ## get_all before the first write
+        created = set(docref.path for kind, docref, docdata in records)
+        missing, docsnaps = self._missing_references((v for kind, docref, docdata in records for v in docdata.values()), created)
+        if missing:
+            missing = set(missing)
+            for lineno, (kind, docref, docdata) in enumerate(records, 1):
+                for v in docdata.values():
+                    if self._is_reference(v) and v.path in missing:
+                        sys.stderr.write("record {}: {}\n".format(lineno, self._reference_error(v.path)))
+            sys.exit(1)
+        writer = self.client.bulk_writer() if self.bulk_writer else self.client.batch()
+        pending = 0
+        lineno = 0
+        try:
+            for kind, docref, docdata in records:
+                lineno += 1
+                writer.create(docref, docdata)
+                pending += 1
+                counts[kind] = counts.get(kind, 0) + 1
+                if kind == 'group':
+                    group_members[docref.id] = [ k for k in docdata ]
+                elif kind == 'user_device':
+                    sync_users.add(docdata['userId'])
+                elif kind == 'group_device':
+                    sync_groups.add(docdata['groupId'])
+                if pending >= batch_size:
+                    writer = self.commit(writer)
+                    pending = 0
+            writer = self.commit(writer)
+            if self.bulk_writer:
+                writer.close()
+        except:
+            (t, e) = sys.exc_info()[:2]
+            sys.stderr.write("record {}: {}\n".format(lineno, e))
+            sys.exit(1)
+        ## user_groups index of the imported users and groups
+        index_writes = [ (self._get_colref(UserGroup.collectionRootPath).document(docref.id), {}) for kind, docref, docdata in records if kind == 'user' ]
+        for group_id, members in group_members.items():
+            index_writes += self._user_groups_writes(group_id, added=members)
+        self._write_user_groups(index_writes)
+        elapsed = time.perf_counter() - start
+        total = sum(counts.values())
+        for path, docsnap in docsnaps.items():
+            if path.startswith(Group.collectionRootPath + '/'):
+                group_members[docsnap.id] = list((docsnap.to_dict() or {}).keys())
+        for group_id, members in self.getGroupMembers(sync_groups - set(group_members)).items():
+            group_members[group_id] = members
+        for group_id in sync_groups:
+            sync_users.update(group_members.get(group_id, []))
+        for user_id in sorted(sync_users):
+            self.requestSync(user_id)
+        sys.stdout.write("imported {total} documents ({kinds}) in {elapsed:.2f}s, {rate:.0f} docs/s, {commits}\n".format(
+            total=total, kinds=', '.join('{} {}'.format(v, k) for k, v in sorted(counts.items())),
+            elapsed=elapsed, rate=total / elapsed if elapsed else 0,
+            commits='bulk writer' if self.bulk_writer else '{} commits'.format(self.commits)))
+        return
 
-    client = get_client()
-    apikey = get_apikey()
+class Apply(Import):
+    arguments = (
+        ('--file',          { 'type': str,    'required': True }),
+        ('--format',        { 'type': str,    'required': False, 'choices': ('jsonl', 'csv') }),
+        ('--prune',         { 'type': bool,   'required': False }),
+        ('--compact',       { 'type': bool,   'required': False }),
+        ('--dry-run',       { 'type': bool,   'required': False }),
+    )
+    ## the records of import with an explicit "id", plus
+    ## {"kind": "ircode", "id": ..., "codes": {remote_type: {action: {key: code}}}}
+    ## devices may have "attributes", user/group devices an "ircode_id"
+    def build(self, record):
+        if 'id' not in record:
+            raise ValueError('{} record without id'.format(record.get('kind')))
+        document_id = str(record['id'])
+        if record.get('kind') == 'ircode':
+            return self.build_ircode(document_id, record.get('codes') or {})
+        kind, docref, docdata = Import.build(self, record)
+        docref = self._get_colref(docref.path.rsplit('/', 1)[0]).document(document_id)
+        if kind == 'user':
+            docdata['id'] = document_id
+        elif kind == 'device' and record.get('attributes'):
+            docdata['attributes'] = record['attributes']
+        elif kind in ('user_device', 'group_device') and record.get('ircode_id'):
+            docdata['ircodeId'] = record['ircode_id']
+            docdata['ircodeReference'] = self.getIrcodeReference(record['ircode_id'])
+        return [ (kind, docref, docdata) ]
+    def check(self, record):
+        if record.get('kind') != 'ircode':
+            return Import.check(self, record)
+        ## codes: {remote_type: {action: {key: code}}}
+        codes = record.get('codes') or {}
+        if not isinstance(codes, dict) or not all(isinstance(actions, dict) and all(isinstance(values, dict) and all(isinstance(v, str) for v in values.values()) for values in actions.values()) for actions in codes.values()):
+            return [ 'codes of ircode {} is not {{remote_type: {{action: {{key: code}}}}}}'.format(record.get('id')) ]
+        return []
+    def build_ircode(self, ircode_id, codes):
+        ircodeReference = self.getIrcodeReference(ircode_id)
+        documents = [ ('ircode', ircodeReference, {}) ]
+        for remote_type, actions in codes.items():
+            for action, values in actions.items():
+                values = { str(k): v for k, v in values.items() }
+                if self.compact:
+                    values, blobs = self.compactCodes(values)
+                    self.blobs.update(blobs)
+                docref = ircodeReference.collection(remote_type).document(ImportRemoteCode.action_name(self, action))
+                documents.append(('ircode_action', docref, values))
+        return documents
+    def prune(self, desired):
+        ## documents of the declared kinds missing from the file
+        deletes = {}
+        collectionPaths = set(docref.path.rsplit('/', 1)[0] for kind, docref, docdata in desired.values() if kind != 'ircode_action')
+        for collectionPath in sorted(collectionPaths):
+            for docref in self._get_colref(collectionPath).list_documents():
+                if docref.path in desired:
+                    continue
+                for child in self._subtree(docref):
+                    deletes.setdefault(child.path, (self.kindOf(child.path), child))
+        for kind, docref, docdata in list(desired.values()):
+            if kind != 'ircode':
+                continue
+            for child in self._subtree(docref):
+                if child.path not in desired:
+                    deletes.setdefault(child.path, ('ircode_action', child))
+        return deletes
+    def kindOf(self, path):
+        collectionPath = path.rsplit('/', 1)[0]
+        for kind, (command_class, link_keys) in self.importKinds.items():
+            if command_class.collectionRootPath == collectionPath:
+                return kind
+        return 'ircode' if collectionPath == Ircode.collectionRootPath else 'ircode_action'
+    def affected(self, kind, docdata, groups, users):
+        ## users whose SYNC response depends on the document
+        if docdata is None:
+            return
+        if kind == 'user_device':
+            users.add(docdata.get('userId'))
+        elif kind == 'group_device':
+            groups.add(docdata.get('groupId'))
+        elif kind == 'group':
+            users.update(docdata.keys())
+    def run(self, args=object):
+        file_format = args.format
+        if file_format is None:
+            file_format = 'csv' if args.file.lower().endswith('.csv') else 'jsonl'
+        self.labels = {}
+        self.compact = args.compact
+        self.blobs = {}
+        start = time.perf_counter()
+        desired = {}
+        lineno = 0
+        try:
+            with open(args.file, 'r', newline='') as fd:
+                for lineno, record in self.check_records(enumerate(self.read_records(fd, file_format), 1)):
+                    for kind, docref, docdata in self.build(record):
+                        if docref.path in desired:
+                            raise ValueError('{} is declared twice'.format(docref.path))
+                        desired[docref.path] = (kind, docref, docdata)
+        except:
+            (t, e) = sys.exc_info()[:2]
+            sys.stderr.write("record {}: {}\n".format(lineno, e))
+            sys.exit(1)
+        if self.invalid:
+            sys.exit(1)
+        missing, docsnaps = self._missing_references((v for kind, docref, docdata in desired.values() for v in docdata.values()), set(desired) | set(self.blobs))
+        if missing:
+            for path in missing:
+                sys.stderr.write(self._reference_error(path) + "\n")
+            sys.exit(1)
+        ## the current state in one bulk read, bypassing the local cache
+        current = { docsnap.reference.path: docsnap.to_dict() if docsnap.exists else None for docsnap in self._get_all([ docref for kind, docref, docdata in desired.values() ], fromCache=False) }
+        ## references compare by path, whatever client made them
+        import snapshot
+        changes = [ (kind, docref, docdata, current[path]) for path, (kind, docref, docdata) in desired.items()
+            if current[path] is None or snapshot.encode(current[path], self._is_reference) != snapshot.encode(docdata, self._is_reference) ]
+        deletes = self.prune(desired) if args.prune else {}
+        blob_writes = self._new_blobs(self.blobs) if self.blobs else []
+        created = sum(1 for kind, docref, docdata, old in changes if old is None)
+        summary = "{} created, {} updated, {} deleted, {} unchanged".format(created, len(changes) - created, len(deletes), len(desired) - len(changes))
+        if args.dry_run:
+            for kind, docref, docdata, old in changes:
+                sys.stdout.write("{} would be {}\n".format(docref.path, 'created' if old is None else 'updated'))
+            for path in deletes:
+                sys.stdout.write("{} would be deleted\n".format(path))
+            sys.stdout.write(summary + "\n")
+            return
+        ## users to requestSync, from the documents before and after the change
+        devices = set(docref.id for kind, docref, docdata, old in changes if kind == 'device' and old is not None)
+        devices.update(docref.id for path, (kind, docref) in deletes.items() if kind == 'device')
+        groups = set()
+        users = self.getDeviceUsers(devices) if devices else set()
+        ## _get_all returns the cached snapshots first, so pair them by path
+        deleted = { docsnap.reference.path: docsnap.to_dict() for docsnap in self._get_all([ docref for kind, docref in deletes.values() ]) } if deletes else {}
+        index_writes = []
+        for kind, docref, docdata, old in changes:
+            self.affected(kind, docdata, groups, users)
+            self.affected(kind, old, groups, users)
+            if kind == 'group':
+                new_members, old_members = set(docdata), set(old or {})
+                index_writes += self._user_groups_writes(docref.id, added=new_members - old_members, removed=old_members - new_members)
+            elif kind == 'user' and old is None:
+                index_writes.append((self._get_colref(UserGroup.collectionRootPath).document(docref.id), {}))
+        for path, (kind, docref) in deletes.items():
+            self.affected(kind, deleted.get(path), groups, users)
+            if kind == 'group':
+                index_writes += self._user_groups_writes(docref.id, removed=(deleted.get(path) or {}).keys())
+            elif kind == 'user':
+                users.add(docref.id)
+                index_writes.append((self._get_colref(UserGroup.collectionRootPath).document(docref.id), None))
+        ## members of the groups of the changed group devices, before the groups are written
+        for members in self.getGroupMembers(groups).values():
+            users.update(members)
+        batch = self.client.batch()
+        commits = 0
+        writes = blob_writes + [ (docref, docdata) for kind, docref, docdata, old in changes ] + [ (docref, None) for kind, docref in deletes.values() ]
+        for docref, docdata in writes:
+            if docdata is None:
+                batch.delete(docref)
+            else:
+                batch.set(docref, docdata)
+            if len(batch) >= self.maxBatchSize:
+                batch.commit()
+                commits += 1
+                batch = self.client.batch()
+        for docref, docdata in index_writes:
+            if docdata is None:
+                batch.delete(docref)
+            else:
+                batch.set(docref, docdata, merge=True)
+            if len(batch) >= self.maxBatchSize:
+                batch.commit()
+                commits += 1
+                batch = self.client.batch()
+        if len(batch):
+            batch.commit()
+            commits += 1
+        self._invalidate([ docref.path for docref, docdata in writes ])
+        for user_id in sorted(u for u in users if u):
+            self.requestSync(user_id)
+        sys.stdout.write("{} in {} commits, {:.2f}s\n".format(summary, commits, time.perf_counter() - start))
+        return
+
+class Validate(Apply):
+    ## the records of import/apply and the states of report_state --states,
+    ## checked locally without connecting to Firestore
+    arguments = (
+        ('--file',          { 'type': str,    'required': False }),
+        ('--format',        { 'type': str,    'required': False, 'choices': ('jsonl', 'csv') }),
+        ('--states',        { 'type': str,    'required': False }),
+    )
+    def check_states(self, fd):
+        validator = get_schema_registry().states()
+        for lineno, line in enumerate(fd, 1):
+            if not line.strip():
+                continue
+            self.checked += 1
+            record = json.loads(line)
+            errors = validator(record.get('state'), 'states/{}'.format(record.get('id')))
+            if errors:
+                self.invalid += 1
+                for error in errors:
+                    sys.stderr.write("record {}: {}\n".format(lineno, error))
+    def run(self, args=object):
+        if not args.file and not args.states:
+            sys.stderr.write("--file or --states is required\n")
+            sys.exit(1)
+        start = time.perf_counter()
+        checked = invalid = 0
+        try:
+            if args.file:
+                file_format = args.format
+                if file_format is None:
+                    file_format = 'csv' if args.file.lower().endswith('.csv') else 'jsonl'
+                with open(args.file, 'r', newline='') as fd:
+                    for lineno, record in self.check_records(enumerate(self.read_records(fd, file_format), 1)):
+                        pass
+                checked += self.checked
+                invalid += self.invalid
+            if args.states:
+                self.checked = self.invalid = 0
+                with open(args.states, 'r') as fd:
+                    self.check_states(fd)
+                checked += self.checked
+                invalid += self.invalid
+        except:
+            (t, e) = sys.exc_info()[:2]
+            sys.stderr.write(str(e) + "\n")
+            sys.exit(1)
+        sys.stdout.write("{} records, {} invalid in {:.2f}s\n".format(checked, invalid, time.perf_counter() - start))
+        if invalid:
+            sys.exit(1)
+        return
+
+class Export(BaseCollection):
+    arguments = (
+        ('--snapshot',      { 'type': str,    'required': True }),
+        ('--collection',    { 'type': list,   'required': False }),
+    )
+    exportCollections = ('devices', 'remotes', 'users', 'groups', 'user_devices', 'group_devices', 'ircodes', 'ircode_blobs', 'user_groups')
+    ## documents of these collections have subcollections,
+    ## ircodes/{id}/{remote_type} and devices/{id}/{remote_type}
+    nestedCollections = ('ircodes', 'devices')
+    progressInterval = 10000
+    def export(self, writer, colref, nested):
+        count = 0
+        for docsnap in self._stream(colref):
+            writer.add(docsnap)
+            count += 1
+            if writer.count % self.progressInterval == 0:
+                sys.stderr.write("{} documents\n".format(writer.count))
+        if nested:
+            ## parents of subcollections do not have to exist
+            for docref in colref.list_documents():
+                for subcolref in docref.collections():
+                    count += self.export(writer, subcolref, True)
+        return count
+    def run(self, args=object):
+        import snapshot
+        collections = args.collection or self.exportCollections
+        start = time.perf_counter()
+        writer = snapshot.Writer(args.snapshot, self._is_reference)
+        counts = {}
+        try:
+            for collection in collections:
+                counts[collection] = self.export(writer, self._get_colref(collection), collection in self.nestedCollections)
+            writer.close({ 'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'collections': counts })
+        except:
+            (t, e) = sys.exc_info()[:2]
+            sys.stderr.write(str(e) + "\n")
+            sys.exit(1)
+        elapsed = time.perf_counter() - start
+        sys.stdout.write("exported {total} documents ({kinds}) to {file} in {elapsed:.2f}s, {size} bytes\n".format(
+            total=writer.count, kinds=', '.join('{} {}'.format(v, k) for k, v in counts.items()),
+            file=args.snapshot, elapsed=elapsed, size=os.path.getsize(args.snapshot)))
+        return
+
+class Restore(BaseCollection):
+    arguments = (
+        ('--snapshot',      { 'type': str,    'required': True }),
+        ('--collection',    { 'type': list,   'required': False }),
+        ('--batch-size',    { 'type': int,    'required': False, 'default': 500 }),
+    )
+    maxBatchSize = 500
+    def run(self, args=object):
+        import snapshot
+        batch_size = min(args.batch_size, self.maxBatchSize)
+        source = snapshot.Client(args.snapshot)
+        collections = args.collection
+        start = time.perf_counter()
+        count = 0
+        users = []
+        batch = self.client.batch()
+        try:
+            for path, docdata in source.documents(self.client.document):
+                if collections and path.split('/', 1)[0] not in collections:
+                    continue
+                batch.set(self.client.document(path), docdata)
+                self._invalidate([path])
+                count += 1
+                if path.startswith(User.collectionRootPath + '/') and path.count('/') == 1:
+                    users.append(path.split('/', 1)[1])
+                if len(batch) >= batch_size:
+                    batch.commit()
+                    batch = self.client.batch()
+                if count % Export.progressInterval == 0:
+                    sys.stderr.write("{} documents\n".format(count))
+            if len(batch):
+                batch.commit()
+        except:
+            (t, e) = sys.exc_info()[:2]
+            sys.stderr.write(str(e) + "\n")
+            sys.exit(1)
+        finally:
+            source.close()
+        elapsed = time.perf_counter() - start
+        for user_id in users:
+            self.requestSync(user_id)
+        sys.stdout.write("restored {} documents from {} in {:.2f}s\n".format(count, args.snapshot, elapsed))
+        return
+
+class ReportState(BaseCollection):
+    arguments = (
+        ('--database-url',  { 'type': str,    'required': False }),
+        ('--states',        { 'type': str,    'required': False }),
+        ('--window',        { 'type': float,  'required': False, 'default': 1.0 }),
+    )
+    ## seconds the users of a personal device are reused before read again
+    agentUsersTtl = 300
+    def agentUsers(self, personal_id):
+        ## users seeing the personal device, through its user_devices or group_devices row
+        now = time.monotonic()
+        cached = self.agents.get(personal_id)
+        if cached and now - cached[1] < self.agentUsersTtl:
+            return cached[0]
+        users = set()
+        references = [ self._get_colref(collectionPath).document(personal_id) for collectionPath in (UserDevice.collectionRootPath, GroupDevice.collectionRootPath) ]
+        for docsnap in self._get_all(references):
+            docdata = docsnap.to_dict() or {}
+            if 'userId' in docdata:
+                users.add(docdata['userId'])
+            if 'groupId' in docdata:
+                for members in self.getGroupMembers([docdata['groupId']]).values():
+                    users.update(members)
+        self.agents[personal_id] = (sorted(users), now)
+        return self.agents[personal_id][0]
+    def update(self, personal_id, state):
+        ## an invalid state is dropped before the users are read
+        errors = get_schema_registry().states()(state, 'states/' + personal_id)
+        if errors:
+            self.invalid += 1
+            for error in errors:
+                sys.stderr.write(error + "\n")
+            return
+        for user_id in self.agentUsers(personal_id):
+            self.publisher.report(user_id, personal_id, state)
+    def read_states(self, filename):
+        ## JSON lines {"id": personalDeviceId, "state": {...}}, - for stdin
+        fd = sys.stdin if filename == '-' else open(filename, 'r')
+        try:
+            for line in fd:
+                if line.strip():
+                    record = json.loads(line)
+                    self.update(record['id'], record['state'])
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+    def on_state_event(self, event):
+        ## event of the listener on states, the path is relative to it
+        path = [ p for p in event.path.split('/') if p ]
+        if event.data is None:
+            return
+        if not path:
+            ## the first event is the current states, not a change
+            if event.event_type == 'patch':
+                for personal_id, state in event.data.items():
+                    self.update(personal_id, state)
+            return
+        ## a change below the device, e.g. /ud1/color/name, as {color: {name: data}}
+        state = event.data
+        for key in reversed(path[1:]):
+            state = { key: state }
+        self.update(path[0], state)
+    def listen_states(self, url):
+        ## states/{personalDeviceId} of the Realtime Database, until interrupted
+        self.client
+        app = getattr(get_backend(), 'app', None)
+        if app is None:
+            sys.stderr.write("report_state --database-url requires the Firebase backend\n")
+            sys.exit(1)
+        from firebase_admin import db
+        listener = db.reference('states', app=app, url=url).listen(self.on_state_event)
+        try:
+            while True:
+                time.sleep(3600)
+        finally:
+            listener.close()
+    def run(self, args=object):
+        if not args.states and not args.database_url:
+            sys.stderr.write("--database-url or --states is required\n")
+            sys.exit(1)
+        self.agents = {}
+        self.invalid = 0
+        self.publisher = ReportStatePublisher(args.homegraph_url, self.apikey, args.sync_concurrency, args.window)
+        try:
+            if args.states:
+                self.read_states(args.states)
+            else:
+                self.listen_states(args.database_url)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.publisher.close()
+        if self.invalid or self.publisher.failed:
+            return 1
+        return
+
+class Shell(BaseCollection):
+    arguments = (
+        ('--listen',        { 'type': str,    'required': False }),
+        ('--quiet',         { 'type': bool,   'required': False }),
+    )
+    prompt = 'client.py> '
+    exitCommands = ('exit', 'quit')
+    def execute(self, line, parser):
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as e:
+            sys.stderr.write(str(e) + "\n")
+            return 1
+        if not argv:
+            return None
+        if argv[0] == 'shell':
+            sys.stderr.write("shell cannot be nested\n")
+            return 1
+        start = time.perf_counter()
+        try:
+            status = run_command(self._client, self.apikey, argv, parser, self.dispatcher, self.engine, self.cache)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception as e:
+            sys.stderr.write(str(e) + "\n")
+            status = 1
+        elapsed = (time.perf_counter() - start) * 1000
+        self.latencies.append(elapsed)
+        if status:
+            self.failures += 1
+        if not self.quiet:
+            cached = ''
+            if self.cache is not None:
+                cached = " cache {}/{}".format(*self.cache.counters())
+            sys.stderr.write("# {mode} {elapsed:.1f}ms exit={status}{cached}\n".format(mode=argv[0], elapsed=elapsed, status=status, cached=cached))
+        return status
+    def interact(self, rfile, parser, prompt=None):
+        while True:
+            if prompt:
+                sys.stderr.write(prompt)
+                sys.stderr.flush()
+            line = rfile.readline()
+            if not line:
+                break
+            if line.strip() in self.exitCommands:
+                break
+            self.execute(line, parser)
+            sys.stdout.flush()
+            sys.stderr.flush()
+    def serve(self, listen, parser):
+        shell = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                wfile = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+                rfile = io.TextIOWrapper(self.rfile, encoding='utf-8')
+                with contextlib.redirect_stdout(wfile), contextlib.redirect_stderr(wfile):
+                    shell.interact(rfile, parser)
+        ## a unix socket only: the server runs any sub-command with the
+        ## shell's credentials, so it is not offered over TCP and the socket
+        ## is created readable and writable by its owner alone
+        if os.path.exists(listen):
+            os.unlink(listen)
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.UnixStreamServer(listen, Handler)
+        finally:
+            os.umask(umask)
+        sys.stderr.write("listening on {}\n".format(listen))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if os.path.exists(listen):
+                os.unlink(listen)
+    def summary(self):
+        if not self.latencies:
+            return
+        latencies = sorted(self.latencies)
+        sys.stderr.write("# {count} commands, total {total:.1f}ms, mean {mean:.1f}ms, p50 {p50:.1f}ms, max {max:.1f}ms\n".format(
+            count=len(latencies), total=sum(latencies), mean=sum(latencies) / len(latencies),
+            p50=latencies[len(latencies) // 2], max=latencies[-1]))
+    def run(self, args=object):
+        self.latencies = []
+        self.failures = 0
+        self.quiet = args.quiet
+        parser = build_parser()
+        if self.cache is not None:
+            ## cached documents stay current while the shell runs
+            self.cache.listen(self.client, self._is_reference)
+        if args.listen:
+            self.serve(args.listen, parser)
+        else:
+            prompt = self.prompt if sys.stdin.isatty() else None
+            try:
+                self.interact(sys.stdin, parser, prompt)
+            except KeyboardInterrupt:
+                sys.stderr.write("\n")
+        self.summary()
+        ## a batch of commands fails if one of them failed
+        if self.failures:
+            return 1
+        return
+
+mode_class = {
+    'get_device': GetDevice,
+    'get_device_attr': GetDeviceAttribute,
+    'get_remote': GetRemote,
+    'get_remote_code': GetRemoteCode,
+    'get_user': GetUser,
+    'get_group': GetGroup,
+    'get_user_device': GetUserDevice,
+    'get_group_device': GetGroupDevice,
+    'add_device': AddDevice,
+    'add_device_attr': AddDeviceAttribute,
+    'add_remote': AddRemote,
+    'add_remote_code': AddRemoteCode,
+    'import_remote_code': ImportRemoteCode,
+    'add_user': AddUser,
+    'add_group': AddGroup,
+    'add_user_device': AddUserDevice,
+    'add_group_device': AddGroupDevice,
+    'del_device': DelDevice,
+    'del_device_attr': DelDeviceAttribute,
+    'del_remote': DelRemote,
+    'del_remote_code': DelRemoteCode,
+    'del_ircode': DelIrcode,
+    'migrate_remote_code': MigrateRemoteCode,
+    'del_user': DelUser,
+    'del_group': DelGroup,
+    'del_user_device': DelUserDevice,
+    'del_group_device': DelGroupDevice,
+    'build_sync': BuildSync,
+    'get_user_groups': GetUserGroups,
+    'build_user_groups': BuildUserGroups,
+    'import': Import,
+    'apply': Apply,
+    'validate': Validate,
+    'export': Export,
+    'restore': Restore,
+    'report_state': ReportState,
+    'shell': Shell,
+}
+
+## build_parser(only=ALL_MODES) gives every sub-command its options
+ALL_MODES = object()
+
+def build_parser(only=ALL_MODES):
+    ## with only, the other sub-commands get no options (they are not parsed),
+    ## only=None (no sub-command on the command line) gives options to none
     p = argparse.ArgumentParser()
+    p.add_argument('--backend', type=str, default=os.environ.get('CLIENT_BACKEND', 'firestore'), choices=('firestore', 'memory'))
+    p.add_argument('--memory-latency', type=float, default=0.0)
+    p.add_argument('--memory-file', type=str)
+    p.add_argument('--homegraph-url', type=str, default=os.environ.get('HOMEGRAPH_URL', BaseCollection.baseUrl))
+    p.add_argument('--sync-concurrency', type=int, default=4)
+    p.add_argument('--engine', type=str, default=os.environ.get('CLIENT_ENGINE', 'sync'), choices=('sync', 'async'))
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--cache', type=str, default=os.environ.get('CLIENT_CACHE'))
+    p.add_argument('--cache-size', type=int, default=10000)
+    p.add_argument('--cache-ttl', type=float, default=300)
+    p.add_argument('--sync-debounce', type=float, default=0.5)
+    p.add_argument('--write-rate', type=float, default=WriteGovernor.initialRate)
+    p.add_argument('--max-write-rate', type=float)
+    p.add_argument('--document-write-interval', type=float, default=WriteGovernor.documentInterval)
+    p.add_argument('--profile', action='store_true')
+    p.add_argument('--profile-format', type=str, default='text', choices=('text', 'json'))
+    p.add_argument('--profile-output', type=str)
     subp = p.add_subparsers(help='sub-command help', dest='mode')
     for k, v in mode_class.items():
         pp = subp.add_parser(k, help='see `{} -h`'.format(k))
+        if only is not ALL_MODES and k != only:
+            continue
         for vv in v.arguments:
             args, kwargs = vv
+            kwargs = dict(kwargs)
             opt_type = None
             if 'type' in kwargs:
                 opt_type = kwargs['type']
@@ -808,10 +3426,186 @@ if __name__ == '__main__':
                 pp.add_argument(args, **kwargs, action='store_true')
             else:
                 pp.add_argument(args, **kwargs, type=opt_type)
-    args = p.parse_args()
+    return p
+
+def run_command(client, apikey, argv=None, parser=None, dispatcher=None, engine=None, cache=None):
+    if parser is None:
+        if argv is None:
+            argv = sys.argv[1:]
+        parser = build_parser(next((a for a in argv if a in mode_class), None))
+    args = parser.parse_args(argv)
     if(not args.mode):
-        p.print_help(sys.stderr)
-        sys.exit(255)
-    c = mode_class[args.mode](client, apikey)
-    c.run(args)
-    sys.exit(0)
+        parser.print_help(sys.stderr)
+        return 255
+    own_dispatcher = dispatcher is None
+    if own_dispatcher:
+        dispatcher = RequestSyncDispatcher(args.homegraph_url, apikey, args.sync_concurrency, args.sync_debounce)
+        if args.backend == 'memory':
+            set_backend(MemoryBackend(args.memory_latency / 1000, args.memory_file))
+        if args.engine == 'async':
+            engine = AsyncEngine(get_backend(), args.concurrency, BaseCollection.getAllChunkSize)
+        if args.cache:
+            cache = DocumentCache(args.cache, args.cache_size, args.cache_ttl)
+    governor = None
+    if isinstance(client, GovernedClient):
+        ## a command of the shell shares the governor of the shell
+        client, governor = client._wrapped_object, client._governor
+    own_governor = governor is None
+    if own_governor:
+        governor = WriteGovernor(args.write_rate, args.max_write_rate, args.document_write_interval)
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        client = ProfiledClient(client, profiler)
+        dispatcher.profiler = profiler
+    if engine is not None and isinstance(client, ProfiledClient):
+        ## the async engine reports into the profiler of the client
+        engine.profiler = client._profiler
+    client = GovernedClient(client, governor)
+    try:
+        c = mode_class[args.mode](client, apikey, dispatcher, engine, cache)
+        status = c.run(args)
+        c.commitSync()
+    finally:
+        if own_governor:
+            governor.close()
+        if own_dispatcher:
+            dispatcher.close()
+            if engine is not None:
+                engine.close()
+            if cache is not None:
+                cache.close()
+            get_backend().close()
+        if profiler:
+            if args.profile_output:
+                with open(args.profile_output, 'w') as fd:
+                    profiler.report(args.profile_format, fd)
+            else:
+                profiler.report(args.profile_format)
+    return status or 0
+
+class FirestoreBackend(object):
+    name = 'firestore'
+    def __init__(self, serviceAccountKeyFile=None):
+        self.serviceAccountKeyFile = serviceAccountKeyFile
+        self.app = None
+    def client(self):
+        import firebase_admin
+        from firebase_admin import credentials,firestore
+        serviceAccountKeyFile = self.serviceAccountKeyFile
+        default_serviceAccountKeyFile = os.path.join(os.getcwd(), 'serviceAccountKey.json')
+        if(serviceAccountKeyFile is None):
+            serviceAccountKeyFile = default_serviceAccountKeyFile
+        if self.app is None:
+            ## initialize_app fails for a second default app
+            cred = credentials.Certificate(serviceAccountKeyFile)
+            cert_cred = cred.get_credential()
+            self.app = firebase_admin.initialize_app(cred)
+        return firestore.client(self.app)
+    def async_client(self):
+        from firebase_admin import firestore_async
+        if self.app is None:
+            get_client()
+        return firestore_async.client(self.app)
+    def delete_field(self):
+        from firebase_admin import firestore
+        return firestore.DELETE_FIELD
+    def reference_types(self):
+        from firebase_admin import firestore
+        from google.cloud.firestore import AsyncDocumentReference
+        return (firestore.DocumentReference, AsyncDocumentReference)
+    def close(self):
+        return
+
+class MemoryBackend(object):
+    ## sample/memstore.py, optionally loaded from and saved back to a JSON file
+    name = 'memory'
+    def __init__(self, latency=0.0, dataFile=None):
+        self.latency = latency
+        self.dataFile = dataFile
+        self._client = None
+    def client(self):
+        import memstore
+        if self._client is None:
+            self._client = memstore.Client(latency=self.latency)
+            if self.dataFile and os.path.exists(self.dataFile):
+                with open(self.dataFile, 'r') as fd:
+                    self._client.load(json.load(fd))
+        return self._client
+    def async_client(self):
+        import memstore
+        return memstore.AsyncClient(self.client())
+    def delete_field(self):
+        import memstore
+        return memstore.DELETE_FIELD
+    def reference_types(self):
+        import memstore
+        return (memstore.DocumentReference,)
+    def close(self):
+        if self._client is None or not self.dataFile:
+            return
+        ## written next to the file and renamed over it, a failed dump keeps the old file
+        import tempfile
+        tmpfd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.dataFile)), prefix='.' + os.path.basename(self.dataFile) + '.')
+        try:
+            with os.fdopen(tmpfd, 'w') as fd:
+                json.dump(self._client.dump(), fd, ensure_ascii=False, indent=1)
+            os.replace(tmpname, self.dataFile)
+        except:
+            os.unlink(tmpname)
+            raise
+
+_backend = None
+_client = None
+_referenceTypes = None
+_schemaRegistry = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = FirestoreBackend()
+    return _backend
+
+def set_backend(backend):
+    global _backend, _client, _referenceTypes
+    _backend = backend
+    _client = None
+    _referenceTypes = None
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = get_backend().client()
+    return _client
+
+def get_reference_types():
+    global _referenceTypes
+    if _referenceTypes is None:
+        _referenceTypes = get_backend().reference_types()
+    return _referenceTypes
+
+def get_schema_registry():
+    ## validators of sample/schema.py, compiled on first use
+    global _schemaRegistry
+    if _schemaRegistry is None:
+        import schema
+        _schemaRegistry = schema.Registry(DEVICE_TRAITS, DEVICE_TYPES, DEVICE_TRAITS_PREFIX, DEVICE_TYPES_PREFIX)
+    return _schemaRegistry
+
+def get_apikey(apiKeyFile=None):
+    default_apiKeyFile = os.path.join(os.getcwd(), 'apikey.txt')
+    if(apiKeyFile is None):
+        apiKeyFile = default_apiKeyFile
+    apikey = None
+    apikey_length = 12
+    try:
+        with open(apiKeyFile, 'r') as fd:
+            apikey = fd.read(apikey_length)
+        return apikey
+    except:
+        (t, e) = sys.exc_info()[:2]
+        return None
+
+if __name__ == '__main__':
+    apikey = get_apikey()
+    sys.exit(run_command(None, apikey))
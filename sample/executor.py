@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+## Command executor for the Broadlink remotes, the Python counterpart of
+## sample/index.js. The personal device (user_devices/group_devices) ->
+## remote -> ircode mapping is read once and kept current with on_snapshot
+## listeners, so a command written to `commands/{personalDeviceId}` of the
+## Realtime Database is resolved without any Firestore read. The latency
+## from receiving a command to the end of its sending is recorded.
+## The transmitter is pluggable: `broadlink` (python-broadlink), `stub`
+## (prints the codes) or `<module>:<class>` with a send(mac_addr, code) method.
+import os, sys
+import argparse
+import importlib
+import json
+import queue
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import client
+
+PERSONAL_COLLECTIONS = (client.GroupDevice.collectionRootPath, client.UserDevice.collectionRootPath)
+
+def convert_action(state, command, params):
+    ## key of the learned code, same as convert_actions() of sample/index.js
+    if command == client.DEVICE_COMMANDS_PREFIX + 'OnOff':
+        return 'on' if params.get('on') is True else 'off'
+    if command == client.DEVICE_COMMANDS_PREFIX + 'BrightnessAbsolute':
+        now = state.get('brightness')
+        return '0' if now is not None and params.get('brightness') < now else '100'
+    return params if isinstance(params, str) else None
+
+def percentiles(values, points=(50, 90, 99)):
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    result = { 'p{}'.format(p): ordered[min(len(ordered) - 1, len(ordered) * p // 100)] for p in points }
+    result['max'] = ordered[-1]
+    return result
+
+class DeviceMap(object):
+    ## personal devices, remotes and the actions of the ircodes they use, in memory
+    def __init__(self, db, timeout=5.0):
+        self.db = db
+        self.timeout = timeout
+        self.collection = client.BaseCollection(db)
+        self.lock = threading.RLock()
+        self.personal = { name: {} for name in PERSONAL_COLLECTIONS }
+        self.remotes = {}
+        ## (ircode_id, remote_type) -> {action: {key: hex code}}
+        self.actions = {}
+        self.loaded = {}
+        self.blobs = {}
+        self.watches = []
+        self.ready = { name: threading.Event() for name in PERSONAL_COLLECTIONS + (client.Remote.collectionRootPath,) }
+    def start(self):
+        for name in PERSONAL_COLLECTIONS:
+            self.watches.append(self.db.collection(name).on_snapshot(self._on_rows(name)))
+        self.watches.append(self.db.collection(client.Remote.collectionRootPath).on_snapshot(self._on_remotes))
+        for event in self.ready.values():
+            event.wait(self.timeout)
+        with self.lock:
+            events = list(self.loaded.values())
+        for event in events:
+            event.wait(self.timeout)
+    def close(self):
+        for watch in self.watches:
+            watch.unsubscribe()
+        self.watches = []
+    def _on_rows(self, name):
+        def on_snapshot(docsnaps, changes, read_time):
+            with self.lock:
+                for change in changes:
+                    if change.type.name == 'REMOVED':
+                        self.personal[name].pop(change.document.id, None)
+                    else:
+                        self.personal[name][change.document.id] = change.document.to_dict()
+            self._watch_ircodes()
+            self.ready[name].set()
+        return on_snapshot
+    def _on_remotes(self, docsnaps, changes, read_time):
+        with self.lock:
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self.remotes.pop(change.document.id, None)
+                else:
+                    self.remotes[change.document.id] = change.document.to_dict()
+        self._watch_ircodes()
+        self.ready[client.Remote.collectionRootPath].set()
+    def _ircode(self, row):
+        ## (ircode_id, remote_type) of a personal device, None while its remote is unknown
+        ircode_id = row['ircodeReference'].id if row.get('ircodeReference') else row.get('ircodeId')
+        remote_id = row['remoteReference'].id if row.get('remoteReference') else row.get('remoteId')
+        remote = self.remotes.get(remote_id)
+        if not ircode_id or not remote:
+            return None
+        return (ircode_id, remote.get('type'))
+    def _watch_ircodes(self):
+        ## one listener per action collection in use, ircodes/{ircode_id}/{remote_type}
+        with self.lock:
+            pairs = set(self._ircode(row) for rows in self.personal.values() for row in rows.values())
+            pairs = [ pair for pair in pairs if pair and pair not in self.loaded ]
+            for pair in pairs:
+                self.loaded[pair] = threading.Event()
+                self.actions[pair] = {}
+        for pair in pairs:
+            colref = self.db.collection(client.Ircode.collectionRootPath, pair[0], pair[1])
+            self.watches.append(colref.on_snapshot(self._on_actions(pair)))
+    def _expand(self, docdata):
+        ## blobs are read when the action is loaded, never on the command path
+        missing = { v.path: v for v in docdata.values() if self.collection._is_reference(v) and v.path not in self.blobs }
+        if missing:
+            self.blobs.update(self.collection.expandCodes([missing])[0])
+        return { k: self.blobs.get(v.path) if self.collection._is_reference(v) else v for k, v in docdata.items() }
+    def _on_actions(self, pair):
+        def on_snapshot(docsnaps, changes, read_time):
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    codes = None
+                else:
+                    codes = self._expand(change.document.to_dict() or {})
+                with self.lock:
+                    if codes is None:
+                        self.actions[pair].pop(change.document.id, None)
+                    else:
+                        self.actions[pair][change.document.id] = codes
+            self.loaded[pair].set()
+        return on_snapshot
+    def resolve(self, personal_id):
+        ## (remote, actions) of a personal device, from memory
+        with self.lock:
+            rows = [ self.personal[name][personal_id] for name in PERSONAL_COLLECTIONS if personal_id in self.personal[name] ]
+            if not rows:
+                raise LookupError('control device cannot detect {}'.format(personal_id))
+            if len(rows) > 1:
+                raise LookupError('data consistency error {}'.format(personal_id))
+            pair = self._ircode(rows[0])
+            if pair is None:
+                raise LookupError('data consistency error {}'.format(personal_id))
+            remote_id = rows[0]['remoteReference'].id if rows[0].get('remoteReference') else rows[0].get('remoteId')
+            remote = self.remotes[remote_id]
+            loaded = self.loaded[pair]
+        ## a device added a moment ago waits for the first snapshot of its ircode
+        if not loaded.wait(self.timeout):
+            raise LookupError('ircodes/{}/{} is not loaded'.format(*pair))
+        with self.lock:
+            return remote, self.actions[pair]
+
+class RealtimeDatabaseSource(object):
+    ## commands/{personalDeviceId} and states/{personalDeviceId} of the Realtime Database
+    def __init__(self, url):
+        self.url = url
+        self.states = {}
+        self.listener = None
+    def _ref(self, path):
+        from firebase_admin import db
+        client.get_client()
+        return db.reference(path, app=client.get_backend().app, url=self.url)
+    def start(self, submit):
+        self.states = self._ref('states').get() or {}
+        def on_event(event):
+            received = time.perf_counter()
+            path = event.path.strip('/')
+            if event.data is None or '/' in path:
+                return
+            if not path:
+                for personal_id, commands in event.data.items():
+                    if commands:
+                        submit(personal_id, commands, received)
+            else:
+                submit(path, event.data, received)
+        self.listener = self._ref('commands').listen(on_event)
+    def wait(self):
+        ## runs until interrupted
+        while True:
+            time.sleep(3600)
+    def state(self, personal_id):
+        return self.states.get(personal_id) or {}
+    def set_state(self, personal_id, params):
+        self.states.setdefault(personal_id, {}).update(params)
+        if params:
+            self._ref('states/' + personal_id).update(params)
+    def done(self, personal_id):
+        self._ref('commands/' + personal_id).delete()
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+
+class LineSource(object):
+    ## JSON lines {"id": personalDeviceId, "commands": [{"command": ..., "params": ...}]}
+    ## from a file or stdin ('-'), states are kept in memory
+    def __init__(self, filename):
+        self.filename = filename
+        self.states = {}
+        self.thread = None
+    def start(self, submit):
+        def read():
+            fd = sys.stdin if self.filename == '-' else open(self.filename, 'r')
+            try:
+                for line in fd:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    submit(record['id'], record['commands'], time.perf_counter())
+            finally:
+                if fd is not sys.stdin:
+                    fd.close()
+        self.thread = threading.Thread(target=read, daemon=True)
+        self.thread.start()
+    def wait(self):
+        self.thread.join()
+    def state(self, personal_id):
+        return self.states.get(personal_id) or {}
+    def set_state(self, personal_id, params):
+        self.states.setdefault(personal_id, {}).update(params)
+    def done(self, personal_id):
+        return
+    def close(self):
+        return
+
+class StubTransmitter(object):
+    ## prints the codes instead of sending them, delay simulates the hardware
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = 0
+    def send(self, mac_addr, code):
+        if self.delay:
+            time.sleep(self.delay)
+        self.sent += 1
+        sys.stdout.write("sendto {} {}\n".format(mac_addr, code))
+        sys.stdout.flush()
+
+class BroadlinkTransmitter(object):
+    ## python-broadlink (pip install broadlink), devices discovered on the LAN
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.devices = {}
+    def _device(self, mac_addr):
+        mac_addr = str(mac_addr).lower()
+        if mac_addr not in self.devices:
+            import broadlink
+            for device in broadlink.discover(timeout=self.timeout):
+                device.auth()
+                self.devices[':'.join('{:02x}'.format(b) for b in device.mac)] = device
+        if mac_addr not in self.devices:
+            raise LookupError('{} is not found'.format(mac_addr))
+        return self.devices[mac_addr]
+    def send(self, mac_addr, code):
+        self._device(mac_addr).send_data(bytes.fromhex(code))
+
+def load_transmitter(spec, delay=0.0):
+    if spec == 'stub':
+        return StubTransmitter(delay)
+    if spec == 'broadlink':
+        return BroadlinkTransmitter()
+    module_name, _, class_name = spec.partition(':')
+    if not class_name:
+        raise ValueError('transmitter {} is not <module>:<class>'.format(spec))
+    return getattr(importlib.import_module(module_name), class_name)()
+
+class Executor(object):
+    ## commands are executed one by one in arrival order by a worker thread
+    def __init__(self, devices, source, transmitter):
+        self.devices = devices
+        self.source = source
+        self.transmitter = transmitter
+        self.queue = queue.Queue()
+        self.latencies = []
+        self.resolves = []
+        self.failed = 0
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+    def submit(self, personal_id, commands, received):
+        self.queue.put((personal_id, commands, received))
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.execute(*item)
+    def execute(self, personal_id, commands, received):
+        try:
+            start = time.perf_counter()
+            remote, actions = self.devices.resolve(personal_id)
+            self.resolves.append(time.perf_counter() - start)
+            codes = []
+            for cmd in commands:
+                key = convert_action(self.source.state(personal_id), cmd.get('command'), cmd.get('params') or {})
+                code = actions.get(cmd.get('command'), {}).get(key)
+                if code:
+                    codes.append(code)
+            for code in codes:
+                self.transmitter.send(remote['mac_addr'], code)
+            self.latencies.append(time.perf_counter() - received)
+            for cmd in commands:
+                sys.stderr.write("CommandsFinished: {} {}\n".format(personal_id, cmd.get('params')))
+                self.source.set_state(personal_id, cmd.get('params') or {})
+        except Exception as e:
+            self.failed += 1
+            sys.stderr.write("{}\n".format(e))
+        finally:
+            self.source.done(personal_id)
+    def close(self):
+        ## the queued commands are executed first
+        self.queue.put(None)
+        self.worker.join()
+    def stats(self):
+        return {
+            'commands': len(self.latencies) + self.failed,
+            'failed': self.failed,
+            'latency_ms': { k: round(v * 1000, 3) for k, v in percentiles(self.latencies).items() },
+            'resolve_ms': { k: round(v * 1000, 3) for k, v in percentiles(self.resolves).items() },
+        }
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--backend', type=str, default=os.environ.get('CLIENT_BACKEND', 'firestore'), choices=('firestore', 'memory'))
+    p.add_argument('--memory-file', type=str)
+    p.add_argument('--database-url', type=str, default=os.environ.get('FIREBASE_DATABASE_URL'), help='Realtime Database of the commands')
+    p.add_argument('--commands', type=str, help='read the commands from a JSON lines file (- for stdin) instead of the Realtime Database')
+    p.add_argument('--transmitter', type=str, default='broadlink', help='broadlink, stub or <module>:<class>')
+    p.add_argument('--send-delay', type=float, default=0.0, help='seconds per code of the stub transmitter')
+    p.add_argument('--timeout', type=float, default=5.0)
+    p.add_argument('--stats-output', type=str)
+    args = p.parse_args()
+
+    if args.backend == 'memory':
+        client.set_backend(client.MemoryBackend(dataFile=args.memory_file))
+    if args.commands:
+        source = LineSource(args.commands)
+    elif args.database_url:
+        source = RealtimeDatabaseSource(args.database_url)
+    else:
+        p.error('--database-url or --commands is required')
+    transmitter = load_transmitter(args.transmitter, args.send_delay)
+    devices = DeviceMap(client.get_client(), args.timeout)
+    start = time.perf_counter()
+    devices.start()
+    sys.stderr.write("loaded {} devices, {} remotes, {} ircodes in {:.2f}s\n".format(
+        sum(len(rows) for rows in devices.personal.values()), len(devices.remotes), len(devices.actions), time.perf_counter() - start))
+    executor = Executor(devices, source, transmitter)
+    try:
+        source.start(executor.submit)
+        source.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.close()
+        source.close()
+        devices.close()
+    stats = executor.stats()
+    latency = ' '.join('{} {:.2f}ms'.format(k, v) for k, v in stats['latency_ms'].items())
+    sys.stderr.write("executed {} commands ({} failed), command to send {}\n".format(stats['commands'], stats['failed'], latency or '-'))
+    if args.stats_output:
+        with open(args.stats_output, 'w') as fd:
+            fd.write(json.dumps(stats, indent=2, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main()
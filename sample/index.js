@@ -2,6 +2,7 @@
 const admin = require('./firebase.admin').admin;
 const Model = require('./firebase.admin').Model;
 const broadlink = require('./getDevice');
+const zlib = require('zlib');
 const DEBUG = true;
 const convert_actions = (nowState, actionType, actionParam) => {
     const now = nowState.data;
@@ -18,6 +19,27 @@ const convert_actions = (nowState, actionType, actionParam) => {
     }
 }
 
+// learned codes stored with `client.py add_remote_code --compact` are references
+// to ircode_blobs/{sha256}, the blobs never change and are kept once read.
+const codeBlobs = new Map();
+const read_code = (code) => {
+    if(!code || typeof code === 'string') {
+        return Promise.resolve(code);
+    }
+    if(codeBlobs.has(code.path)) {
+        return Promise.resolve(codeBlobs.get(code.path));
+    }
+    return code.get().then((blobDocsnap) => {
+        const blob = blobDocsnap.data();
+        if(!blob) {
+            return undefined;
+        }
+        const hex = (blob.encoding === 'zlib' ? zlib.inflateSync(blob.data) : Buffer.from(blob.data)).toString('hex');
+        codeBlobs.set(code.path, hex);
+        return hex;
+    });
+};
+
 const broadlink_commander = (macaddr, commands=[]) => {
     return new Promise((resolve, reject) => {
         macaddr = String(macaddr).toLowerCase();
@@ -67,7 +89,7 @@ admin.database().ref('commands').on('child_added', (snap) => {
                 deviceCommandPromises.push(remoteCommand.doc(cmd.command).get().then((remoteCommandDocsnap) => {
                     const cmddata = remoteCommandDocsnap.data();
                     if(cmddata[cmdkey]) {
-                        return cmddata[cmdkey];
+                        return read_code(cmddata[cmdkey]);
                     }
                 }));
             });
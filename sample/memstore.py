@@ -0,0 +1,743 @@
+#!/usr/bin/env python3
+## In-memory stand-in for the google-cloud-firestore Client used by client.py.
+## Only the API surface client.py relies on is implemented: collections,
+## subcollections, DocumentReference fields, add/set/update/delete,
+## where/select/order_by/limit/cursors, get_all, WriteBatch, BulkWriter and
+## on_snapshot. Every RPC sleeps Store.latency seconds and is counted.
+import bisect
+import concurrent.futures
+import datetime
+import itertools
+import random
+import string
+import threading
+import time
+
+DOCUMENT_ID = '__name__'
+
+class _Sentinel(object):
+    def __init__(self, description):
+        self.description = description
+    def __repr__(self):
+        return 'Sentinel: {}'.format(self.description)
+
+## field value of update() that removes the field
+DELETE_FIELD = _Sentinel('Value used to delete a field in a document.')
+
+class AlreadyExists(Exception):
+    pass
+
+class NotFound(Exception):
+    pass
+
+class InvalidArgument(Exception):
+    pass
+
+class ResourceExhausted(Exception):
+    pass
+
+class Aborted(Exception):
+    pass
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def _auto_id():
+    chars = string.ascii_letters + string.digits
+    return ''.join(random.choice(chars) for _ in range(20))
+
+def _get_nested(data, field_path):
+    for key in field_path.split('.'):
+        if not isinstance(data, dict) or key not in data:
+            raise KeyError(field_path)
+        data = data[key]
+    return data
+
+def _set_nested(data, field_path, value):
+    keys = field_path.split('.')
+    for key in keys[:-1]:
+        if not isinstance(data.get(key), dict):
+            data[key] = {}
+        data = data[key]
+    data[keys[-1]] = value
+
+def _pop_nested(data, field_path):
+    keys = field_path.split('.')
+    for key in keys[:-1]:
+        data = data.get(key)
+        if not isinstance(data, dict):
+            return
+    data.pop(keys[-1], None)
+
+def _merge(target, source):
+    for k, v in source.items():
+        if v is DELETE_FIELD:
+            target.pop(k, None)
+        elif isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge(target[k], v)
+        else:
+            target[k] = v
+
+def _copy(data):
+    ## DocumentReference values are shared, everything else is copied
+    if isinstance(data, dict):
+        return { k: _copy(v) for k, v in data.items() }
+    if isinstance(data, list):
+        return [ _copy(v) for v in data ]
+    return data
+
+def _project(data, field_paths):
+    projected = {}
+    for field_path in field_paths:
+        try:
+            _set_nested(projected, field_path, _get_nested(data, field_path))
+        except KeyError:
+            pass
+    return projected
+
+class Store(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.documents = {}
+        self.collections = {}
+        self.sortedIds = {}
+        ## parent document path ('' for the root) -> ids of its collections
+        self.subcollections = {}
+        self.watches = []
+        self.lock = threading.RLock()
+        self.rpcs = 0
+        self.reads = 0
+        self.writes = 0
+        ## simulated limits of a commit, None for none: writes per second and
+        ## seconds between two commits writing the same document
+        self.writeRate = None
+        self.documentInterval = None
+        self.commitTimes = []
+        self.documentTimes = {}
+    def rpc(self, reads=0, writes=0):
+        with self.lock:
+            self.rpcs += 1
+            self.reads += reads
+            self.writes += writes
+        if self.latency:
+            time.sleep(self.latency)
+    def admit(self, paths):
+        ## raises like Firestore when a commit exceeds the limits
+        now = time.monotonic()
+        with self.lock:
+            if self.writeRate is not None:
+                self.commitTimes = [ (t, n) for t, n in self.commitTimes if now - t < 1.0 ]
+                if sum(n for t, n in self.commitTimes) + len(paths) > self.writeRate:
+                    raise ResourceExhausted('Quota exceeded: {} writes per second'.format(self.writeRate))
+            if self.documentInterval is not None:
+                for path in paths:
+                    if now - self.documentTimes.get(path, float('-inf')) < self.documentInterval:
+                        raise Aborted('Too much contention on these documents: {}'.format(path))
+                for path in paths:
+                    self.documentTimes[path] = now
+            if self.writeRate is not None:
+                self.commitTimes.append((now, len(paths)))
+    def put(self, path, entry):
+        collection_path, document_id = path.rsplit('/', 1)
+        if collection_path not in self.collections:
+            segments = collection_path.split('/')
+            for i in range(0, len(segments), 2):
+                self.subcollections.setdefault('/'.join(segments[:i]), set()).add(segments[i])
+        documents = self.collections.setdefault(collection_path, {})
+        if document_id not in documents:
+            self.sortedIds.pop(collection_path, None)
+        documents[document_id] = entry
+        self.documents[path] = entry
+    def pop(self, path):
+        entry = self.documents.pop(path, None)
+        if entry is not None:
+            collection_path, document_id = path.rsplit('/', 1)
+            del self.collections[collection_path][document_id]
+            self.sortedIds.pop(collection_path, None)
+        return entry
+    def sorted_ids(self, collection_path):
+        ids = self.sortedIds.get(collection_path)
+        if ids is None:
+            ids = self.sortedIds[collection_path] = sorted(self.collections.get(collection_path, {}))
+        return ids
+    def _has_documents(self, collection_path):
+        ## documents in the collection, or else in any collection below it
+        if self.collections.get(collection_path):
+            return True
+        prefix = collection_path + '/'
+        return any(documents for path, documents in self.collections.items() if documents and path.startswith(prefix))
+    def children(self, parent_path):
+        with self.lock:
+            prefix = parent_path + '/' if parent_path else ''
+            return sorted(c for c in self.subcollections.get(parent_path, ()) if self._has_documents(prefix + c))
+    def notify(self, paths):
+        ## deliver changes to on_snapshot listeners of the written collections
+        collection_paths = set(path.rsplit('/', 1)[0] for path in paths)
+        for watch in list(self.watches):
+            if watch.collectionPath in collection_paths:
+                watch.fire()
+
+class DocumentSnapshot(object):
+    def __init__(self, reference, data, create_time=None, update_time=None):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+        self.read_time = _now()
+    @property
+    def id(self):
+        return self.reference.id
+    @property
+    def exists(self):
+        return self._data is not None
+    def to_dict(self):
+        if self._data is None:
+            return None
+        return _copy(self._data)
+    def get(self, field_path):
+        return _copy(_get_nested(self._data or {}, field_path))
+
+class WriteResult(object):
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+class DocumentReference(object):
+    def __init__(self, client, *path):
+        self._client = client
+        self._path = tuple(path)
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+    def __hash__(self):
+        return hash(self.path)
+    def __repr__(self):
+        return '<DocumentReference {}>'.format(self.path)
+    @property
+    def id(self):
+        return self._path[-1]
+    @property
+    def path(self):
+        return '/'.join(self._path)
+    @property
+    def parent(self):
+        return CollectionReference(self._client, *self._path[:-1])
+    def collection(self, collection_id):
+        return CollectionReference(self._client, *(self._path + (collection_id,)))
+    def collections(self, page_size=None):
+        self._client._store.rpc()
+        return [ self.collection(c) for c in self._client._store.children(self.path) ]
+    def _snapshot(self, field_paths=None):
+        store = self._client._store
+        with store.lock:
+            entry = store.documents.get(self.path)
+            if entry is None:
+                return DocumentSnapshot(self, None)
+            data = _copy(entry['data'])
+        if field_paths is not None:
+            data = _project(data, field_paths)
+        return DocumentSnapshot(self, data, entry['create_time'], entry['update_time'])
+    def _check(self, op):
+        exists = self.path in self._client._store.documents
+        if op == 'create' and exists:
+            raise AlreadyExists('Document already exists: {}'.format(self.path))
+        if op == 'update' and not exists:
+            raise NotFound('No document to update: {}'.format(self.path))
+    def _write(self, op, data=None, merge=False, now=None):
+        ## caller holds the store lock and has run _check
+        store = self._client._store
+        now = now or _now()
+        entry = store.documents.get(self.path)
+        if op == 'delete':
+            store.pop(self.path)
+        elif op == 'update':
+            for field_path, value in data.items():
+                if value is DELETE_FIELD:
+                    _pop_nested(entry['data'], field_path)
+                else:
+                    _set_nested(entry['data'], field_path, _copy(value))
+            entry['update_time'] = now
+        elif op == 'set' and merge and entry is not None:
+            _merge(entry['data'], _copy(data))
+            entry['update_time'] = now
+        elif op == 'set' and merge:
+            merged = {}
+            _merge(merged, _copy(data))
+            store.put(self.path, { 'data': merged, 'create_time': now, 'update_time': now })
+        else:
+            created = entry['create_time'] if entry else now
+            store.put(self.path, { 'data': _copy(data), 'create_time': created, 'update_time': now })
+        return WriteResult(now)
+    def _commit(self, op, data=None, merge=False):
+        store = self._client._store
+        store.rpc(writes=1)
+        store.admit([self.path])
+        with store.lock:
+            self._check(op)
+            result = self._write(op, data, merge)
+        store.notify([self.path])
+        return result
+    def get(self, field_paths=None, transaction=None):
+        self._client._store.rpc(reads=1)
+        return self._snapshot(field_paths)
+    def create(self, document_data):
+        return self._commit('create', document_data)
+    def set(self, document_data, merge=False):
+        return self._commit('set', document_data, merge)
+    def update(self, field_updates, option=None):
+        return self._commit('update', field_updates)
+    def delete(self, option=None):
+        return self._commit('delete').update_time
+
+class FieldFilter(object):
+    def __init__(self, field_path, op_string, value=None):
+        self.field_path = field_path
+        self.op_string = op_string
+        self.value = value
+
+class _Ordered(object):
+    ## sort wrapper: None < bool < numbers < strings < references
+    def __init__(self, value, descending=False):
+        self.value = value
+        self.descending = descending
+    def _key(self):
+        v = self.value
+        if v is None:
+            return (0, '', 0)
+        if isinstance(v, bool):
+            return (1, '', v)
+        if isinstance(v, (int, float)):
+            return (2, '', v)
+        if isinstance(v, DocumentReference):
+            return (4, '', v.path)
+        return (3, type(v).__name__, v)
+    def __lt__(self, other):
+        a, b = self._key(), other._key()
+        return a > b if self.descending else a < b
+    def __gt__(self, other):
+        return other < self
+    def __eq__(self, other):
+        return self._key() == other._key()
+    def __le__(self, other):
+        return not other < self
+    def __ge__(self, other):
+        return not self < other
+
+class Query(object):
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+    def __init__(self, parent, filters=(), projection=None, orders=(), limit=None, start=None, end=None):
+        self._parent = parent
+        self._filters = tuple(filters)
+        self._projection = projection
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start = start
+        self._end = end
+    def _copy(self, **kwargs):
+        attrs = {
+            'filters': self._filters, 'projection': self._projection, 'orders': self._orders,
+            'limit': self._limit, 'start': self._start, 'end': self._end,
+        }
+        attrs.update(kwargs)
+        return Query(self._parent, **attrs)
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is None:
+            filter = FieldFilter(field_path, op_string, value)
+        return self._copy(filters=self._filters + (filter,))
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+    def limit(self, count):
+        return self._copy(limit=count)
+    def start_at(self, document_fields):
+        return self._copy(start=(document_fields, True))
+    def start_after(self, document_fields):
+        return self._copy(start=(document_fields, False))
+    def end_at(self, document_fields):
+        return self._copy(end=(document_fields, True))
+    def end_before(self, document_fields):
+        return self._copy(end=(document_fields, False))
+    def _value(self, path, data, field_path):
+        if field_path == DOCUMENT_ID:
+            return path
+        return _get_nested(data, field_path)
+    def _match(self, path, data):
+        for f in self._filters:
+            try:
+                v = self._value(path, data, f.field_path)
+            except KeyError:
+                return False
+            target = f.value
+            if f.field_path == DOCUMENT_ID:
+                target = self._name(target)
+            op = f.op_string
+            if op == '==' and not v == target: return False
+            if op == '!=' and not v != target: return False
+            if op == '<' and not v < target: return False
+            if op == '<=' and not v <= target: return False
+            if op == '>' and not v > target: return False
+            if op == '>=' and not v >= target: return False
+            if op == 'in' and v not in target: return False
+            if op == 'not-in' and v in target: return False
+            if op == 'array_contains' and (not isinstance(v, list) or target not in v): return False
+            if op == 'array_contains_any' and (not isinstance(v, list) or not [ t for t in target if t in v ]): return False
+        return True
+    def _name(self, value):
+        if isinstance(value, DocumentReference):
+            return value.path
+        return self._parent.path + '/' + value
+    def _orders_with_name(self):
+        ## like Firestore, results are finally ordered by document name
+        orders = list(self._orders)
+        if not any(field_path == DOCUMENT_ID for field_path, _ in orders):
+            direction = orders[-1][1] if orders else self.ASCENDING
+            orders.append((DOCUMENT_ID, direction))
+        return orders
+    def _sort_key(self, path, data, orders):
+        key = []
+        for field_path, direction in orders:
+            try:
+                v = self._value(path, data, field_path)
+            except KeyError:
+                v = None
+            key.append(_Ordered(v, direction == self.DESCENDING))
+        return key
+    def _cursor_key(self, cursor, orders):
+        document_fields, inclusive = cursor
+        values = []
+        if isinstance(document_fields, DocumentSnapshot):
+            for field_path, _ in orders:
+                if field_path == DOCUMENT_ID:
+                    values.append(document_fields.reference.path)
+                else:
+                    values.append(document_fields.get(field_path))
+        elif isinstance(document_fields, dict):
+            for field_path, _ in orders:
+                if field_path not in document_fields:
+                    break
+                v = document_fields[field_path]
+                values.append(self._name(v) if field_path == DOCUMENT_ID else v)
+        else:
+            values = list(document_fields)
+        return [ _Ordered(v, direction == self.DESCENDING) for v, (_, direction) in zip(values, orders) ], inclusive
+    def _in_range(self, key, start_key, end_key):
+        if start_key:
+            start, inclusive = start_key
+            if key[:len(start)] < start or (not inclusive and key[:len(start)] == start):
+                return False
+        if end_key:
+            end, inclusive = end_key
+            if key[:len(end)] > end or (not inclusive and key[:len(end)] == end):
+                return False
+        return True
+    def _run(self):
+        store = self._parent._client._store
+        collection_path = self._parent.path
+        orders = self._orders_with_name()
+        start_key = self._cursor_key(self._start, orders) if self._start else None
+        end_key = self._cursor_key(self._end, orders) if self._end else None
+        rows = []
+        with store.lock:
+            documents = store.collections.get(collection_path, {})
+            ids = store.sorted_ids(collection_path)
+            if orders == [(DOCUMENT_ID, self.ASCENDING)]:
+                ## ordered by name only: seek to the cursor and stop at the limit
+                begin = 0
+                if start_key and start_key[0]:
+                    start_id = start_key[0][0].value.rsplit('/', 1)[1]
+                    seek = bisect.bisect_left if start_key[1] else bisect.bisect_right
+                    begin = seek(ids, start_id)
+                for document_id in itertools.islice(ids, begin, None):
+                    path = collection_path + '/' + document_id
+                    entry = documents[document_id]
+                    key = [ _Ordered(path) ]
+                    if end_key and not self._in_range(key, None, end_key):
+                        break
+                    if not self._match(path, entry['data']):
+                        continue
+                    rows.append((key, path, entry))
+                    if self._limit is not None and len(rows) >= self._limit:
+                        break
+            else:
+                for document_id in ids:
+                    path = collection_path + '/' + document_id
+                    entry = documents[document_id]
+                    if not self._match(path, entry['data']):
+                        continue
+                    key = self._sort_key(path, entry['data'], orders)
+                    if self._in_range(key, start_key, end_key):
+                        rows.append((key, path, entry))
+                rows.sort(key=lambda row: row[0])
+                if self._limit is not None:
+                    rows = rows[:self._limit]
+            results = []
+            for _, path, entry in rows:
+                data = _copy(entry['data'])
+                if self._projection is not None:
+                    data = _project(data, self._projection)
+                reference = self._parent.document(path.rsplit('/', 1)[1])
+                results.append(DocumentSnapshot(reference, data, entry['create_time'], entry['update_time']))
+        return results
+    def stream(self, transaction=None):
+        results = self._run()
+        ## an empty result is still billed one read
+        self._parent._client._store.rpc(reads=max(1, len(results)))
+        for docsnap in results:
+            yield docsnap
+    def get(self, transaction=None):
+        return list(self.stream())
+    def on_snapshot(self, callback):
+        watch = Watch(self, callback)
+        store = self._parent._client._store
+        with store.lock:
+            store.watches.append(watch)
+        watch.fire()
+        return watch
+
+class CollectionReference(Query):
+    def __init__(self, client, *path):
+        self._client = client
+        self._path = tuple(path)
+        Query.__init__(self, self)
+    def __eq__(self, other):
+        return isinstance(other, CollectionReference) and other.path == self.path
+    def __hash__(self):
+        return hash(self.path)
+    @property
+    def id(self):
+        return self._path[-1]
+    @property
+    def path(self):
+        return '/'.join(self._path)
+    @property
+    def parent(self):
+        if len(self._path) == 1:
+            return None
+        return DocumentReference(self._client, *self._path[:-1])
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = _auto_id()
+        return DocumentReference(self._client, *(self._path + tuple(document_id.split('/'))))
+    def add(self, document_data, document_id=None):
+        docref = self.document(document_id)
+        result = docref.create(document_data)
+        return result.update_time, docref
+    def list_documents(self, page_size=None):
+        store = self._client._store
+        store.rpc()
+        with store.lock:
+            return [ self.document(document_id) for document_id in store.sorted_ids(self.path) ]
+
+class WriteBatch(object):
+    maxWrites = 500
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+    def __len__(self):
+        return len(self._writes)
+    def create(self, reference, document_data):
+        self._writes.append((reference, 'create', document_data, False))
+    def set(self, reference, document_data, merge=False):
+        self._writes.append((reference, 'set', document_data, merge))
+    def update(self, reference, field_updates, option=None):
+        self._writes.append((reference, 'update', field_updates, False))
+    def delete(self, reference, option=None):
+        self._writes.append((reference, 'delete', None, False))
+    def commit(self):
+        if len(self._writes) > self.maxWrites:
+            raise InvalidArgument('maximum {} writes allowed per request'.format(self.maxWrites))
+        writes, self._writes = self._writes, []
+        store = self._client._store
+        store.rpc(writes=len(writes))
+        store.admit(set(reference.path for reference, _, _, _ in writes))
+        now = _now()
+        with store.lock:
+            ## all or nothing, like a Firestore commit
+            for reference, op, data, merge in writes:
+                reference._check(op)
+            results = [ reference._write(op, data, merge, now) for reference, op, data, merge in writes ]
+        store.notify([ reference.path for reference, _, _, _ in writes ])
+        return results
+
+class BulkWriter(object):
+    ## like the real BulkWriter: batches of up to 20 writes sent in parallel,
+    ## a failed write does not fail the others
+    batchSize = 20
+    def __init__(self, client, max_workers=8):
+        self._client = client
+        self._pending = []
+        self._max_workers = max_workers
+        self._error_callback = None
+        self.errors = []
+    def on_write_error(self, callback):
+        self._error_callback = callback
+    def create(self, reference, document_data):
+        self._pending.append((reference, 'create', document_data, False))
+    def set(self, reference, document_data, merge=False):
+        self._pending.append((reference, 'set', document_data, merge))
+    def update(self, reference, field_updates, option=None):
+        self._pending.append((reference, 'update', field_updates, False))
+    def delete(self, reference, option=None):
+        self._pending.append((reference, 'delete', None, False))
+    def _commit(self, writes):
+        store = self._client._store
+        store.rpc(writes=len(writes))
+        for reference, op, data, merge in writes:
+            try:
+                with store.lock:
+                    reference._check(op)
+                    reference._write(op, data, merge)
+            except (AlreadyExists, NotFound) as e:
+                self.errors.append(e)
+                if self._error_callback:
+                    self._error_callback(e)
+        store.notify([ reference.path for reference, _, _, _ in writes ])
+    def flush(self):
+        writes, self._pending = self._pending, []
+        chunks = [ writes[i:i + self.batchSize] for i in range(0, len(writes), self.batchSize) ]
+        if not chunks:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            list(executor.map(self._commit, chunks))
+    def close(self):
+        self.flush()
+
+class DocumentChange(object):
+    class Type(object):
+        def __init__(self, name):
+            self.name = name
+        def __repr__(self):
+            return self.name
+    def __init__(self, type_name, document):
+        self.type = DocumentChange.Type(type_name)
+        self.document = document
+
+class Watch(object):
+    ## calls callback(snapshots, changes, read_time) on registration and
+    ## after every write to the watched collection that changes the result
+    def __init__(self, query, callback):
+        self.query = query
+        self.callback = callback
+        self.collectionPath = query._parent.path
+        self.seen = None
+        self.lock = threading.Lock()
+    def fire(self):
+        with self.lock:
+            snapshots = self.query._run()
+            current = { s.reference.path: s for s in snapshots }
+            previous = self.seen or {}
+            changes = []
+            for path, snap in current.items():
+                if path not in previous:
+                    changes.append(DocumentChange('ADDED', snap))
+                elif previous[path].update_time != snap.update_time:
+                    changes.append(DocumentChange('MODIFIED', snap))
+            for path, snap in previous.items():
+                if path not in current:
+                    changes.append(DocumentChange('REMOVED', snap))
+            initial = self.seen is None
+            self.seen = current
+        if changes or initial:
+            self.callback(snapshots, changes, _now())
+    def unsubscribe(self):
+        store = self.query._parent._client._store
+        with store.lock:
+            if self in store.watches:
+                store.watches.remove(self)
+
+class Client(object):
+    def __init__(self, store=None, latency=0.0):
+        if store is None:
+            store = Store(latency)
+        self._store = store
+    def collection(self, *collection_path):
+        path = '/'.join(collection_path).split('/')
+        return CollectionReference(self, *path)
+    def document(self, *document_path):
+        path = '/'.join(document_path).split('/')
+        return DocumentReference(self, *path)
+    def collections(self):
+        self._store.rpc()
+        return [ self.collection(c) for c in self._store.children('') ]
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        self._store.rpc(reads=len(references))
+        for reference in references:
+            yield reference._snapshot(field_paths)
+    def batch(self):
+        return WriteBatch(self)
+    def bulk_writer(self, options=None):
+        return BulkWriter(self)
+    def dump(self):
+        ## JSON-serializable copy of every document, references as {'__ref__': path}
+        ## and bytes as {'__bytes__': hex}, like sample/snapshot.py
+        def encode(v):
+            if isinstance(v, DocumentReference):
+                return { '__ref__': v.path }
+            if isinstance(v, dict):
+                return { k: encode(vv) for k, vv in v.items() }
+            if isinstance(v, list):
+                return [ encode(vv) for vv in v ]
+            if isinstance(v, datetime.datetime):
+                return v.isoformat()
+            if isinstance(v, bytes):
+                return { '__bytes__': v.hex() }
+            return v
+        with self._store.lock:
+            return { path: encode(entry['data']) for path, entry in sorted(self._store.documents.items()) }
+    def load(self, documents):
+        def decode(v):
+            if isinstance(v, dict) and set(v) == {'__ref__'}:
+                return self.document(v['__ref__'])
+            if isinstance(v, dict) and set(v) == {'__bytes__'}:
+                return bytes.fromhex(v['__bytes__'])
+            if isinstance(v, dict):
+                return { k: decode(vv) for k, vv in v.items() }
+            if isinstance(v, list):
+                return [ decode(vv) for vv in v ]
+            return v
+        now = _now()
+        with self._store.lock:
+            for path, data in documents.items():
+                self._store.put(path, { 'data': decode(data), 'create_time': now, 'update_time': now })
+
+class AsyncDocumentReference(object):
+    ## awaitable facade of DocumentReference, the blocking call runs in the
+    ## client's thread pool so the latencies of concurrent calls overlap
+    def __init__(self, client, reference):
+        self._async_client = client
+        self._reference = reference
+    def __getattr__(self, name):
+        return getattr(self._reference, name)
+    def __repr__(self):
+        return '<AsyncDocumentReference {}>'.format(self._reference.path)
+    async def get(self, field_paths=None, transaction=None):
+        return await self._async_client._run(self._reference.get, field_paths)
+    async def create(self, document_data):
+        return await self._async_client._run(self._reference.create, document_data)
+    async def set(self, document_data, merge=False):
+        return await self._async_client._run(self._reference.set, document_data, merge)
+    async def update(self, field_updates, option=None):
+        return await self._async_client._run(self._reference.update, field_updates)
+    async def delete(self, option=None):
+        return await self._async_client._run(self._reference.delete)
+
+class AsyncClient(object):
+    ## the subset of google.cloud.firestore.AsyncClient used by client.py,
+    ## sharing the store of a synchronous Client
+    def __init__(self, client, maxWorkers=32):
+        self._client = client
+        self._store = client._store
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+    async def _run(self, method, *args):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+    def document(self, *document_path):
+        return AsyncDocumentReference(self, self._client.document(*document_path))
+    async def get_all(self, references, field_paths=None, transaction=None):
+        references = [ getattr(r, '_reference', r) for r in references ]
+        snapshots = await self._run(lambda: list(self._client.get_all(references, field_paths)))
+        for snapshot in snapshots:
+            yield snapshot
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+## Validators of trait attributes and states, compiled from the
+## 'attributes'/'states' tables of DEVICE_TRAITS in client.py.
+## The schemas are a small JSON Schema subset: type, enum, minimum, maximum,
+## properties, required, additionalProperties, items and anyOf. A schema is
+## compiled once into nested closures and the validator of a trait set is
+## cached, so a bulk file is checked without interpreting the schemas again.
+## A validator is called with (value, path) and returns a list of errors.
+import json
+
+TYPES = {
+    'boolean': lambda v: isinstance(v, bool),
+    'integer': lambda v: isinstance(v, int) and not isinstance(v, bool),
+    'number': lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    'string': lambda v: isinstance(v, str),
+    'object': lambda v: isinstance(v, dict),
+    'array': lambda v: isinstance(v, list),
+}
+
+def _show(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+def compile_schema(schema):
+    checks = []
+    if 'type' in schema:
+        names = schema['type'] if isinstance(schema['type'], (list, tuple)) else [ schema['type'] ]
+        tests = [ TYPES[name] for name in names ]
+        expected = ' or '.join(names)
+        def check_type(value, path):
+            if not any(test(value) for test in tests):
+                return [ '{}: {} is not {}'.format(path, _show(value), expected) ]
+            return []
+        checks.append(check_type)
+    if 'enum' in schema:
+        allowed = frozenset(schema['enum'])
+        choices = ', '.join(_show(v) for v in schema['enum'])
+        def check_enum(value, path):
+            if isinstance(value, (dict, list)) or value not in allowed:
+                return [ '{}: {} is not one of {}'.format(path, _show(value), choices) ]
+            return []
+        checks.append(check_enum)
+    if 'minimum' in schema or 'maximum' in schema:
+        minimum = schema.get('minimum', float('-inf'))
+        maximum = schema.get('maximum', float('inf'))
+        def check_range(value, path):
+            if TYPES['number'](value) and not minimum <= value <= maximum:
+                return [ '{}: {} is out of range {}..{}'.format(path, _show(value), schema.get('minimum', ''), schema.get('maximum', '')) ]
+            return []
+        checks.append(check_range)
+    if 'properties' in schema or 'required' in schema or 'additionalProperties' in schema:
+        properties = { k: compile_schema(v) for k, v in schema.get('properties', {}).items() }
+        required = tuple(schema.get('required', ()))
+        closed = schema.get('additionalProperties', True) is False
+        def check_object(value, path):
+            if not isinstance(value, dict):
+                return []
+            errors = [ '{}: {} is required'.format(path, k) for k in required if k not in value ]
+            for k, v in value.items():
+                validator = properties.get(k)
+                if validator is not None:
+                    errors += validator(v, path + '.' + k)
+                elif closed:
+                    errors.append('{}: {} is not allowed'.format(path, k))
+            return errors
+        checks.append(check_object)
+    if 'items' in schema:
+        item = compile_schema(schema['items'])
+        def check_items(value, path):
+            if not isinstance(value, list):
+                return []
+            errors = []
+            for i, v in enumerate(value):
+                errors += item(v, '{}[{}]'.format(path, i))
+            return errors
+        checks.append(check_items)
+    if 'anyOf' in schema:
+        alternatives = [ compile_schema(s) for s in schema['anyOf'] ]
+        def check_any(value, path):
+            errors = []
+            for alternative in alternatives:
+                e = alternative(value, path)
+                if not e:
+                    return []
+                errors += e
+            return [ ' / '.join(errors) ]
+        checks.append(check_any)
+    if len(checks) == 1:
+        return checks[0]
+    def check(value, path):
+        for c in checks:
+            errors = c(value, path)
+            if errors:
+                return errors
+        return []
+    return check
+
+def _merge_schemas(schemas):
+    ## one schema for a field declared by several traits
+    distinct = []
+    for schema in schemas:
+        if schema not in distinct:
+            distinct.append(schema)
+    return distinct[0] if len(distinct) == 1 else { 'anyOf': distinct }
+
+class Registry(object):
+    ## states every device may report, whatever its traits
+    commonStates = {
+        'online': { 'type': 'boolean' },
+    }
+    def __init__(self, traits, types, traitsPrefix='', typesPrefix=''):
+        self.traits = traits
+        self.types = types
+        self.traitsPrefix = traitsPrefix
+        self.typesPrefix = typesPrefix
+        self.validators = {}
+    def trait_name(self, trait):
+        return trait[len(self.traitsPrefix):] if trait.startswith(self.traitsPrefix) else trait
+    def type_name(self, device_type):
+        return device_type[len(self.typesPrefix):] if device_type.startswith(self.typesPrefix) else device_type
+    def _compile(self, table, traits, extra):
+        ## field -> validator of the fields of traits (all traits when None)
+        names = sorted(self.traits) if traits is None else traits
+        fields = {}
+        for name in names:
+            for k, v in self.traits[name].get(table, {}).items():
+                fields.setdefault(k, []).append(v)
+        for k, v in extra.items():
+            fields.setdefault(k, []).append(v)
+        return { k: compile_schema(_merge_schemas(v)) for k, v in fields.items() }
+    def _validator(self, table, traits, extra={}):
+        if traits is not None:
+            traits = tuple(sorted(set(self.trait_name(t) for t in traits)))
+            unknown = [ t for t in traits if t not in self.traits ]
+            if unknown:
+                raise ValueError('{} is not a device trait'.format(', '.join(unknown)))
+        key = (table, traits)
+        validator = self.validators.get(key)
+        if validator is None:
+            fields = self._compile(table, traits, extra)
+            owner = 'any trait' if traits is None else ', '.join(traits) or 'no trait'
+            singular = { 'attributes': 'an attribute', 'states': 'a state' }[table]
+            def validator(values, path=table):
+                if not isinstance(values, dict):
+                    return [ '{}: {} is not object'.format(path, _show(values)) ]
+                errors = []
+                for k, v in values.items():
+                    check = fields.get(k)
+                    if check is None:
+                        errors.append('{}.{}: not {} of {}'.format(path, k, singular, owner))
+                    else:
+                        errors += check(v, path + '.' + k)
+                return errors
+            self.validators[key] = validator
+        return validator
+    def attributes(self, traits=None):
+        ## validator of the attributes of a device with traits, any trait when None
+        return self._validator('attributes', traits)
+    def states(self, traits=None):
+        return self._validator('states', traits, self.commonStates)
+    def device(self, docdata):
+        ## errors of a devices document (or its import record), traits and type with or without prefix
+        errors = []
+        device_type = docdata.get('type')
+        if not isinstance(device_type, str) or self.type_name(device_type) not in self.types:
+            errors.append('type: {} is not a device type'.format(_show(device_type)))
+        traits = docdata.get('traits')
+        if not isinstance(traits, list) or not traits:
+            return errors + [ 'traits: {} is not a list of traits'.format(_show(traits)) ]
+        unknown = [ t for t in traits if not isinstance(t, str) or self.trait_name(t) not in self.traits ]
+        if unknown:
+            return errors + [ 'traits: {} is not a device trait'.format(', '.join(_show(t) for t in unknown)) ]
+        if 'attributes' in docdata:
+            errors += self.attributes(traits)(docdata['attributes'])
+        return errors
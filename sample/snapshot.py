@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+## Local snapshot of the Firestore collections in one SQLite file.
+## `client.py export` writes it, `client.py restore` writes it back to a
+## project (or the emulator) and the get_* sub-commands read it with
+## --snapshot. The read side implements the subset of the Firestore client
+## used by client.py, where('==') on the link fields uses SQLite indexes.
+## DocumentReference values are stored as {'__ref__': path}.
+import datetime
+import json
+import os
+import sqlite3
+
+DOCUMENT_ID = '__name__'
+SCHEMA = '''
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE documents (
+    path TEXT PRIMARY KEY,
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    update_time TEXT
+);
+'''
+## fields compared by where('==') of client.py
+INDEXED_FIELDS = ('deviceId', 'userId', 'remoteId', 'groupId', 'type')
+
+def _field_expression(field_path):
+    return "json_extract(data, '$.{}')".format(field_path)
+
+def encode(value, is_reference):
+    if is_reference(value):
+        return { '__ref__': value.path }
+    if isinstance(value, dict):
+        return { k: encode(v, is_reference) for k, v in value.items() }
+    if isinstance(value, (list, tuple)):
+        return [ encode(v, is_reference) for v in value ]
+    if isinstance(value, datetime.datetime):
+        return { '__time__': value.isoformat() }
+    if isinstance(value, bytes):
+        return { '__bytes__': value.hex() }
+    return value
+
+def decode(value, document):
+    ## document: path -> DocumentReference of the client the data is used with
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if '__ref__' in value:
+                return document(value['__ref__'])
+            if '__time__' in value:
+                return datetime.datetime.fromisoformat(value['__time__'])
+            if '__bytes__' in value:
+                return bytes.fromhex(value['__bytes__'])
+        return { k: decode(v, document) for k, v in value.items() }
+    if isinstance(value, list):
+        return [ decode(v, document) for v in value ]
+    return value
+
+class Writer(object):
+    def __init__(self, filename, is_reference):
+        if os.path.exists(filename):
+            os.unlink(filename)
+        self.filename = filename
+        self.is_reference = is_reference
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+        self.count = 0
+    def add(self, docsnap):
+        path = docsnap.reference.path
+        collection, document_id = path.rsplit('/', 1)
+        data = json.dumps(encode(docsnap.to_dict() or {}, self.is_reference), ensure_ascii=False, separators=(',', ':'))
+        update_time = getattr(docsnap, 'update_time', None)
+        self.db.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)',
+            (path, collection, document_id, data, update_time.isoformat() if update_time else None))
+        self.count += 1
+    def close(self, meta=None):
+        ## indexes are built once after the bulk insert
+        self.db.execute('CREATE INDEX documents_collection ON documents (collection, id)')
+        for field in INDEXED_FIELDS:
+            self.db.execute('CREATE INDEX documents_{0} ON documents (collection, {1}, id)'.format(field, _field_expression(field)))
+        for k, v in dict(meta or {}, documents=self.count).items():
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (k, json.dumps(v)))
+        self.db.commit()
+        self.db.execute('ANALYZE')
+        self.db.execute('VACUUM')
+        self.db.close()
+
+class DocumentSnapshot(object):
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self._data = data
+        self.update_time = datetime.datetime.fromisoformat(update_time) if update_time else None
+    @property
+    def id(self):
+        return self.reference.id
+    @property
+    def exists(self):
+        return self._data is not None
+    def to_dict(self):
+        return self._data
+    def get(self, field_path):
+        data = self._data or {}
+        for key in field_path.split('.'):
+            data = data[key]
+        return data
+
+class DocumentReference(object):
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+    def __hash__(self):
+        return hash(self.path)
+    def __repr__(self):
+        return '<DocumentReference {}>'.format(self.path)
+    @property
+    def id(self):
+        return self.path.rsplit('/', 1)[-1]
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit('/', 1)[0])
+    def collection(self, collection_id):
+        return CollectionReference(self._client, self.path + '/' + collection_id)
+    def collections(self):
+        return [ self.collection(c) for c in self._client._children(self.path) ]
+    def get(self, field_paths=None, transaction=None):
+        return next(self._client.get_all([self], field_paths))
+
+def _project(data, field_paths):
+    projected = {}
+    for field_path in field_paths:
+        source, target = data, projected
+        keys = field_path.split('.')
+        try:
+            for key in keys:
+                source = source[key]
+        except (KeyError, TypeError):
+            continue
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = source
+    return projected
+
+class Query(object):
+    def __init__(self, parent, filters=(), fields=None, limit=None, after=None):
+        self._parent = parent
+        self._filters = tuple(filters)
+        self._fields = fields
+        self._limit = limit
+        self._after = after
+    def _copy(self, **kwargs):
+        options = dict(filters=self._filters, fields=self._fields, limit=self._limit, after=self._after)
+        options.update(kwargs)
+        return Query(self._parent, **options)
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string != '==':
+            raise ValueError('snapshot supports only == filters, not {}'.format(op_string))
+        return self._copy(filters=self._filters + ((field_path, value),))
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+    def order_by(self, field_path, direction=None):
+        ## documents are always returned in id order
+        if field_path != DOCUMENT_ID:
+            raise ValueError('snapshot supports ordering by document id only')
+        return self
+    def limit(self, count):
+        return self._copy(limit=count)
+    def start_after(self, document_fields):
+        if isinstance(document_fields, dict):
+            after = document_fields[DOCUMENT_ID]
+        else:
+            after = document_fields.id
+        return self._copy(after=after)
+    def stream(self, transaction=None):
+        client = self._parent._client
+        sql = 'SELECT path, data, update_time FROM documents WHERE collection = ?'
+        params = [ self._parent.path ]
+        for field_path, value in self._filters:
+            if hasattr(value, 'path'):
+                sql += ' AND {} = ?'.format(_field_expression(field_path + '.__ref__'))
+                value = value.path
+            else:
+                sql += ' AND {} = ?'.format(_field_expression(field_path))
+            params.append(value)
+        if self._after is not None:
+            sql += ' AND id > ?'
+            params.append(self._after)
+        sql += ' ORDER BY id'
+        if self._limit is not None:
+            sql += ' LIMIT ?'
+            params.append(self._limit)
+        for path, data, update_time in client._db.execute(sql, params):
+            yield client._snapshot(path, data, update_time, self._fields)
+    def get(self, transaction=None):
+        return list(self.stream())
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        Query.__init__(self, self)
+    @property
+    def id(self):
+        return self.path.rsplit('/', 1)[-1]
+    def document(self, document_id):
+        return DocumentReference(self._client, self.path + '/' + document_id)
+    def list_documents(self, page_size=None):
+        return [ self.document(document_id) for (document_id,) in self._client._db.execute('SELECT id FROM documents WHERE collection = ? ORDER BY id', (self.path,)) ]
+
+class Client(object):
+    ## read-only client over a snapshot file
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            raise FileNotFoundError('{} does not exist'.format(filename))
+        self._db = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True, check_same_thread=False)
+    def meta(self):
+        return { k: json.loads(v) for k, v in self._db.execute('SELECT key, value FROM meta') }
+    def _snapshot(self, path, data, update_time, field_paths=None):
+        data = decode(json.loads(data), self.document)
+        if field_paths is not None:
+            data = _project(data, field_paths)
+        return DocumentSnapshot(DocumentReference(self, path), data, update_time)
+    def _children(self, path):
+        prefix = path + '/' if path else ''
+        rows = self._db.execute('SELECT DISTINCT collection FROM documents WHERE collection LIKE ? ESCAPE ?', (prefix.replace('_', '\\_').replace('%', '\\%') + '%', '\\'))
+        return sorted(set(collection[len(prefix):].split('/')[0] for (collection,) in rows))
+    def collection(self, *collection_path):
+        return CollectionReference(self, '/'.join(collection_path))
+    def document(self, *document_path):
+        return DocumentReference(self, '/'.join(document_path))
+    def collections(self):
+        return [ self.collection(c) for c in self._children('') ]
+    def get_all(self, references, field_paths=None, transaction=None):
+        paths = [ reference.path for reference in references ]
+        found = {}
+        ## SQLite allows 999 variables per statement
+        for i in range(0, len(paths), 900):
+            chunk = paths[i:i + 900]
+            sql = 'SELECT path, data, update_time FROM documents WHERE path IN ({})'.format(','.join('?' * len(chunk)))
+            for path, data, update_time in self._db.execute(sql, chunk):
+                found[path] = (data, update_time)
+        for path in paths:
+            if path in found:
+                yield self._snapshot(path, found[path][0], found[path][1], field_paths)
+            else:
+                yield DocumentSnapshot(DocumentReference(self, path), None)
+    def documents(self, document):
+        ## (path, data) of every document, references made with document(path)
+        for path, data in self._db.execute('SELECT path, data FROM documents ORDER BY path'):
+            yield path, decode(json.loads(data), document)
+    def close(self):
+        self._db.close()
@@ -0,0 +1,84 @@
+## Shared by the tests: client.py sub-commands run on a fresh in-memory
+## backend (sample/memstore.py), no Firestore project or network needed.
+##   python -m unittest discover -s sample/tests
+import os, sys
+import contextlib
+import io
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import client
+
+## the home of MemoryTestCase.seed_home() in the import/apply format
+HOME = [
+    { 'kind': 'user', 'id': 'user1', 'name': 'foo@example.jp' },
+    { 'kind': 'user', 'id': 'user2', 'name': 'bar@example.jp' },
+    { 'kind': 'group', 'id': 'group1', 'user_id': ['user1', 'user2'] },
+    { 'kind': 'device', 'id': 'light1', 'manufacturer': 'Panasonic', 'model': 'HH-XCH1222A', 'type': 'LIGHT', 'traits': ['OnOff'], 'attributes': { 'commandOnlyOnOff': True } },
+    { 'kind': 'remote', 'id': 'remote1', 'mac_addr': '34:EA:34:00:00:00', 'remote_type': 'broadlink' },
+    { 'kind': 'ircode', 'id': 'ircode1', 'codes': { 'broadlink': { 'OnOff': { 'on': '2600ac00', 'off': '2600ad00' } } } },
+    { 'kind': 'user_device', 'id': 'ud1', 'device_id': 'light1', 'user_id': 'user1', 'remote_id': 'remote1', 'ircode_id': 'ircode1', 'name': 'living' },
+    { 'kind': 'group_device', 'id': 'gd1', 'device_id': 'light1', 'group_id': 'group1', 'remote_id': 'remote1', 'ircode_id': 'ircode1', 'name': 'hall' },
+]
+
+class MemoryTestCase(unittest.TestCase):
+    ## options before the sub-command, the rate limits are not needed in memory
+    globalArgs = ('--write-rate', '0', '--document-write-interval', '0')
+    def setUp(self):
+        self.backend = client.MemoryBackend()
+        client.set_backend(self.backend)
+        self.db = client.get_client()
+    def cli(self, *argv, db=None, apikey=None):
+        ## (exit status, stdout, stderr) of one client.py command,
+        ## requestSync is sent only with an apikey
+        return self._run(db or self.db, list(self.globalArgs) + list(argv), apikey)
+    def cli_file(self, dataFile, *argv):
+        ## the command loads and saves its own memory backend in dataFile
+        return self._run(None, list(self.globalArgs) + ['--backend', 'memory', '--memory-file', dataFile] + list(argv))
+    def _run(self, db, argv, apikey=None):
+        out, err = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                status = client.run_command(db, apikey, argv)
+            except SystemExit as e:
+                status = e.code
+        return status, out.getvalue(), err.getvalue()
+    def records_file(self, records, suffix='.jsonl'):
+        ## a JSON lines file of import/apply records, removed after the test
+        fd = tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False)
+        self.addCleanup(os.unlink, fd.name)
+        with fd:
+            for record in records:
+                fd.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return fd.name
+    def apply_home(self, records=HOME):
+        status, out, err = self.cli('apply', '--file', self.records_file(records))
+        self.assertEqual(status, 0, err)
+    def seed_home(self):
+        ## a small home written as client.py stores it: two users sharing a
+        ## group, a light with a remote and its codes, seen by both users
+        self.put('users/user1', { 'id': 'user1', 'name': 'foo@example.jp' })
+        self.put('users/user2', { 'id': 'user2', 'name': 'bar@example.jp' })
+        self.put('groups/group1', { 'user1': self.ref('users/user1'), 'user2': self.ref('users/user2') })
+        self.put('user_groups/user1', { 'group1': self.ref('groups/group1') })
+        self.put('user_groups/user2', { 'group1': self.ref('groups/group1') })
+        self.put('devices/light1', { 'manufacturer': 'Panasonic', 'model': 'HH-XCH1222A', 'type': 'action.devices.types.LIGHT',
+            'willReportState': False, 'traits': ['action.devices.traits.OnOff'], 'attributes': { 'commandOnlyOnOff': True } })
+        self.put('remotes/remote1', { 'mac_addr': '34:EA:34:00:00:00', 'type': 'broadlink' })
+        self.put('ircodes/ircode1', {})
+        self.put('ircodes/ircode1/broadlink/action.devices.commands.OnOff', { 'on': '2600ac00', 'off': '2600ad00' })
+        self.put('user_devices/ud1', { 'deviceId': 'light1', 'userId': 'user1', 'remoteId': 'remote1', 'ircodeId': 'ircode1', 'name': 'living',
+            'deviceReference': self.ref('devices/light1'), 'userReference': self.ref('users/user1'), 'remoteReference': self.ref('remotes/remote1') })
+        self.put('group_devices/gd1', { 'deviceId': 'light1', 'groupId': 'group1', 'remoteId': 'remote1', 'ircodeId': 'ircode1', 'name': 'hall',
+            'deviceReference': self.ref('devices/light1'), 'groupReference': self.ref('groups/group1'), 'remoteReference': self.ref('remotes/remote1') })
+    def put(self, path, docdata):
+        self.db.document(path).set(docdata)
+    def ref(self, path):
+        return self.db.document(path)
+    def data(self, path):
+        docsnap = self.db.document(path).get()
+        return docsnap.to_dict() if docsnap.exists else None
+    def paths(self, collectionPath):
+        return sorted(path for path in self.db.dump() if path.rsplit('/', 1)[0] == collectionPath)
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import support
+import client
+
+class ApplyTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.apply_home()
+    def apply(self, records, *argv, options=()):
+        store = self.db._store
+        writes = store.writes
+        status, out, err = self.cli(*options, 'apply', '--file', self.records_file(records), *argv)
+        self.assertEqual(status, 0, err)
+        return out, store.writes - writes
+
+    def test_apply_again_writes_nothing(self):
+        before = self.db.dump()
+        out, writes = self.apply(support.HOME)
+        self.assertTrue(out.startswith('0 created, 0 updated, 0 deleted, 9 unchanged in 0 commits'), out)
+        self.assertEqual(writes, 0)
+        self.assertEqual(self.db.dump(), before)
+
+    def test_only_changed_documents_are_written(self):
+        records = [ dict(record, name='new@example.jp') if record['id'] == 'user1' else record for record in support.HOME ]
+        out, writes = self.apply(records, '--dry-run')
+        self.assertEqual(out, 'users/user1 would be updated\n0 created, 1 updated, 0 deleted, 8 unchanged\n')
+        self.assertEqual(writes, 0)
+        out, writes = self.apply(records)
+        self.assertTrue(out.startswith('0 created, 1 updated, 0 deleted, 8 unchanged in 1 commits'), out)
+        self.assertEqual(self.data('users/user1')['name'], 'new@example.jp')
+        self.assertEqual(self.apply(records)[1], 0)
+
+    def test_prune_deletes_what_the_file_does_not_have(self):
+        self.put('user_devices/ud9', dict(self.data('user_devices/ud1'), name='old'))
+        out, writes = self.apply(support.HOME)
+        self.assertIsNotNone(self.data('user_devices/ud9'))
+        out, writes = self.apply(support.HOME, '--prune')
+        self.assertTrue(out.startswith('0 created, 0 updated, 1 deleted, 9 unchanged'), out)
+        self.assertIsNone(self.data('user_devices/ud9'))
+        ## kinds missing from the file are not pruned
+        out, writes = self.apply([ record for record in support.HOME if record['kind'] != 'group_device' ], '--prune')
+        self.assertEqual(writes, 0)
+        self.assertIsNotNone(self.data('group_devices/gd1'))
+
+    def test_prune_with_a_warm_cache(self):
+        self.put('groups/group9', { 'user1': self.ref('users/user1') })
+        self.put('user_groups/user1', { 'group1': self.ref('groups/group1'), 'group9': self.ref('groups/group9') })
+        self.put('user_devices/ud9', dict(self.data('user_devices/ud1'), name='old'))
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        filename = os.path.join(tmpdir.name, 'cache.db')
+        ## only ud9 is cached, so the snapshots do not come back in the order asked
+        cache = client.DocumentCache(filename)
+        cache.store(self.ref('user_devices/ud9').get(), client.User(self.db, None, None, None, None)._is_reference)
+        cache.close()
+        out, writes = self.apply(support.HOME, '--prune', options=('--cache', filename))
+        self.assertTrue(out.startswith('0 created, 0 updated, 2 deleted, 9 unchanged'), out)
+        self.assertEqual(self.paths('groups'), ['groups/group1'])
+        self.assertIsNone(self.data('user_devices/ud9'))
+        self.assertEqual(self.data('user_groups/user1'), { 'group1': self.ref('groups/group1') })
+
+    def test_compact_apply_is_idempotent(self):
+        out, writes = self.apply(support.HOME, '--compact')
+        self.assertGreater(writes, 0)
+        self.assertEqual(len(self.paths('ircode_blobs')), 2)
+        out, writes = self.apply(support.HOME, '--compact')
+        self.assertEqual(writes, 0)
@@ -0,0 +1,23 @@
+import support
+import client
+
+class AsyncEngineTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+
+    def test_commands_print_the_same_as_the_sync_engine(self):
+        for argv in (('get_user_device', '--full'), ('get_group_device', '--full'), ('get_group', '--full')):
+            expected = self.cli(*argv)
+            self.assertEqual(expected[0], 0, expected[2])
+            self.assertEqual(self.cli('--engine', 'async', *argv), expected)
+
+    def test_chunks_are_read_together(self):
+        engine = client.AsyncEngine(self.backend, concurrency=2, chunkSize=2)
+        self.addCleanup(engine.close)
+        paths = [ 'users/user1', 'users/user2', 'devices/light1', 'remotes/remote1', 'users/nobody' ]
+        rpcs = self.db._store.rpcs
+        docsnaps = engine.get_all([ self.ref(path) for path in paths ])
+        self.assertEqual(self.db._store.rpcs - rpcs, 3)
+        self.assertEqual(sorted(docsnap.reference.path for docsnap in docsnaps), sorted(paths))
+        self.assertEqual([ docsnap.reference.path for docsnap in docsnaps if not docsnap.exists ], ['users/nobody'])
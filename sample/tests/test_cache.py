@@ -0,0 +1,63 @@
+import os
+import tempfile
+import support
+import client
+
+class DocumentCacheTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = client.DocumentCache(os.path.join(self.tmpdir.name, 'cache.db'))
+        self.command = client.User(self.db, None, None, None, self.cache)
+        self.put('users/u1', { 'name': 'a@example.jp' })
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+    def read(self, path):
+        return [ docsnap.to_dict() for docsnap in self.command._get_all([ self.ref(path) ]) ]
+
+    def test_cached_document_is_not_read_again(self):
+        self.read('users/u1')
+        rpcs = self.db._store.rpcs
+        self.assertEqual(self.read('users/u1'), [{ 'name': 'a@example.jp' }])
+        self.assertEqual(self.db._store.rpcs, rpcs)
+        self.assertEqual(self.cache.counters(), (1, 1))
+
+    def test_expired_document_is_read_again(self):
+        self.read('users/u1')
+        ## written by another process
+        self.put('users/u1', { 'name': 'b@example.jp' })
+        self.assertEqual(self.read('users/u1'), [{ 'name': 'a@example.jp' }])
+        self.cache.ttl = 0
+        self.assertEqual(self.read('users/u1'), [{ 'name': 'b@example.jp' }])
+
+    def test_cache_is_kept_in_the_file(self):
+        self.read('users/u1')
+        self.cache.close()
+        cache = client.DocumentCache(self.cache.filename)
+        docsnap = cache.lookup(self.ref('users/u1'), self.db.document)
+        self.assertEqual(docsnap.to_dict(), { 'name': 'a@example.jp' })
+
+    def test_existence_check_bypasses_the_cache(self):
+        self.read('users/u1')
+        self.db.document('users/u1').delete()
+        missing, docsnaps = self.command._missing_references([ self.ref('users/u1') ])
+        self.assertEqual(missing, ['users/u1'])
+        ## the deleted document is dropped from the cache too
+        self.assertIsNone(self.cache.lookup(self.ref('users/u1'), self.db.document))
+
+    def test_deleted_document_is_invalidated(self):
+        self.read('users/u1')
+        self.command._del('u1')
+        self.assertIsNone(self.cache.lookup(self.ref('users/u1'), self.db.document))
+
+    def test_listener_keeps_cached_documents_current(self):
+        self.cache.listen(self.db, self.command._is_reference)
+        self.read('users/u1')
+        self.put('users/u1', { 'name': 'b@example.jp' })
+        self.put('users/u2', { 'name': 'c@example.jp' })
+        self.assertEqual(self.read('users/u1'), [{ 'name': 'b@example.jp' }])
+        ## only documents already cached are added
+        self.assertNotIn('users/u2', self.cache._entries())
+        self.db.document('users/u1').delete()
+        self.assertIsNone(self.cache.lookup(self.ref('users/u1'), self.db.document))
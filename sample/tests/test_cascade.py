@@ -0,0 +1,41 @@
+import support
+
+class CascadeTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+
+    def test_dry_run_writes_nothing(self):
+        before = self.db.dump()
+        status, out, err = self.cli('del_user', '--user-id', 'user1', '--cascade', '--dry-run')
+        self.assertEqual(status, 0, err)
+        self.assertIn('user_devices/ud1 would be deleted\n', out)
+        self.assertIn('groups/group1 would be updated (user1)\n', out)
+        self.assertEqual(self.db.dump(), before)
+
+    def test_user_is_removed_from_its_groups(self):
+        status, out, err = self.cli('del_user', '--user-id', 'user1', '--cascade')
+        self.assertEqual(status, 0, err)
+        self.assertIsNone(self.data('users/user1'))
+        self.assertIsNone(self.data('user_devices/ud1'))
+        self.assertIsNone(self.data('user_groups/user1'))
+        self.assertEqual(list(self.data('groups/group1')), ['user2'])
+        ## the group and its devices are kept for the other member
+        self.assertIsNotNone(self.data('group_devices/gd1'))
+
+    def test_device_takes_its_user_and_group_devices(self):
+        status, out, err = self.cli('del_device', '--device-id', 'light1', '--cascade')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(out, 'devices/light1 was deleted\n3 documents deleted, 0 updated\n')
+        self.assertEqual(self.paths('user_devices') + self.paths('group_devices'), [])
+        self.assertEqual(self.data('user_syncs/user1')['devices'], [])
+
+    def test_ircode_takes_its_subcollections(self):
+        status, out, err = self.cli('del_ircode', '--ircode-id', 'ircode1', '--cascade')
+        self.assertEqual(status, 0, err)
+        self.assertEqual([ path for path in self.db.dump() if path.startswith('ircodes/') ], [])
+
+    def test_without_cascade_the_links_are_kept(self):
+        status, out, err = self.cli('del_device', '--device-id', 'light1')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.paths('user_devices'), ['user_devices/ud1'])
@@ -0,0 +1,49 @@
+import contextlib
+import io
+import support
+import client
+import executor
+
+ON = client.DEVICE_COMMANDS_PREFIX + 'OnOff'
+
+class Transmitter(object):
+    def __init__(self):
+        self.sent = []
+    def send(self, mac_addr, code):
+        self.sent.append((mac_addr, code))
+
+class DeviceMapTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+        self.devices = executor.DeviceMap(self.db, timeout=1.0)
+        self.devices.start()
+        self.addCleanup(self.devices.close)
+
+    def test_resolve_reads_nothing(self):
+        rpcs = self.db._store.rpcs
+        remote, actions = self.devices.resolve('ud1')
+        self.assertEqual(self.db._store.rpcs, rpcs)
+        self.assertEqual(remote['mac_addr'], '34:EA:34:00:00:00')
+        self.assertEqual(actions[ON], { 'on': '2600ac00', 'off': '2600ad00' })
+
+    def test_changes_are_followed(self):
+        status, out, err = self.cli('add_remote_code', '--ircode-id', 'ircode1', '--remote-type', 'broadlink', '--action', 'OnOff', '--values', 'on=2600ae00', '--compact')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.devices.resolve('gd1')[1][ON]['on'], '2600ae00')
+        self.db.document('user_devices/ud1').delete()
+        with self.assertRaises(LookupError):
+            self.devices.resolve('ud1')
+
+    def test_commands_send_the_learned_codes(self):
+        source = executor.LineSource('-')
+        transmitter = Transmitter()
+        runner = executor.Executor(self.devices, source, transmitter)
+        with contextlib.redirect_stderr(io.StringIO()):
+            runner.submit('ud1', [{ 'command': ON, 'params': { 'on': True } }], 0)
+            runner.submit('ud1', [{ 'command': ON, 'params': { 'on': False } }], 0)
+            runner.submit('nodevice', [{ 'command': ON, 'params': { 'on': True } }], 0)
+            runner.close()
+        self.assertEqual(transmitter.sent, [('34:EA:34:00:00:00', '2600ac00'), ('34:EA:34:00:00:00', '2600ad00')])
+        self.assertEqual(source.state('ud1'), { 'on': False })
+        self.assertEqual(runner.stats()['failed'], 1)
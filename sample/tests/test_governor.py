@@ -0,0 +1,122 @@
+import io
+from unittest import mock
+import support
+import client
+
+class GovernedClientTest(support.MemoryTestCase):
+    def test_cascade_delete_user_removes_group_member(self):
+        self.put('users/u1', { 'id': 'u1' })
+        self.put('users/u2', { 'id': 'u2' })
+        status, out, err = self.cli('add_group', '--user-id', 'u1', '--user-id', 'u2')
+        self.assertEqual(status, 0)
+        group_id = self.paths('groups')[0].split('/')[1]
+        status, out, err = self.cli('del_user', '--user-id', 'u1', '--cascade')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(list(self.data('groups/' + group_id)), ['u2'])
+        self.assertIsNone(self.data('user_groups/u1'))
+        status, out, err = self.cli('build_user_groups', '--verify')
+        self.assertIn('0 inconsistent', out)
+
+    def test_where_unwraps_governed_reference(self):
+        self.put('users/u1', { 'id': 'u1' })
+        self.put('groups/g1', { 'u1': self.ref('users/u1') })
+        governed = client.GovernedClient(self.db, client.WriteGovernor(0, None, 0))
+        query = governed.collection('groups').where('u1', '==', governed.document('users/u1'))
+        self.assertEqual([ docsnap.id for docsnap in query.stream() ], ['g1'])
+
+class SharedGovernorTest(support.MemoryTestCase):
+    def test_shell_command_uses_the_shell_governor(self):
+        governor = client.WriteGovernor(0, None, 0)
+        governed = client.GovernedClient(self.db, governor)
+        with mock.patch.object(client.WriteGovernor, '__init__', side_effect=AssertionError('second governor')):
+            status, out, err = self.cli('add_user', '--name', 'a@example.jp', db=governed)
+        self.assertEqual(status, 0, err)
+        ## add, update of the id and the user_groups document
+        self.assertEqual(governor.writes, 3)
+
+class CoalesceTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.delete = self.backend.delete_field()
+    def coalesce(self, previous, current):
+        return client._coalesce(previous, current, self.delete)
+
+    def test_merged_sets_become_one(self):
+        self.assertEqual(self.coalesce(('set', { 'a': 1, 'm': { 'x': 1 } }, True), ('set', { 'b': 2, 'm': { 'y': 2 } }, True)),
+            ('set', { 'a': 1, 'b': 2, 'm': { 'x': 1, 'y': 2 } }, True))
+        self.assertEqual(self.coalesce(('set', { 'a': 1, 'b': 2 }, False), ('set', { 'b': self.delete }, True)),
+            ('set', { 'a': 1 }, False))
+
+    def test_updates_become_one(self):
+        self.assertEqual(self.coalesce(('update', { 'a': 1 }, False), ('update', { 'b': 2 }, False)), ('update', { 'a': 1, 'b': 2 }, False))
+        ## a field and a field below it stay two writes
+        self.assertIsNone(self.coalesce(('update', { 'm': {} }, False), ('update', { 'm.x': 1 }, False)))
+
+    def test_last_full_write_wins(self):
+        self.assertEqual(self.coalesce(('set', { 'a': 1 }, True), ('delete', None, False)), ('delete', None, False))
+        self.assertEqual(self.coalesce(('delete', None, False), ('set', { 'a': 1 }, True)), ('set', { 'a': 1 }, False))
+
+    def test_create_and_update_keep_their_errors(self):
+        self.assertIsNone(self.coalesce(('update', { 'a': 1 }, False), ('delete', None, False)))
+        self.assertIsNone(self.coalesce(('create', { 'a': 1 }, False), ('set', { 'b': 2 }, True)))
+        self.assertIsNone(self.coalesce(('set', { 'a': 1 }, False), ('create', { 'b': 2 }, False)))
+
+    def test_batch_sends_one_write_per_document(self):
+        governor = client.WriteGovernor(0, None, 0)
+        governed = client.GovernedClient(self.db, governor)
+        batch = governed.batch()
+        batch.set(governed.document('users/u1'), { 'name': 'a' }, merge=True)
+        batch.set(governed.document('users/u1'), { 'id': 'u1' }, merge=True)
+        batch.set(governed.document('users/u2'), { 'id': 'u2' })
+        self.assertEqual(len(batch), 2)
+        writes = self.db._store.writes
+        batch.commit()
+        self.assertEqual(self.db._store.writes - writes, 2)
+        self.assertEqual((governor.writes, governor.coalesced), (2, 1))
+        self.assertEqual(self.data('users/u1'), { 'name': 'a', 'id': 'u1' })
+
+class RetryTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.governor = client.WriteGovernor(0, None, 0)
+        self.governor.backoffBase = 0.05
+        self.governed = client.GovernedClient(self.db, self.governor)
+        patcher = mock.patch('sys.stderr', new_callable=io.StringIO)
+        self.err = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resource_exhausted_is_retried_at_half_the_rate(self):
+        self.governor.rate = self.governor.tokens = 1000
+        self.db._store.writeRate = 2
+        self.governed.document('users/u1').set({ 'id': 'u1' })
+        self.governed.document('users/u2').set({ 'id': 'u2' })
+        ## over the backend's rate until its second is over
+        self.governed.document('users/u3').set({ 'id': 'u3' })
+        self.assertEqual(self.paths('users'), ['users/u1', 'users/u2', 'users/u3'])
+        self.assertGreater(self.governor.retries, 0)
+        self.assertLess(self.governor.rate, 1000)
+        self.assertIn('write failed (ResourceExhausted)', self.err.getvalue())
+
+    def test_aborted_is_retried_at_the_same_rate(self):
+        self.governor.rate = self.governor.tokens = 1000
+        self.db._store.documentInterval = 0.2
+        self.governed.document('users/u1').set({ 'name': 'a' })
+        self.governed.document('users/u1').set({ 'name': 'b' })
+        self.assertEqual(self.data('users/u1'), { 'name': 'b' })
+        self.assertGreater(self.governor.retries, 0)
+        self.assertEqual(self.governor.rate, 1000)
+
+    def test_document_interval_spaces_the_writes(self):
+        ## the store sees the writes a little later than the governor plans them
+        self.governor.documentInterval = 0.25
+        self.db._store.documentInterval = 0.2
+        self.governed.document('users/u1').set({ 'name': 'a' })
+        self.governed.document('users/u1').set({ 'name': 'b' })
+        ## waited instead of failing
+        self.assertEqual(self.governor.retries, 0)
+        self.assertGreater(self.governor.waited, 0.1)
+
+    def test_other_errors_are_not_retried(self):
+        with self.assertRaises(Exception):
+            self.governed.document('users/nobody').update({ 'name': 'a' })
+        self.assertEqual(self.governor.retries, 0)
@@ -0,0 +1,65 @@
+import support
+
+RECORDS = [
+    { 'kind': 'device', 'ref': 'light', 'manufacturer': 'Panasonic', 'model': 'HH-XCH1222A', 'type': 'LIGHT', 'traits': ['OnOff'] },
+    { 'kind': 'remote', 'ref': 'remote', 'mac_addr': '34:EA:34:00:00:00', 'remote_type': 'broadlink' },
+    { 'kind': 'user', 'ref': 'alice', 'name': 'alice@example.jp' },
+    { 'kind': 'user', 'ref': 'bob', 'name': 'bob@example.jp' },
+    { 'kind': 'group', 'ref': 'home', 'user_id': ['alice', 'bob'] },
+    { 'kind': 'user_device', 'device_id': 'light', 'user_id': 'alice', 'remote_id': 'remote', 'name': 'living' },
+    { 'kind': 'group_device', 'device_id': 'light', 'group_id': 'home', 'remote_id': 'remote', 'name': 'hall' },
+]
+
+class ImportTest(support.MemoryTestCase):
+    def import_records(self, records, *argv, suffix='.jsonl'):
+        status, out, err = self.cli('import', '--file', self.records_file(records, suffix), *argv)
+        self.assertEqual(status, 0, err)
+        return out
+
+    def test_records_are_linked_by_their_ref(self):
+        out = self.import_records(RECORDS)
+        self.assertIn('imported 7 documents (1 device, 1 group, 1 group_device, 1 remote, 2 user, 1 user_device)', out)
+        self.assertTrue(out.endswith(', 1 commits\n'), out)
+        [ device ] = self.paths('devices')
+        [ remote ] = self.paths('remotes')
+        users = { self.data(path)['name']: path for path in self.paths('users') }
+        [ group ] = self.paths('groups')
+        self.assertEqual(sorted(reference.path for reference in self.data(group).values()), sorted(users.values()))
+        [ user_device ] = self.paths('user_devices')
+        docdata = self.data(user_device)
+        self.assertEqual(docdata['deviceReference'].path, device)
+        self.assertEqual(docdata['userReference'].path, users['alice@example.jp'])
+        self.assertEqual(docdata['remoteReference'].path, remote)
+        [ group_device ] = self.paths('group_devices')
+        self.assertEqual(self.data(group_device)['groupReference'].path, group)
+
+    def test_writes_are_committed_in_batches(self):
+        out = self.import_records(RECORDS, '--batch-size', '3')
+        self.assertTrue(out.endswith(', 3 commits\n'), out)
+        self.assertEqual(len(self.paths('users')), 2)
+
+    def test_bulk_writer(self):
+        out = self.import_records(RECORDS, '--bulk-writer')
+        self.assertIn('imported 7 documents', out)
+        self.assertIn('bulk writer', out)
+        self.assertEqual(len(self.paths('group_devices')), 1)
+
+    def test_csv_lists_are_split(self):
+        with open(self.records_file([], '.csv'), 'w') as fd:
+            fd.write('kind,manufacturer,model,type,traits,report_state\n')
+            fd.write('device,Panasonic,HH-XCH1222A,LIGHT,OnOff;Brightness,yes\n')
+            filename = fd.name
+        status, out, err = self.cli('import', '--file', filename)
+        self.assertEqual(status, 0, err)
+        [ device ] = self.paths('devices')
+        docdata = self.data(device)
+        self.assertEqual(docdata['traits'], ['action.devices.traits.OnOff', 'action.devices.traits.Brightness'])
+        self.assertTrue(docdata['willReportState'])
+
+    def test_every_invalid_record_is_reported_before_writing(self):
+        records = RECORDS + [ { 'kind': 'toaster' }, { 'kind': 'remote' } ]
+        status, out, err = self.cli('import', '--file', self.records_file(records))
+        self.assertEqual(status, 1)
+        self.assertIn('record 8: toaster is not a known kind', err)
+        self.assertIn('record 9: remote record without mac_addr', err)
+        self.assertEqual(self.db.dump(), {})
@@ -0,0 +1,109 @@
+import os
+import json
+import tempfile
+import support
+import client
+
+CODE = '2600ac00' * 16
+
+class CompactCodeTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dataFile = os.path.join(self.tmpdir.name, 'db.json')
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_compact_code_survives_memory_file(self):
+        backend = client.MemoryBackend(dataFile=self.dataFile)
+        backend.client().document('ircodes/ir1').set({ 'name': 'tv' })
+        backend.close()
+        status, out, err = self.cli_file(self.dataFile, 'add_remote_code', '--ircode-id', 'ir1', '--remote-type', 'broadlink',
+            '--action', 'OnOff', '--values', 'on=' + CODE, '--values', 'off=' + CODE, '--compact')
+        self.assertEqual(status, 0, err)
+        with open(self.dataFile) as fd:
+            documents = json.load(fd)
+        blobs = [ path for path in documents if path.startswith('ircode_blobs/') ]
+        ## both keys share one content-addressed blob
+        self.assertEqual(len(blobs), 1)
+        db = client.MemoryBackend(dataFile=self.dataFile).client()
+        docdata = db.document('ircodes/ir1/broadlink/action.devices.commands.OnOff').get().to_dict()
+        self.assertNotEqual(docdata['on'], CODE)
+        self.assertEqual(client.Ircode(db).expandCodes([docdata]), [{ 'on': CODE, 'off': CODE }])
+
+class MigrateRemoteCodeTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.put('ircodes/ir1', { 'name': 'tv' })
+        self.put('ircodes/ir1/broadlink/action.devices.commands.OnOff', { 'on': CODE })
+        self.put('ircodes/ir1/broadlink/action.devices.commands.Mute', { 'mute': self.ref('ircode_blobs/gone') })
+
+    def test_missing_blob_is_skipped_and_reported(self):
+        status, out, err = self.cli('migrate_remote_code', '--ircode-id', 'ir1')
+        self.assertEqual(status, 1)
+        self.assertIn('ircodes/ir1/broadlink/action.devices.commands.Mute.mute: ircode_blobs/gone does not exist', err)
+        ## the row is kept as it was, not written with a null code
+        self.assertEqual(self.data('ircodes/ir1/broadlink/action.devices.commands.Mute')['mute'].path, 'ircode_blobs/gone')
+        ## the other rows are migrated
+        self.assertNotEqual(self.data('ircodes/ir1/broadlink/action.devices.commands.OnOff')['on'], CODE)
+
+    def test_expand_never_writes_a_null_code(self):
+        status, out, err = self.cli('migrate_remote_code', '--ircode-id', 'ir1', '--expand')
+        self.assertEqual(status, 1)
+        self.assertIsNotNone(self.data('ircodes/ir1/broadlink/action.devices.commands.Mute')['mute'])
+
+class AddRemoteCodeTest(support.MemoryTestCase):
+    def test_missing_ircode_is_rejected(self):
+        status, out, err = self.cli('add_remote_code', '--ircode-id', 'ir1', '--remote-type', 'broadlink',
+            '--action', 'OnOff', '--values', 'on=' + CODE)
+        self.assertEqual(status, 1)
+        self.assertIn('ir1 cannot referenced, check Ircodes', err)
+        self.assertEqual(self.db.dump(), {})
+
+    def test_ircode_and_blobs_are_checked_with_one_read(self):
+        self.put('ircodes/ir1', { 'name': 'tv' })
+        rpcs = self.db._store.rpcs
+        status, out, err = self.cli('add_remote_code', '--ircode-id', 'ir1', '--remote-type', 'broadlink',
+            '--action', 'OnOff', '--values', 'on=' + CODE, '--values', 'off=' + CODE[::-1], '--compact')
+        self.assertEqual(status, 0, err)
+        ## one get_all and one batch commit
+        self.assertEqual(self.db._store.rpcs - rpcs, 2)
+        self.assertEqual(len(self.paths('ircode_blobs')), 2)
+
+class ImportRemoteCodeTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+    def write(self, path, content):
+        path = os.path.join(self.tmpdir.name, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fd:
+            fd.write(content)
+        return path
+
+    def test_imported_ircode_takes_more_codes(self):
+        source = self.write('codes.json', json.dumps({ 'ir1': { 'broadlink': { 'OnOff': { 'on': CODE } } } }))
+        status, out, err = self.cli('import_remote_code', '--from', source)
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.data('ircodes/ir1'), {})
+        status, out, err = self.cli('add_remote_code', '--ircode-id', 'ir1', '--remote-type', 'broadlink',
+            '--action', 'OnOff', '--values', 'off=' + CODE[::-1])
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.data('ircodes/ir1/broadlink/action.devices.commands.OnOff'), { 'on': CODE, 'off': CODE[::-1] })
+
+    def test_directory_is_read_before_writing(self):
+        self.write('codes/broadlink/OnOff/on.txt', CODE)
+        self.write('codes/broadlink/OnOff/off.txt', 'no code learned')
+        status, out, err = self.cli('import_remote_code', '--from', os.path.join(self.tmpdir.name, 'codes'))
+        self.assertEqual(status, 1)
+        self.assertIn('off.txt has no learned code', err)
+        self.assertEqual(self.db.dump(), {})
+
+    def test_directory_makes_a_new_ircode(self):
+        self.write('codes/broadlink/OnOff/on.txt', 'learned hex code: ' + CODE)
+        status, out, err = self.cli('import_remote_code', '--from', os.path.join(self.tmpdir.name, 'codes'))
+        self.assertEqual(status, 0, err)
+        [ ircode ] = self.paths('ircodes')
+        self.assertIn('{} was added\n'.format(ircode), out)
+        self.assertEqual(self.data(ircode + '/broadlink/action.devices.commands.OnOff'), { 'on': CODE })
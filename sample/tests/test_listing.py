@@ -0,0 +1,150 @@
+import json
+from unittest import mock
+import support
+import memstore
+
+class ResolveReferencesTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+        for i in range(2, 5):
+            self.put('user_devices/ud{}'.format(i), dict(self.data('user_devices/ud1'), name='room{}'.format(i)))
+    def list_full(self, *argv):
+        store = self.db._store
+        rpcs, reads = store.rpcs, store.reads
+        status, out, err = self.cli('get_user_device', '--full', '--format', 'jsonl', *argv)
+        self.assertEqual(status, 0, err)
+        return [ json.loads(line) for line in out.splitlines() ], store.rpcs - rpcs, store.reads - reads
+
+    def test_references_of_a_page_are_read_with_one_get_all(self):
+        records, rpcs, reads = self.list_full()
+        self.assertEqual([ record['id'] for record in records ], ['ud1', 'ud2', 'ud3', 'ud4'])
+        self.assertEqual(records[3]['deviceReference']['model'], 'HH-XCH1222A')
+        self.assertEqual(records[3]['userReference'], { 'id': 'user1', 'name': 'foo@example.jp' })
+        ## one query and one get_all of the 3 distinct references
+        self.assertEqual((rpcs, reads), (2, 4 + 3))
+
+    def test_references_are_read_per_page(self):
+        records, rpcs, reads = self.list_full('--page-size', '3')
+        self.assertEqual(len(records), 4)
+        ## two pages, each with its query and its get_all
+        self.assertEqual(rpcs, 4)
+
+    def test_missing_reference_resolves_to_none(self):
+        self.db.document('remotes/remote1').delete()
+        records, rpcs, reads = self.list_full()
+        self.assertEqual([ record['remoteReference'] for record in records ], [None] * 4)
+        self.assertEqual(records[0]['deviceReference']['type'], 'action.devices.types.LIGHT')
+
+    def test_async_engine_resolves_the_same(self):
+        expected = self.list_full()[0]
+        status, out, err = self.cli('--engine', 'async', 'get_user_device', '--full', '--format', 'jsonl', '--page-size', '3')
+        self.assertEqual(status, 0, err)
+        self.assertEqual([ json.loads(line) for line in out.splitlines() ], expected)
+
+class FilterTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+        self.put('devices/light2', self.data('devices/light1'))
+        ud1 = self.data('user_devices/ud1')
+        self.put('user_devices/ud2', dict(ud1, userId='user2', userReference=self.ref('users/user2')))
+        self.put('user_devices/ud3', dict(ud1, deviceId='light2', deviceReference=self.ref('devices/light2')))
+        for i in range(4, 10):
+            self.put('user_devices/ud{}'.format(i), dict(ud1, userId='user2', userReference=self.ref('users/user2'), deviceId='light2'))
+        gd1 = self.data('group_devices/gd1')
+        self.put('group_devices/gd2', dict(gd1, groupId='group2', groupReference=self.ref('groups/group2')))
+    def ids(self, mode, *argv):
+        reads = self.db._store.reads
+        status, out, err = self.cli(mode, '--format', 'jsonl', *argv)
+        self.assertEqual(status, 0, err)
+        return [ json.loads(line)['id'] for line in out.splitlines() ], self.db._store.reads - reads
+
+    def test_only_matching_documents_are_read(self):
+        self.assertEqual(self.ids('get_user_device', '--user-id', 'user1'), (['ud1', 'ud3'], 2))
+        self.assertEqual(self.ids('get_user_device', '--user-id', 'user1', '--device-id', 'light2'), (['ud3'], 1))
+        self.assertEqual(self.ids('get_user_device', '--device-id', 'light1', '--remote-id', 'remote1'), (['ud1', 'ud2'], 2))
+        self.assertEqual(self.ids('get_group_device', '--group-id', 'group2'), (['gd2'], 1))
+
+    def test_no_match_costs_one_read(self):
+        self.assertEqual(self.ids('get_user_device', '--user-id', 'nobody'), ([], 1))
+
+    def test_filters_apply_to_one_document(self):
+        self.assertEqual(self.ids('get_user_device', '--user-device-id', 'ud2', '--user-id', 'user2')[0], ['ud2'])
+        self.assertEqual(self.ids('get_user_device', '--user-device-id', 'ud2', '--user-id', 'user1')[0], [])
+
+class PagingTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        for i in range(7):
+            self.put('users/u{}'.format(i), { 'id': 'u{}'.format(i), 'name': 'u{}@example.jp'.format(i) })
+    def ids(self, *argv):
+        store = self.db._store
+        rpcs, reads = store.rpcs, store.reads
+        status, out, err = self.cli('get_user', '--format', 'jsonl', *argv)
+        self.assertEqual(status, 0, err)
+        return [ json.loads(line)['id'] for line in out.splitlines() ], store.rpcs - rpcs, store.reads - reads
+
+    def test_limit_reads_no_more_than_asked(self):
+        self.assertEqual(self.ids('--limit', '3'), (['u0', 'u1', 'u2'], 1, 3))
+        ## pages of 2, the last one cut to the limit
+        self.assertEqual(self.ids('--limit', '3', '--page-size', '2'), (['u0', 'u1', 'u2'], 2, 3))
+
+    def test_start_after_resumes_the_listing(self):
+        ids, rpcs, reads = self.ids('--start-after', 'u4')
+        self.assertEqual(ids, ['u5', 'u6'])
+        pages = []
+        last = None
+        while True:
+            ids = self.ids('--limit', '3', *(('--start-after', last) if last else ()))[0]
+            if not ids:
+                break
+            pages.append(ids)
+            last = ids[-1]
+        self.assertEqual(pages, [['u0', 'u1', 'u2'], ['u3', 'u4', 'u5'], ['u6']])
+
+    def test_every_page_is_read(self):
+        ids, rpcs, reads = self.ids('--page-size', '3')
+        self.assertEqual(ids, [ 'u{}'.format(i) for i in range(7) ])
+        self.assertEqual(rpcs, 3)
+
+    def test_jsonl_keeps_references_as_paths(self):
+        self.put('groups/g1', { 'u0': self.ref('users/u0') })
+        status, out, err = self.cli('get_group', '--format', 'jsonl')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(out, '{"id": "g1", "u0": "users/u0"}\n')
+        status, out, err = self.cli('get_group', '--full', '--format', 'jsonl')
+        self.assertEqual(json.loads(out), { 'id': 'g1', 'u0': { 'id': 'u0', 'name': 'u0@example.jp' } })
+
+class ProjectionTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+    def records(self, mode, *argv):
+        status, out, err = self.cli(mode, '--format', 'jsonl', *argv)
+        self.assertEqual(status, 0, err)
+        return [ json.loads(line) for line in out.splitlines() ]
+
+    def test_one_document_is_filtered_on_fields_left_out(self):
+        self.assertEqual(self.records('get_user_device', '--user-device-id', 'ud1', '--user-id', 'user1'),
+            [{ 'id': 'ud1', 'deviceId': 'light1', 'remoteId': 'remote1', 'name': 'living' }])
+        self.assertEqual(self.records('get_user_device', '--user-device-id', 'ud1', '--user-id', 'user2'), [])
+
+    def test_summary_listing_selects_its_fields(self):
+        selected = []
+        select = memstore.Query.select
+        def spy(query, field_paths):
+            selected.append(list(field_paths))
+            return select(query, field_paths)
+        rpcs = self.db._store.rpcs
+        with mock.patch.object(memstore.Query, 'select', spy):
+            records = self.records('get_user_device')
+        self.assertEqual(selected, [['deviceId', 'remoteId', 'name']])
+        self.assertEqual(records, [{ 'id': 'ud1', 'deviceId': 'light1', 'remoteId': 'remote1', 'name': 'living' }])
+        ## no reference is resolved
+        self.assertEqual(self.db._store.rpcs - rpcs, 1)
+
+    def test_full_listing_reads_everything(self):
+        [ record ] = self.records('get_user_device', '--full')
+        self.assertEqual(record['userReference'], { 'id': 'user1', 'name': 'foo@example.jp' })
+        self.assertEqual(record['ircodeId'], 'ircode1')
@@ -0,0 +1,32 @@
+import os
+import json
+import tempfile
+import support
+import client
+
+class MemoryBackendTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dataFile = os.path.join(self.tmpdir.name, 'db.json')
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_data_file_round_trip(self):
+        status, out, err = self.cli_file(self.dataFile, 'add_user', '--name', 'a@example.jp')
+        self.assertEqual(status, 0, err)
+        db = client.MemoryBackend(dataFile=self.dataFile).client()
+        users = [ path for path in db.dump() if path.startswith('users/') ]
+        self.assertEqual(len(users), 1)
+        self.assertEqual(db.document(users[0]).get().get('name'), 'a@example.jp')
+
+    def test_failed_save_keeps_data_file(self):
+        with open(self.dataFile, 'w') as fd:
+            json.dump({ 'users/u1': { 'id': 'u1' } }, fd)
+        backend = client.MemoryBackend(dataFile=self.dataFile)
+        backend.client().document('users/u2').set({ 'id': object() })
+        with self.assertRaises(TypeError):
+            backend.close()
+        with open(self.dataFile) as fd:
+            self.assertEqual(json.load(fd), { 'users/u1': { 'id': 'u1' } })
+        self.assertEqual(os.listdir(self.tmpdir.name), ['db.json'])
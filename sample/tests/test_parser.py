@@ -0,0 +1,30 @@
+from unittest import mock
+import support
+import client
+
+class BuildParserTest(support.MemoryTestCase):
+    def options(self, parser, mode):
+        subparsers = next(action for action in parser._actions if action.dest == 'mode')
+        return [ action.dest for action in subparsers.choices[mode]._actions if action.dest != 'help' ]
+
+    def test_every_mode_by_default(self):
+        parser = client.build_parser()
+        self.assertEqual(self.options(parser, 'add_user'), ['name'])
+        self.assertIn('device_id', self.options(parser, 'get_device'))
+
+    def test_only_the_given_mode(self):
+        parser = client.build_parser('add_user')
+        self.assertEqual(self.options(parser, 'add_user'), ['name'])
+        self.assertEqual(self.options(parser, 'get_device'), [])
+
+    def test_no_mode_builds_no_options(self):
+        built = []
+        original = client.build_parser
+        def build_parser(only=client.ALL_MODES):
+            built.append(only)
+            return original(only)
+        with mock.patch.object(client, 'build_parser', build_parser):
+            status, out, err = self.cli()
+        self.assertEqual(status, 255)
+        self.assertEqual(built, [None])
+        self.assertEqual(self.options(client.build_parser(None), 'add_user'), [])
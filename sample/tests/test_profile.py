@@ -0,0 +1,120 @@
+import io
+import json
+import unittest
+import support
+import client
+
+class Document(object):
+    ## the calls of a Firestore document the profiled client forwards
+    def __init__(self, path):
+        self.path = path
+    def get(self):
+        return self.path
+    def set(self, docdata, merge=False):
+        return 'updated'
+    def delete(self):
+        return 'deleted'
+
+class Batch(list):
+    def set(self, reference, docdata, merge=False):
+        self.append(('set', reference.path))
+    def delete(self, reference):
+        self.append(('delete', reference.path))
+    def commit(self):
+        return [ 'updated' ] * len(self)
+
+class Client(object):
+    def document(self, path):
+        return Document(path)
+    def get_all(self, references):
+        return [ reference.path for reference in references ]
+    def batch(self):
+        return Batch()
+
+class ProfilerTest(unittest.TestCase):
+    def test_summary_and_cost(self):
+        profiler = client.Profiler()
+        profiler.record('client.get_all', 0.004, reads=100)
+        profiler.record('client.get_all', 0.030, reads=50)
+        profiler.record('batch.commit', 0.002, writes=20, deletes=10)
+        summary = profiler.summary()
+        self.assertEqual(summary['totals'], { 'calls': 3, 'rpcs': 3, 'reads': 150, 'writes': 20, 'deletes': 10, 'http': 0 })
+        self.assertEqual(summary['operations']['client.get_all']['histogram_ms'], { '<=5': 1, '<=50': 1 })
+        self.assertEqual(summary['operations']['client.get_all']['latency_ms']['max'], 30.0)
+        self.assertEqual(summary['estimated_cost_usd'], round((150 * 0.06 + 20 * 0.18 + 10 * 0.02) / 100000, 8))
+
+    def test_json_report(self):
+        profiler = client.Profiler()
+        profiler.record('http.requestSync', 0.1, rpcs=0, http=1)
+        stream = io.StringIO()
+        profiler.report('json', stream)
+        self.assertEqual(json.loads(stream.getvalue())['totals']['http'], 1)
+
+    def test_n_plus_one_reads_are_noted(self):
+        profiler = client.Profiler()
+        for i in range(11):
+            profiler.record('document.get', 0.001, reads=1)
+        stream = io.StringIO()
+        profiler.report('text', stream)
+        self.assertIn('note: 11 single document gets, check for N+1 reads', stream.getvalue())
+
+class ProfiledClientTest(unittest.TestCase):
+    def setUp(self):
+        self.profiler = client.Profiler()
+        self.db = client.ProfiledClient(Client(), self.profiler)
+    def counts(self, operation):
+        op = self.profiler.summary()['operations'][operation]
+        return op['calls'], op['rpcs'], op['reads'], op['writes'], op['deletes']
+
+    def test_calls_are_forwarded_and_counted(self):
+        self.assertEqual(self.db.document('users/u1').get(), 'users/u1')
+        self.db.document('users/u1').set({ 'name': 'a' })
+        self.db.document('users/u2').delete()
+        self.assertEqual(self.counts('document.get'), (1, 1, 1, 0, 0))
+        self.assertEqual(self.counts('document.set'), (1, 1, 0, 1, 0))
+        self.assertEqual(self.counts('document.delete'), (1, 1, 0, 0, 1))
+
+    def test_get_all_is_one_rpc(self):
+        references = [ self.db.document('users/u{}'.format(i)) for i in range(3) ]
+        ## the wrapped client gets the unwrapped references
+        self.assertEqual(self.db.get_all(references), [ 'users/u0', 'users/u1', 'users/u2' ])
+        self.assertEqual(self.counts('client.get_all'), (1, 1, 3, 0, 0))
+
+    def test_batch_is_counted_when_committed(self):
+        batch = self.db.batch()
+        batch.set(self.db.document('users/u1'), { 'name': 'a' })
+        batch.set(self.db.document('users/u2'), { 'name': 'b' })
+        batch.delete(self.db.document('users/u3'))
+        self.assertEqual(self.profiler.summary()['operations'], {})
+        batch.commit()
+        self.assertEqual(self.counts('batch.commit'), (1, 1, 0, 2, 1))
+
+class MemoryBackendProfileTest(support.MemoryTestCase):
+    ## the memory backend bills reads and writes like Firestore
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.put('users/u1', { 'id': 'u1', 'name': 'a@example.jp' })
+        self.put('devices/d1', { 'manufacturer': 'Panasonic', 'model': 'HH-XCH1222A', 'type': 'action.devices.types.LIGHT', 'traits': ['action.devices.traits.OnOff'] })
+        self.put('remotes/r1', { 'mac_addr': '34:EA:34:00:00:00', 'type': 'broadlink' })
+        self.put('user_devices/ud1', { 'deviceId': 'd1', 'userId': 'u1', 'remoteId': 'r1',
+            'deviceReference': self.ref('devices/d1'), 'userReference': self.ref('users/u1'), 'remoteReference': self.ref('remotes/r1') })
+    def profile(self, *argv):
+        store = self.db._store
+        before = (store.rpcs, store.reads, store.writes)
+        status, out, err = self.cli('--profile', '--profile-format', 'json', *argv)
+        self.assertEqual(status, 0, err)
+        return json.loads(err), (store.rpcs - before[0], store.reads - before[1], store.writes - before[2])
+
+    def test_reads_are_counted_as_the_backend_bills_them(self):
+        summary, (rpcs, reads, writes) = self.profile('get_user_device', '--user-id', 'u1', '--full')
+        totals = summary['totals']
+        self.assertEqual((totals['rpcs'], totals['reads'], totals['writes']), (rpcs, reads, writes))
+        ## the references of the user device are resolved with one get_all
+        self.assertEqual(summary['operations']['client.get_all']['calls'], 1)
+        self.assertEqual(summary['estimated_cost_usd'], round(reads * 0.06 / 100000, 8))
+
+    def test_writes_are_counted(self):
+        summary, (rpcs, reads, writes) = self.profile('add_user', '--name', 'b@example.jp')
+        totals = summary['totals']
+        self.assertEqual((totals['rpcs'], totals['reads'], totals['writes']), (rpcs, reads, writes))
+        self.assertGreater(totals['writes'], 0)
@@ -0,0 +1,40 @@
+import support
+
+class ReferenceCheckTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+        self.before = self.db.dump()
+
+    def test_every_missing_reference_is_reported_with_one_read(self):
+        rpcs = self.db._store.rpcs
+        status, out, err = self.cli('add_user_device', '--device-id', 'nolight', '--user-id', 'user1', '--remote-id', 'noremote')
+        self.assertEqual(status, 1)
+        self.assertEqual(err, 'nolight cannot referenced, check Devices\nnoremote cannot referenced, check Remotes\n')
+        self.assertEqual(self.db._store.rpcs - rpcs, 1)
+        self.assertEqual(self.db.dump(), self.before)
+
+    def test_group_member_must_exist(self):
+        status, out, err = self.cli('add_group', '--user-id', 'user1', '--user-id', 'ghost')
+        self.assertEqual(status, 1)
+        self.assertEqual(err, 'ghost cannot referenced, check Users\n')
+        self.assertEqual(self.db.dump(), self.before)
+
+    def test_import_writes_nothing_when_a_record_is_dangling(self):
+        records = [
+            { 'kind': 'user', 'id': 'user3' },
+            { 'kind': 'user_device', 'device_id': 'light1', 'user_id': 'ghost', 'remote_id': 'remote1' },
+        ]
+        status, out, err = self.cli('import', '--file', self.records_file(records))
+        self.assertEqual(status, 1)
+        self.assertIn('record 2: ghost cannot referenced, check Users', err)
+        self.assertEqual(self.db.dump(), self.before)
+
+    def test_record_may_reference_a_record_of_the_same_file(self):
+        records = [
+            { 'kind': 'user', 'ref': 'new-user' },
+            { 'kind': 'user_device', 'device_id': 'light1', 'user_id': 'new-user', 'remote_id': 'remote1' },
+        ]
+        status, out, err = self.cli('import', '--file', self.records_file(records))
+        self.assertEqual(status, 0, err)
+        self.assertEqual(len(self.paths('user_devices')), 2)
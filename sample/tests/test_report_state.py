@@ -0,0 +1,46 @@
+import json
+import tempfile
+import types
+import support
+import client
+
+class ReportStateTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.put('users/u1', { 'id': 'u1' })
+        self.put('user_devices/ud1', { 'userId': 'u1', 'deviceId': 'd1' })
+        self.command = client.ReportState(self.db)
+        self.command.agents = {}
+        self.command.invalid = 0
+        self.command.publisher = client.ReportStatePublisher('http://127.0.0.1:9', None)
+        ## reports are kept, not sent
+        self.command.publisher.submit = lambda agent_user_id: None
+    def event(self, path, data, event_type='put'):
+        return types.SimpleNamespace(path=path, data=data, event_type=event_type)
+
+    def test_nested_events_are_merged_per_device(self):
+        self.command.on_state_event(self.event('/ud1/on', True))
+        self.command.on_state_event(self.event('/ud1/color/spectrumRGB', 255))
+        self.command.on_state_event(self.event('/ud1/color/name', 'blue'))
+        self.assertEqual(self.command.publisher.states, { 'u1': { 'ud1': { 'on': True, 'color': { 'spectrumRGB': 255, 'name': 'blue' } } } })
+
+    def test_initial_put_is_not_reported(self):
+        self.command.on_state_event(self.event('/', { 'ud1': { 'on': True } }))
+        self.assertEqual(self.command.publisher.states, {})
+
+    def test_invalid_state_is_dropped(self):
+        self.command.on_state_event(self.event('/ud1/brightness', 150))
+        self.assertEqual(self.command.publisher.states, {})
+
+    def test_invalid_state_fails_the_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as fd:
+            fd.write(json.dumps({ 'id': 'ud1', 'state': { 'brightness': 150 } }) + '\n')
+            fd.flush()
+            status, out, err = self.cli('report_state', '--states', fd.name)
+        self.assertEqual(status, 1)
+        self.assertIn('states/ud1.brightness: 150 is out of range 0..100', err)
+
+    def test_database_url_requires_firebase_backend(self):
+        status, out, err = self.cli('report_state', '--database-url', 'https://example.firebaseio.com')
+        self.assertEqual(status, 1)
+        self.assertIn('requires the Firebase backend', err)
@@ -0,0 +1,87 @@
+import io
+import json
+import threading
+import http.server
+import contextlib
+import support
+import client
+
+class HomeGraph(http.server.ThreadingHTTPServer):
+    ## records the requestSync calls and the connections they came on
+    def __init__(self, statuses=None):
+        self.requests = []
+        self.connections = set()
+        self.statuses = statuses or {}
+        server = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with server.lock:
+                    server.requests.append((self.path, payload))
+                    server.connections.add(self.client_address)
+                status = server.statuses.get(payload.get('agent_user_id'), 200)
+                self.send_response(status)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+            def log_message(self, *args):
+                pass
+        self.lock = threading.Lock()
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    def agents(self):
+        return sorted(payload['agent_user_id'] for path, payload in self.requests)
+
+class RequestSyncDispatcherTest(support.MemoryTestCase):
+    def homegraph(self, statuses=None):
+        server = HomeGraph(statuses)
+        self.addCleanup(server.stop)
+        return server
+    def close(self, dispatcher):
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            dispatcher.close()
+        return err.getvalue()
+
+    def test_duplicates_within_the_window_are_sent_once(self):
+        server = self.homegraph()
+        dispatcher = client.RequestSyncDispatcher(server.url, 'key', debounce=60)
+        for agent_user_id in ('u1', 'u2', 'u1', 'u1'):
+            dispatcher.submit(agent_user_id)
+        err = self.close(dispatcher)
+        self.assertEqual(server.agents(), ['u1', 'u2'])
+        self.assertEqual(server.requests[0][0], '/v1/devices:requestSync?key=key')
+        self.assertEqual(err, 'requestSync: 4 requested, 2 sent, 2 merged, 0 failed\n')
+
+    def test_connections_are_kept_alive(self):
+        server = self.homegraph()
+        dispatcher = client.RequestSyncDispatcher(server.url, None, maxWorkers=1, debounce=60)
+        for i in range(5):
+            dispatcher.submit('u{}'.format(i))
+            dispatcher.flush()
+        self.close(dispatcher)
+        self.assertEqual(len(server.requests), 5)
+        self.assertEqual(len(server.connections), 1)
+
+    def test_failures_are_counted(self):
+        server = self.homegraph({ 'u2': 404 })
+        dispatcher = client.RequestSyncDispatcher(server.url, None, debounce=60)
+        dispatcher.submit('u1')
+        dispatcher.submit('u2')
+        err = self.close(dispatcher)
+        self.assertIn('requestSync u2 failed: 404', err)
+        self.assertIn('2 sent, 0 merged, 1 failed', err)
+
+    def test_one_request_per_user_of_a_command(self):
+        server = self.homegraph()
+        self.seed_home()
+        ## user1 and user2 share group1, each is synced once
+        status, out, err = self.cli('--homegraph-url', server.url, 'add_group_device', '--device-id', 'light1', '--group-id', 'group1', '--remote-id', 'remote1', apikey='key')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(server.agents(), ['user1', 'user2'])
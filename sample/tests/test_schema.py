@@ -0,0 +1,137 @@
+import os
+import json
+import tempfile
+import support
+import client
+
+class DeviceAttributeTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.put('devices/d1', { 'type': 'action.devices.types.LIGHT', 'traits': [ 'action.devices.traits.OnOff', 'action.devices.traits.ColorSpectrum' ] })
+
+    def test_valid_attribute_is_written(self):
+        status, out, err = self.cli('add_device_attr', '--device-id', 'd1', '--attr-name', 'colorModel', '--attr-data', '"hsv"')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.data('devices/d1')['attributes'], { 'colorModel': 'hsv' })
+
+    def test_invalid_value_costs_no_rpc(self):
+        rpcs = self.db._store.rpcs
+        status, out, err = self.cli('add_device_attr', '--device-id', 'd1', '--attr-name', 'colorModel', '--attr-data', '"cmyk"')
+        self.assertEqual(status, 1)
+        self.assertIn('is not one of', err)
+        self.assertEqual(self.db._store.rpcs, rpcs)
+
+    def test_attribute_of_another_trait(self):
+        status, out, err = self.cli('add_device_attr', '--device-id', 'd1', '--attr-name', 'temperatureMinK', '--attr-data', '2000')
+        self.assertEqual(status, 1)
+        self.assertIn('not an attribute of ColorSpectrum, OnOff', err)
+        self.assertNotIn('attributes', self.data('devices/d1'))
+
+    def test_device_with_unknown_trait(self):
+        self.put('devices/d2', { 'type': 'action.devices.types.LIGHT', 'traits': [ 'action.devices.traits.OnOff', 'action.devices.traits.Timer' ] })
+        status, out, err = self.cli('add_device_attr', '--device-id', 'd2', '--attr-name', 'commandOnlyOnOff', '--attr-data', 'true')
+        self.assertEqual(status, 1)
+        self.assertIn('devices/d2: Timer is not a device trait', err)
+        self.assertNotIn('Traceback', err)
+
+    def test_nested_field_is_checked_within_its_attribute(self):
+        self.put('devices/d3', { 'type': 'action.devices.types.KETTLE', 'traits': [ 'action.devices.traits.TemperatureControl' ],
+            'attributes': { 'temperatureRange': { 'minThresholdCelsius': 30, 'maxThresholdCelsius': 90 } } })
+        status, out, err = self.cli('add_device_attr', '--device-id', 'd3', '--attr-name', 'temperatureRange.maxThresholdCelsius', '--attr-data', '"hot"')
+        self.assertEqual(status, 1)
+        self.assertIn('attributes.temperatureRange.maxThresholdCelsius: "hot" is not number', err)
+        status, out, err = self.cli('add_device_attr', '--device-id', 'd1', '--attr-name', 'nothing.field', '--attr-data', '1')
+        self.assertEqual(status, 1)
+        self.assertIn('attributes.nothing: not an attribute of ColorSpectrum, OnOff', err)
+        status, out, err = self.cli('add_device_attr', '--device-id', 'd3', '--attr-name', 'temperatureRange.maxThresholdCelsius', '--attr-data', '100')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.data('devices/d3')['attributes'], { 'temperatureRange': { 'minThresholdCelsius': 30, 'maxThresholdCelsius': 100 } })
+
+    def test_missing_device_is_not_taken_from_the_cache(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        filename = os.path.join(tmpdir.name, 'cache.db')
+        self.put('devices/d1', dict(self.data('devices/d1'), manufacturer='a', model='b'))
+        status, out, err = self.cli('--cache', filename, 'get_device', '--device-id', 'd1')
+        self.assertEqual(status, 0, err)
+        self.db.document('devices/d1').delete()
+        for attr_name in ('colorModel', 'colorModel.field'):
+            status, out, err = self.cli('--cache', filename, 'add_device_attr', '--device-id', 'd1', '--attr-name', attr_name, '--attr-data', '"hsv"')
+            self.assertEqual(status, 1)
+            self.assertIn('d1 cannot referenced, check Devices', err)
+        self.assertIsNone(self.data('devices/d1'))
+
+class StateSchemaTest(support.MemoryTestCase):
+    ## params of EXECUTE commands, stored as states by index.js and executor.py
+    commandParams = [
+        { 'on': True },
+        { 'brightness': 40 },
+        { 'color': { 'name': 'red', 'spectrumRGB': 0xFF0000 } },
+        { 'color': { 'temperature': 2700 } },
+        { 'fanSpeed': 'speed_low' },
+        { 'updateModeSettings': { 'load': 'small' } },
+        { 'updateToggleSettings': { 'sterilization': True } },
+        { 'thermostatMode': 'cool' },
+        { 'thermostatTemperatureSetpoint': 26 },
+        { 'thermostatTemperatureSetpointHigh': 28, 'thermostatTemperatureSetpointLow': 20 },
+        { 'start': True },
+        { 'pause': False },
+        { 'temperature': 60 },
+        { 'deactivate': False },
+    ]
+
+    def test_command_params_are_valid_states(self):
+        validator = client.get_schema_registry().states()
+        for params in self.commandParams:
+            self.assertEqual(validator(params), [], params)
+
+    def test_validate_states_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'states.jsonl')
+            with open(filename, 'w') as fd:
+                for i, params in enumerate(self.commandParams):
+                    fd.write(json.dumps({ 'id': 'ud{}'.format(i), 'state': params }) + "\n")
+                fd.write(json.dumps({ 'id': 'bad', 'state': { 'brightness': 150, 'on': 'yes' } }) + "\n")
+            status, out, err = self.cli('validate', '--states', filename)
+        self.assertEqual(status, 1)
+        self.assertIn('{} records, 1 invalid'.format(len(self.commandParams) + 1), out)
+        self.assertIn('states/bad.brightness: 150 is out of range 0..100', err)
+        self.assertIn('states/bad.on: "yes" is not boolean', err)
+
+class ValidateFileTest(support.MemoryTestCase):
+    def records(self):
+        records = [ dict(record) for record in support.HOME ]
+        records[3]['traits'] = ['OnOff', 'ColorSpectrum']
+        records[3]['attributes'] = { 'colorModel': 'cmyk' }
+        records.append({ 'kind': 'device', 'id': 'toaster1', 'manufacturer': 'a', 'model': 'b', 'type': 'TOASTER', 'traits': ['Toast'] })
+        return records
+
+    def test_valid_file(self):
+        status, out, err = self.cli('validate', '--file', self.records_file(support.HOME))
+        self.assertEqual(status, 0, err)
+        self.assertTrue(out.startswith('8 records, 0 invalid'), out)
+
+    def test_every_error_is_reported_without_reading(self):
+        rpcs = self.db._store.rpcs
+        status, out, err = self.cli('validate', '--file', self.records_file(self.records()))
+        self.assertEqual(status, 1)
+        self.assertTrue(out.startswith('9 records, 2 invalid'), out)
+        self.assertEqual(err.splitlines(), [
+            'record 4: attributes.colorModel: "cmyk" is not one of "rgb", "hsv"',
+            'record 9: type: "TOASTER" is not a device type',
+            'record 9: traits: "Toast" is not a device trait',
+        ])
+        self.assertEqual(self.db._store.rpcs, rpcs)
+
+    def test_csv_file(self):
+        filename = self.records_file([], suffix='.csv')
+        with open(filename, 'w') as fd:
+            fd.write('kind,manufacturer,model,type,traits\ndevice,a,b,LIGHT,OnOff;Brightness\ndevice,a,b,LIGHT,OnOff;Dim\n')
+        status, out, err = self.cli('validate', '--file', filename)
+        self.assertEqual(status, 1)
+        self.assertEqual(err, 'record 2: traits: "Dim" is not a device trait\n')
+
+    def test_invalid_file_is_not_applied(self):
+        status, out, err = self.cli('apply', '--file', self.records_file(self.records()))
+        self.assertEqual(status, 1)
+        self.assertEqual(self.db.dump(), {})
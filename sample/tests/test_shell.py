@@ -0,0 +1,53 @@
+import io
+import os
+import json
+import tempfile
+from unittest import mock
+import support
+import client
+
+class ShellStatusTest(support.MemoryTestCase):
+    def shell(self, *lines):
+        with mock.patch('sys.stdin', io.StringIO(''.join(line + '\n' for line in lines))):
+            return self.cli('shell', '--quiet')
+
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.put('users/u1', { 'name': 'a@example.jp' })
+        self.put('user_groups/u1', {})
+
+    def test_batch_succeeds(self):
+        status, out, err = self.shell('add_user --name b@example.jp', 'get_user --user-id u1')
+        self.assertEqual(status, 0, err)
+
+    def test_failed_command_fails_the_batch(self):
+        status, out, err = self.shell('build_user_groups --verify', 'get_user --user-id u1')
+        self.assertEqual(status, 0, err)
+        self.put('user_groups/u2', {})
+        status, out, err = self.shell('build_user_groups --verify', 'get_user --user-id u1')
+        self.assertEqual(status, 1)
+        self.assertIn('user_groups/u2 has no user', out)
+
+    def test_failed_validate_fails_the_batch(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as fd:
+            fd.write(json.dumps({ 'kind': 'user' }) + '\n')
+            fd.write(json.dumps({ 'kind': 'device', 'device_id': 'd1' }) + '\n')
+            fd.flush()
+            status, out, err = self.shell('validate --file ' + fd.name)
+        self.assertEqual(status, 1)
+        self.assertIn('1 invalid', out)
+
+class ShellListenTest(support.MemoryTestCase):
+    def test_socket_is_for_its_owner_only(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        listen = os.path.join(tmpdir.name, 'client.sock')
+        modes = []
+        def serve_forever(server):
+            modes.append(os.stat(listen).st_mode & 0o777)
+            raise KeyboardInterrupt()
+        with mock.patch.object(client.socketserver.UnixStreamServer, 'serve_forever', serve_forever):
+            status, out, err = self.cli('shell', '--listen', listen)
+        self.assertEqual(status, 0, err)
+        self.assertEqual(modes, [0o600])
+        self.assertFalse(os.path.exists(listen))
@@ -0,0 +1,38 @@
+import os
+import tempfile
+import support
+import client
+
+class SnapshotTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+        ## a compact code, bytes in its blob
+        status, out, err = self.cli('add_remote_code', '--ircode-id', 'ircode1', '--remote-type', 'broadlink', '--action', 'OnOff', '--values', 'on=2600ae00', '--compact')
+        self.assertEqual(status, 0, err)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.snapshot = os.path.join(self.tmpdir.name, 'snapshot.db')
+        status, out, err = self.cli('export', '--snapshot', self.snapshot)
+        self.assertEqual(status, 0, err)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def exported(self, documents):
+        return { path: docdata for path, docdata in documents.items() if path.split('/', 1)[0] in client.Export.exportCollections }
+
+    def test_get_reads_the_snapshot_like_firestore(self):
+        for argv in (('get_user_device', '--full'), ('get_group', '--full'), ('get_device',)):
+            self.assertEqual(self.cli(*argv, '--snapshot', self.snapshot), self.cli(*argv))
+
+    def test_snapshot_is_not_read_from_firestore(self):
+        rpcs = self.db._store.rpcs
+        status, out, err = self.cli('get_user_device', '--full', '--snapshot', self.snapshot)
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.db._store.rpcs, rpcs)
+
+    def test_restore_gives_back_the_exported_documents(self):
+        expected = self.exported(self.db.dump())
+        db = client.MemoryBackend().client()
+        status, out, err = self.cli('restore', '--snapshot', self.snapshot, db=db)
+        self.assertEqual(status, 0, err)
+        self.assertEqual(out.split(' in ')[0], 'restored {} documents from {}'.format(len(expected), self.snapshot))
+        self.assertEqual(self.exported(db.dump()), expected)
@@ -0,0 +1,49 @@
+import support
+
+class UserGroupTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+    def group_ids(self, user_id):
+        return sorted(self.data('user_groups/' + user_id))
+
+    def test_index_follows_the_groups(self):
+        self.assertEqual(self.group_ids('user1'), ['group1'])
+        status, out, err = self.cli('add_group', '--user-id', 'user2')
+        self.assertEqual(status, 0, err)
+        group_id = out.split()[0].split('/')[1]
+        self.assertEqual(self.group_ids('user2'), sorted(['group1', group_id]))
+        self.assertEqual(self.data('user_groups/user2')[group_id].path, 'groups/' + group_id)
+        status, out, err = self.cli('del_group', '--group-id', 'group1')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.group_ids('user1'), [])
+        self.assertEqual(self.group_ids('user2'), [group_id])
+
+    def test_deleted_user_takes_its_index_along(self):
+        status, out, err = self.cli('del_user', '--user-id', 'user1')
+        self.assertEqual(status, 0, err)
+        self.assertIsNone(self.data('users/user1'))
+        self.assertIsNone(self.data('user_groups/user1'))
+        self.assertIsNotNone(self.data('user_groups/user2'))
+
+    def test_get_user_groups_reads_one_document(self):
+        rpcs = self.db._store.rpcs
+        status, out, err = self.cli('get_user_groups', '--user-id', 'user2', '--format', 'jsonl')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(out, '{"id": "user2", "groups": ["group1"]}\n')
+        self.assertEqual(self.db._store.rpcs - rpcs, 1)
+
+    def test_build_user_groups_repairs_the_index(self):
+        self.put('user_groups/user1', { 'stale': self.ref('groups/stale') })
+        self.db.document('user_groups/user2').delete()
+        self.put('user_groups/ghost', {})
+        status, out, err = self.cli('build_user_groups', '--verify')
+        self.assertEqual(status, 1)
+        self.assertIn('3 inconsistent', out)
+        status, out, err = self.cli('build_user_groups')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.group_ids('user1'), ['group1'])
+        self.assertEqual(self.group_ids('user2'), ['group1'])
+        self.assertIsNone(self.data('user_groups/ghost'))
+        status, out, err = self.cli('build_user_groups', '--verify')
+        self.assertEqual((status, out), (0, '2 users checked, 0 inconsistent\n'))
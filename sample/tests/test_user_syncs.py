@@ -0,0 +1,48 @@
+import support
+
+class UserSyncTest(support.MemoryTestCase):
+    def setUp(self):
+        support.MemoryTestCase.setUp(self)
+        self.seed_home()
+        status, out, err = self.cli('build_sync')
+        self.assertEqual(status, 0, err)
+    def device_ids(self, user_id):
+        return sorted(device['id'] for device in self.data('user_syncs/' + user_id)['devices'])
+
+    def test_sync_devices_of_user_and_groups(self):
+        self.assertEqual(self.device_ids('user1'), ['gd1', 'ud1'])
+        self.assertEqual(self.device_ids('user2'), ['gd1'])
+        device = next(device for device in self.data('user_syncs/user1')['devices'] if device['id'] == 'ud1')
+        self.assertEqual(device, {
+            'id': 'ud1',
+            'type': 'action.devices.types.LIGHT',
+            'name': { 'defaultNames': ['Panasonic HH-XCH1222A'], 'name': 'Panasonic HH-XCH1222A', 'nicknames': ['living'] },
+            'deviceInfo': { 'manufacturer': 'Panasonic', 'model': 'HH-XCH1222A' },
+            'traits': ['action.devices.traits.OnOff'],
+            'willReportState': False,
+            'attributes': { 'commandOnlyOnOff': True },
+        })
+
+    def test_device_change_is_written_to_every_user(self):
+        status, out, err = self.cli('add_device_attr', '--device-id', 'light1', '--attr-name', 'commandOnlyOnOff', '--attr-data', 'false')
+        self.assertEqual(status, 0, err)
+        for user_id in ('user1', 'user2'):
+            for device in self.data('user_syncs/' + user_id)['devices']:
+                self.assertEqual(device['attributes'], { 'commandOnlyOnOff': False })
+
+    def test_user_device_changes_are_written(self):
+        status, out, err = self.cli('add_user_device', '--device-id', 'light1', '--user-id', 'user2', '--remote-id', 'remote1')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(len(self.device_ids('user2')), 2)
+        status, out, err = self.cli('del_user_device', '--user-device-id', 'ud1')
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.device_ids('user1'), ['gd1'])
+
+    def test_build_sync_rebuilds_and_removes(self):
+        self.db.document('user_syncs/user1').delete()
+        self.put('user_syncs/ghost', { 'devices': [] })
+        status, out, err = self.cli('build_sync')
+        self.assertEqual(status, 0, err)
+        self.assertTrue(out.startswith('2 SYNC documents built, 1 removed'), out)
+        self.assertEqual(self.device_ids('user1'), ['gd1', 'ud1'])
+        self.assertIsNone(self.data('user_syncs/ghost'))